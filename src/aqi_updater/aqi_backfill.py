@@ -0,0 +1,141 @@
+import sys
+sys.path.append('..')
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+from botocore.exceptions import ClientError
+from common.logger import Logger
+
+
+# the fetcher and the updater of a worker process of AqiBackfill (created by init_backfill_worker())
+__worker_state = {}
+
+
+def get_backfill_hours(start: datetime, end: datetime) -> List[datetime]:
+    """Returns the (UTC) hours from the hour of start to end (exclusive).
+    """
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    hours = []
+    while (hour < end):
+        hours.append(hour)
+        hour += timedelta(hours=1)
+    return hours
+
+
+def init_backfill_worker(create_fetcher: Callable, create_updater: Callable) -> None:
+    """Creates the updater and the fetcher of a worker process of AqiBackfill (once per process). The fetcher is
+    created with the sampling bounds of the updater (as keyword argument bounds), so that the AQI rasters are
+    cropped to the edges.
+    """
+    aqi_updater = create_updater()
+    __worker_state['updater'] = aqi_updater
+    __worker_state['fetcher'] = create_fetcher(bounds=aqi_updater.get_sampling_bounds())
+
+
+def backfill_aqi_hour(aqi_hour: datetime) -> dict:
+    """Fetches and processes the Enfuser data of the given (UTC) hour and exports the AQI update of the hour in
+    a worker process of AqiBackfill. The hour is skipped if its update already exists (e.g. from an earlier run).
+    Returns the hour, the status of the hour (done, skipped, missing or failed) and the duration (seconds).
+    """
+    aqi_fetcher = __worker_state['fetcher']
+    aqi_updater = __worker_state['updater']
+    aqi_tif_name = 'aqi_'+ aqi_hour.strftime('%Y-%m-%dT%H') +'.tif'
+    result = { 'aqi_tif': aqi_tif_name, 'status': 'done' }
+    time1 = time.time()
+    if (aqi_updater.full_update_exists(aqi_tif_name)):
+        result['status'] = 'skipped'
+        return result
+    try:
+        aqi_fetcher.fetch_process_aqi_data(aqi_hour)
+        aqi_updater.create_aqi_update_csv(
+            aqi_fetcher.latest_aqi_tif,
+            aqi_raster=aqi_fetcher.latest_aqi_raster,
+            pollutant_rasters=aqi_fetcher.latest_pollutant_rasters,
+            publish=False
+        )
+    except Exception as e:
+        if (isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')):
+            result['status'] = 'missing'
+        else:
+            result['status'] = 'failed'
+            result['error'] = traceback.format_exc()
+    finally:
+        aqi_fetcher.finish_aqi_fetch()
+    result['duration'] = round(time.time() - time1, 2)
+    return result
+
+
+class AqiBackfill:
+    """AqiBackfill creates the AQI updates of past hours (e.g. for rebuilding the history of AQI for exposure
+    studies). The hours are fetched, processed and sampled in parallel in a pool of worker processes, each of
+    which has its own AqiFetcher and AqiUpdater (created once per process by the given factories, e.g. partials
+    of the classes). The number of hours submitted to the pool at a time is bounded (to max_pending), so that
+    the results of completed hours are logged as the backfill proceeds.
+
+    The updates are written as full (unpublished) updates, i.e. with the same file names and formats as the
+    updates of the live AQI updater, but without aqi_map.json and manifest.json. Hours whose update already
+    exists are skipped, so that an interrupted backfill can be resumed by running it again. Hours whose Enfuser
+    data is not found in S3 are reported as missing.
+
+    Attributes:
+        log: An instance of Logger class for writing log messages.
+        results: The results of the backfilled hours (AQI tif name, status and duration) in the order of completion.
+        __create_fetcher: A function that returns an AqiFetcher (takes the sampling bounds as keyword argument).
+        __create_updater: A function that returns an AqiUpdater.
+        __processes: The number of worker processes.
+        __max_pending: The maximum number of hours submitted to the worker processes at a time.
+    """
+
+    def __init__(
+        self,
+        log: Logger,
+        create_fetcher: Callable,
+        create_updater: Callable,
+        processes: int = 4,
+        max_pending: int = None
+    ):
+        self.log = log
+        self.results: List[dict] = []
+        self.__create_fetcher = create_fetcher
+        self.__create_updater = create_updater
+        self.__processes = max(processes, 1)
+        self.__max_pending = max_pending if max_pending else 2 * self.__processes
+
+    def run(self, start: datetime, end: datetime) -> Dict[str, int]:
+        """Backfills the AQI updates of the hours from start to end (exclusive). Returns the number of hours by
+        status (done, skipped, missing and failed).
+        """
+        hours = get_backfill_hours(start, end)
+        self.log.info(f'Backfilling AQI updates of {len(hours)} hours with {self.__processes} processes')
+        counts = { 'done': 0, 'skipped': 0, 'missing': 0, 'failed': 0 }
+        with ProcessPoolExecutor(
+            max_workers=self.__processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_backfill_worker,
+            initargs=(self.__create_fetcher, self.__create_updater)
+        ) as executor:
+            pending = set()
+            for hour in hours:
+                if (len(pending) >= self.__max_pending):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.__add_result(future.result(), counts, len(hours))
+                pending.add(executor.submit(backfill_aqi_hour, hour))
+            for future in wait(pending).done:
+                self.__add_result(future.result(), counts, len(hours))
+        self.log.info(f'Backfilled AQI updates: {counts}')
+        return counts
+
+    def __add_result(self, result: dict, counts: Dict[str, int], hour_count: int) -> None:
+        self.results.append(result)
+        counts[result['status']] += 1
+        progress = f'({len(self.results)}/{hour_count})'
+        if (result['status'] == 'failed'):
+            self.log.error(f'Backfill of {result["aqi_tif"]} failed {progress}:\n{result["error"]}')
+        elif (result['status'] == 'missing'):
+            self.log.warning(f'No Enfuser data found for {result["aqi_tif"]} {progress}')
+        elif (result['status'] == 'done'):
+            self.log.info(f'Backfilled {result["aqi_tif"]} in {result["duration"]} s {progress}')
@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+from datetime import datetime
+from functools import partial
+from aqi_fetcher import AqiFetcher
+from aqi_updater import create_graph_aqi_updater
+from aqi_backfill import AqiBackfill
+from load_env_vars import load_env_vars, get_bool_env
+from common.logger import Logger
+
+
+def main():
+    # e.g. python aqi_backfill_app.py --start 2020-10-01T00 --end 2020-11-01T00 --processes 8
+    parser = argparse.ArgumentParser(description='Creates the AQI updates of past hours (UTC)')
+    parser.add_argument('--start', required=True, help='The first hour to backfill, e.g. 2020-10-01T00')
+    parser.add_argument('--end', required=True, help='The hour at which the backfill ends (exclusive), e.g. 2020-11-01T00')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='The number of worker processes')
+    parser.add_argument('--graph', default=None, help='A GraphML file of the graph (default by GRAPH_SUBSET)')
+    parser.add_argument(
+        '--aqi-updates', 
+        default='aqi_backfill/', 
+        help='The directory of the AQI updates (not the aqi_updates/ directory of the live AQI updater, which removes '
+            'unpublished update files)'
+    )
+    args = parser.parse_args()
+
+    log = Logger(printing=True, log_file='aqi_backfill_app.log')
+    load_env_vars(log)
+
+    # the live AQI updater would remove the backfilled (unpublished) files from its directory
+    live_aqi_updates = os.path.abspath(args.aqi_updates) == os.path.abspath('aqi_updates/')
+    if (live_aqi_updates or os.path.exists(os.path.join(args.aqi_updates, 'manifest.json'))):
+        log.error(f'{args.aqi_updates} is a directory of published AQI updates, use another one for the backfill')
+        sys.exit(1)
+
+    graph_subset = get_bool_env('GRAPH_SUBSET', False)
+    graph_file = args.graph if args.graph else 'graph/kumpula.graphml' if graph_subset else 'graph/hma.graphml'
+    pollutants = [p for p in os.getenv('AQI_POLLUTANTS', '').split(',') if p]
+    os.makedirs(args.aqi_updates, exist_ok=True)
+    os.makedirs('aqi_cache/backfill/', exist_ok=True)
+
+    # the updates are exported as full updates (no delta updates or AQI map)
+    create_updater = partial(
+        create_graph_aqi_updater,
+        log,
+        graph_file,
+        aqi_updates=args.aqi_updates,
+        sampling=os.getenv('AQI_SAMPLING', 'point'),
+        binary_formats=[f for f in os.getenv('AQI_BINARY_FORMATS', '').split(',') if f],
+        pollutants=pollutants
+    )
+    # the rasters are only kept in memory (the workers share aqi_cache/backfill/ for temp files)
+    create_fetcher = partial(
+        AqiFetcher,
+        log,
+        aqi_dir='aqi_cache/backfill/',
+        in_memory=True,
+        archive_tif=False,
+        pollutants=pollutants,
+        download_concurrency=int(os.getenv('AQI_BACKFILL_DOWNLOAD_CONCURRENCY', '2'))
+    )
+
+    aqi_backfill = AqiBackfill(log, create_fetcher, create_updater, processes=args.processes)
+    counts = aqi_backfill.run(
+        datetime.strptime(args.start, '%Y-%m-%dT%H'),
+        datetime.strptime(args.end, '%Y-%m-%dT%H')
+    )
+    if (counts['failed'] > 0):
+        log.error(f'Backfill of {counts["failed"]} hours failed, run the backfill again to retry them')
+        sys.exit(1)
+
+
+if (__name__ == '__main__'):
+    main()
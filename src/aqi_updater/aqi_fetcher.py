@@ -1,18 +1,26 @@
 import sys
 sys.path.append('..')
 import os
+import shutil
+import tempfile
+import threading
 import zipfile
+import netCDF4
 import rioxarray
 import xarray
+import time
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import numpy as np
 import pandas as pd
 import datetime
-import rasterio
-from rasterio import fill
 from datetime import datetime
-from typing import List, Set, Dict, Tuple, Optional
+from typing import List, Set, Dict, Tuple, Optional, IO
 from common.logger import Logger
+from common.raster import RasterBand, RasterStack, write_raster_band
+from common.raster_fill import NodataFiller
 
 
 class AqiFetcher:
@@ -21,54 +29,151 @@ class AqiFetcher:
     Notes:
         The required python environment for using the class can be installed with: conda env create -f conda-env.yml.
         
+        Before the download, new_aqi_available() checks the metadata (ETag and size) of the expected Enfuser zip file in
+        S3 with a HEAD request, so that the download is only started when a new file has been published.
+
         Essentially, AQI download workflow is composed of the following steps (executed by fetch_process_current_aqi_data()):
-            1)	Create a key for fetching Enfuser data based on current UTC time (e.g. “allPollutants_2019-11-08T11.zip”).
+            1)	Create a key for fetching Enfuser data based on current UTC time (e.g. “allPollutants_2019-11-08T11.zip”),
+                or on a given hour (fetch_process_aqi_data(), e.g. for backfilling AQI updates of past hours).
             2)  Fetch a zip archive that contains Enfuser netCDF data from Amazon S3 bucket using the key, 
-                aws_access_key_id and aws_secret_access_key. 
-            3)  Extract Enfuser netCDF data (e.g. allPollutants_2019-09-11T15.nc) from the downloaded zip archive.
-            4)  Extract AQI layer from the allPollutants*.nc file and export it as GeoTiff (WGS84).
-            5)  Open the exported raster and fill nodata values with interpolated values. 
-                Value 1 is considered nodata in the data. This is an optional step. 
+                aws_access_key_id and aws_secret_access_key. The archive is streamed to a spooled buffer that 
+                is kept in memory unless it is larger than spool_max_size. Archives larger than
+                download_chunk_size are downloaded as parallel ranged requests (download_concurrency).
+            3)  Decompress only the Enfuser netCDF file (e.g. allPollutants_2019-09-11T15.nc) from the zip archive, 
+                to memory or (if larger than spool_max_size) to aqi_cache directory.
+            4)  Read (only) the AQI layer (and the layers of the optional pollutants) from the allPollutants*.nc 
+                file as an array (WGS84). If bounds are given, only the window within the bounds is read (and 
+                processed in the following steps). In forecast mode, all time steps (hours) of the AQI layer are 
+                read as a stack, else only the first one.
+            5)  Fill nodata values of the AQI array with interpolated values. 
+                Value 1 is considered nodata in the data. This is an optional step. Nodata is detected on the 
+                whole grid of the first time step of AQI, also when the array is cropped to bounds. The fill plan 
+                (source pixels and weights of the nodata pixels) is reused as long as the nodata area does not 
+                change. All time steps (and pollutants) are filled at once with the nodata mask of the first step
+                of AQI.
+            6)  Export the filled AQI array as GeoTiff. In in-memory mode, the filled AQI array is handed to 
+                AqiUpdater directly (as latest_aqi_raster) and the GeoTiff is only written as an archival copy 
+                in a background thread (if archive_tif is True). 
+        
+        The results of the steps are cached until the whole workflow succeeds. Hence if the processing fails midway,
+        it is resumed from the last completed step on the next try (if the zip file in S3 has not changed).
 
     Attributes:
         log: An instance of Logger class for writing log messages.
         wip_aqi_tif: The name of an aqi tif file that is currently being produced (wip = work in progress).
         latest_aqi_tif: The name of the latest AQI tif file that was processed.
+        latest_aqi_raster: The latest processed AQI raster (RasterBand) in memory.
+        latest_aqi_forecast: All time steps (hours) of the latest processed AQI data (RasterStack) in forecast mode,
+            starting from the hour of latest_aqi_raster.
+        latest_pollutant_rasters: The latest processed rasters (RasterBand) of the pollutants by variable name 
+            (of the same hour and grid as latest_aqi_raster).
+        latest_aqi_available_at: The time (epoch seconds) when the latest processed Enfuser zip file was published 
+            in S3 (or when its processing started, if the time is not known).
         __aqi_dir: A filepath pointing to a directory where all AQI files will be downloaded to and processed.
         __s3_bucketname: The name of the AWS s3 bucket from where the enfuser data will be fetched from.
         __s3_region: The name of the AWS s3 bucket from where the enfuser data will be fetched from.
+        __s3_endpoint_url: An optional endpoint URL of the S3 service (e.g. of a local MinIO server for testing).
         __AWS_ACCESS_KEY_ID: A secret AWS access key id to enfuser s3 bucket.
         __AWS_SECRET_ACCESS_KEY: A secret AWS access key to enfuser s3 bucket.
         __temp_files_to_rm (list): A list where names of created temporary files will be collected during processing.
         __status: The status of the aqi processor - has latest AQI data been processed or not.
+        __in_memory: A boolean variable indicating whether the GeoTiff is written in a background thread 
+            (or not at all) instead of on the critical path of the processing.
+        __archive_tif: A boolean variable indicating whether the GeoTiff is written in in-memory mode.
+        __archive_thread: A thread that writes the latest GeoTiff in in-memory mode.
+        __spool_max_size: Maximum size (bytes) of the downloaded zip and the extracted netCDF file to keep in memory.
+        __nodata_share: The minimum share of nodata pixels expected in the whole AQI grid (if not learned from previous hours).
+        __bounds: Optional WGS84 bounds (minx, miny, maxx, maxy) to which the AQI raster is cropped.
+        __forecast: A boolean variable indicating whether all time steps of the AQI data are processed.
+        __pollutants: Names of the variables of the pollutants (e.g. NO2, PM25, PM10, O3) to process besides AQI.
+        __learned_nodata: The shape of the grid and the count of nodata pixels found in the latest AQI grid.
+        __nodata_filler: Fills nodata of AQI rasters with a fill plan cached for the latest nodata mask.
+        __transfer_config: S3 transfer settings for downloading with parallel ranged requests.
+        __s3_client: A long-lived S3 client (with a connection pool) that is reused between downloads.
+        latest_download_stats: Size, duration and throughput of the latest download.
+        __current_s3_object: Key, ETag and size of the Enfuser zip file found by the latest HEAD request.
+        __stage_cache: Results of the completed processing steps of the current Enfuser zip file (valid for its ETag and size).
 
     """
 
-    def __init__(self, logger: Logger, aqi_dir: str = 'aqi_cache/'):
+    def __init__(
+        self, 
+        logger: Logger, 
+        aqi_dir: str = 'aqi_cache/', 
+        in_memory: bool = False, 
+        archive_tif: bool = True,
+        spool_max_size: int = 512 * 2**20,
+        nodata_share: float = 0.1,
+        bounds: Tuple[float, float, float, float] = None,
+        forecast: bool = False,
+        pollutants: List[str] = [],
+        download_concurrency: int = 8,
+        download_chunk_size: int = 8 * 2**20,
+        s3_bucketname: str = 'enfusernow2',
+        s3_endpoint_url: str = None
+    ):
         self.log = logger
         self.wip_aqi_tif: str = ''
         self.latest_aqi_tif: str = ''
+        self.latest_aqi_raster: RasterBand = None
+        self.latest_aqi_available_at: float = None
+        self.latest_aqi_forecast: RasterStack = None
+        self.latest_pollutant_rasters: Dict[str, RasterBand] = {}
         self.__aqi_dir = aqi_dir
-        self.__s3_bucketname: str = 'enfusernow2'
+        self.__in_memory = in_memory
+        self.__archive_tif = archive_tif
+        self.__archive_thread: threading.Thread = None
+        self.__spool_max_size = spool_max_size
+        self.__nodata_share = nodata_share
+        self.__bounds = bounds
+        self.__forecast = forecast
+        self.__pollutants = list(pollutants)
+        self.__learned_nodata: Tuple[tuple, int] = None
+        self.__nodata_filler = NodataFiller(max_search_distance=100)
+        self.__s3_bucketname: str = s3_bucketname
         self.__s3_region: str = 'eu-central-1'
+        self.__s3_endpoint_url: str = s3_endpoint_url if s3_endpoint_url else os.getenv('ENFUSER_S3_ENDPOINT_URL', None)
         self.__AWS_ACCESS_KEY_ID: str = os.getenv('ENFUSER_S3_ACCESS_KEY_ID', None) 
         self.__AWS_SECRET_ACCESS_KEY: str = os.getenv('ENFUSER_S3_SECRET_ACCESS_KEY', None) 
+        self.__transfer_config = TransferConfig(
+            multipart_threshold=download_chunk_size,
+            multipart_chunksize=download_chunk_size,
+            max_concurrency=download_concurrency,
+            use_threads=download_concurrency > 1
+        )
+        self.__s3_client = None
+        self.latest_download_stats: dict = {}
+        self.__current_s3_object: dict = {}
+        self.__stage_cache: dict = {}
         self.__temp_files_to_rm: list = []
         self.__status: str = ''
 
     def new_aqi_available(self) -> bool:
         """Returns False if the expected latest aqi file is either already processed or being processed at the moment, 
-        else returns True.
+        or if the corresponding Enfuser zip file is not yet found in S3, else returns True. Only the existence of the 
+        zip file is probed (by HEAD request): a zip file that is changed in S3 after its hour has been processed is not 
+        fetched again. If the HEAD request to S3 fails, availability is decided by the name of the aqi file only.
         """
         b_available = True
         status = ''
-        current_aqi_tif = self.__get_current_aqi_tif_name()
+        current_aqi_tif = self.__get_aqi_tif_name(datetime.utcnow())
         if (self.latest_aqi_tif == current_aqi_tif):
             status = 'latest AQI data already fetched'
             b_available = False
         else:
-            status = 'new AQI data available: '+ current_aqi_tif
-            b_available = True
+            enfuser_data_key, _ = self.__get_enfuser_key_filename(datetime.utcnow())
+            try:
+                self.__current_s3_object = self.__probe_enfuser_data(enfuser_data_key)
+            except Exception:
+                self.__current_s3_object = {}
+                self.log.warning('Failed to check enfuser data in S3: '+ enfuser_data_key)
+                
+            if (self.__current_s3_object is None):
+                status = 'waiting for AQI data to be published: '+ enfuser_data_key
+                b_available = False
+            else:
+                status = 'new AQI data available: '+ current_aqi_tif
+                b_available = True
 
         if (self.__status != status):
             self.log.info(f'AQI processor status changed to: {status}')
@@ -76,28 +181,74 @@ class AqiFetcher:
         return b_available
 
     def fetch_process_current_aqi_data(self) -> None:
-        self.__set_wip_aqi_tif_name(self.__get_current_aqi_tif_name())
-        enfuser_data_key, aqi_zip_name = self.__get_current_enfuser_key_filename()
-        self.log.info('Created key for current AQI: '+ enfuser_data_key)
-        self.log.info('Fetching enfuser data...')
-        aqi_zip_name = self.__fetch_enfuser_data(enfuser_data_key, aqi_zip_name)
-        self.log.info('Got aqi_zip: '+ aqi_zip_name)
-        aqi_nc_name = self.__extract_zipped_aqi(aqi_zip_name)
+        self.fetch_process_aqi_data(datetime.utcnow())
+
+    def fetch_process_aqi_data(self, aqi_hour: datetime) -> None:
+        """Fetches and processes the Enfuser data of the given (UTC) hour.
+        """
+        fetch_started_at = time.time()
+        self.__set_wip_aqi_tif_name(self.__get_aqi_tif_name(aqi_hour))
+        enfuser_data_key, aqi_zip_name = self.__get_enfuser_key_filename(aqi_hour)
+        self.log.info('Created key for AQI: '+ enfuser_data_key)
+        s3_object = self.__current_s3_object
+        if (not s3_object or s3_object['key'] != enfuser_data_key):
+            s3_object = { 'key': enfuser_data_key }
+        if (self.__stage_cache.get('s3_object') != s3_object):
+            self.__stage_cache = { 's3_object': s3_object }
+
+        if ('aqi_nc' not in self.__stage_cache):
+            self.log.info('Fetching enfuser data...')
+            with self.__fetch_enfuser_data(enfuser_data_key) as aqi_zip:
+                self.log.info('Got aqi_zip: '+ aqi_zip_name)
+                self.__stage_cache['aqi_nc'] = self.__extract_zipped_aqi(aqi_zip)
+        else:
+            self.log.info('Resuming AQI processing from cached aqi_nc')
+        aqi_nc_name, aqi_nc_data = self.__stage_cache['aqi_nc']
         self.log.info('Extracted aqi_nc: '+ aqi_nc_name)
-        aqi_tif_name = self.__convert_aqi_nc_to_raster(aqi_nc_name)
-        self.log.info('Extracted aqi_tif: '+ aqi_tif_name)
-        aqi_tif_name = self.__fillna_in_raster(aqi_tif_name, na_val=1.0) 
-        self.latest_aqi_tif = aqi_tif_name
+
+        if ('aqi_raster' not in self.__stage_cache):
+            (
+                self.__stage_cache['aqi_raster'],
+                self.__stage_cache['pollutant_rasters'],
+                self.__stage_cache['nodata_threshold']
+            ) = self.__convert_aqi_nc_to_raster(aqi_nc_name, aqi_nc_data)
+        self.log.info('Extracted AQI raster: '+ ', '.join(self.__stage_cache['aqi_raster'].names))
+
+        if ('aqi_raster_fillna' not in self.__stage_cache):
+            # nodata mask of the first time step of AQI is used for all time steps and pollutants
+            nodata_mask = self.__stage_cache['aqi_raster'].bands[0] <= self.__stage_cache['nodata_threshold']
+            aqi_stack = self.__fillna_in_raster(self.__stage_cache['aqi_raster'], nodata_mask)
+            self.__validate_aqi_fillna(aqi_stack)
+            self.__stage_cache['pollutant_rasters_fillna'] = { 
+                variable: self.__fillna_in_raster(pollutant_raster, nodata_mask)
+                for variable, pollutant_raster in self.__stage_cache['pollutant_rasters'].items()
+            }
+            self.__stage_cache['aqi_raster_fillna'] = aqi_stack
+        aqi_stack = self.__stage_cache['aqi_raster_fillna']
+        aqi_raster = aqi_stack.get_band(0)
+        self.__export_aqi_raster(aqi_raster)
+
+        self.latest_aqi_raster = aqi_raster
+        self.latest_aqi_forecast = aqi_stack if self.__forecast else None
+        self.latest_pollutant_rasters = { 
+            variable: pollutant_raster.get_band(0) 
+            for variable, pollutant_raster in self.__stage_cache['pollutant_rasters_fillna'].items()
+        }
+        self.latest_aqi_tif = aqi_raster.name
+        self.latest_aqi_available_at = s3_object.get('last_modified', fetch_started_at)
+        self.__stage_cache = {}
 
     def finish_aqi_fetch(self) -> None:
-        self.__remove_temp_files()
+        # keep temp files (extracted aqi_nc) for resuming failed processing
+        if (not self.__stage_cache):
+            self.__remove_temp_files()
         self.__remove_old_aqi_files()
         self.__reset_wip_aqi_tif_name()
 
-    def __get_current_aqi_tif_name(self) -> str:
-        """Returns the name of the current expected edge aqi tif file. Note: it might not exist yet.
+    def __get_aqi_tif_name(self, aqi_hour: datetime) -> str:
+        """Returns the name of the expected edge aqi tif file of the given (UTC) hour. Note: it might not exist yet.
         """
-        curdt = datetime.utcnow().strftime('%Y-%m-%dT%H')
+        curdt = aqi_hour.strftime('%Y-%m-%dT%H')
         return 'aqi_'+ curdt +'.tif'
 
     def __set_wip_aqi_tif_name(self, name: str) -> None:
@@ -108,138 +259,266 @@ class AqiFetcher:
     def __reset_wip_aqi_tif_name(self) -> None:
         self.wip_aqi_tif = ''
 
-    def __get_current_enfuser_key_filename(self) -> Tuple[str, str]:
-        """Returns a key pointing to the expected current enfuser zip file in AWS S3 bucket. 
+    def __get_enfuser_key_filename(self, aqi_hour: datetime) -> Tuple[str, str]:
+        """Returns a key pointing to the expected enfuser zip file of the given (UTC) hour in AWS S3 bucket. 
         Also returns a name for the zip file for exporting the file. The names of the key and the zip file contain
-        the current UTC time (e.g. 2019-11-08T11).
+        the UTC time (e.g. 2019-11-08T11).
         """
-        curdt = datetime.utcnow().strftime('%Y-%m-%dT%H')
+        curdt = aqi_hour.strftime('%Y-%m-%dT%H')
         enfuser_data_key = 'Finland/pks/allPollutants_' + curdt + '.zip'
         aqi_zip_name = 'allPollutants_' + curdt + '.zip'
         return (enfuser_data_key, aqi_zip_name)
 
-    def __fetch_enfuser_data(self, enfuser_data_key: str, aqi_zip_name: str) -> str:
-        """Downloads the current enfuser data as a zip file containing multiple netcdf files to the aqi_cache directory. 
+    def __probe_enfuser_data(self, enfuser_data_key: str) -> Optional[dict]:
+        """Returns the key, ETag, size and modification time (epoch seconds) of an enfuser zip file in S3 
+        (by HEAD request), or None if the file does not exist (yet).
+        """
+        try:
+            response = self.__get_s3_client().head_object(Bucket=self.__s3_bucketname, Key=enfuser_data_key)
+        except ClientError as e:
+            if (e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')):
+                return None
+            raise
+        return { 
+            'key': enfuser_data_key, 
+            'etag': response['ETag'], 
+            'size': response['ContentLength'], 
+            'last_modified': response['LastModified'].timestamp()
+        }
+
+    def __fetch_enfuser_data(self, enfuser_data_key: str) -> IO[bytes]:
+        """Downloads the current enfuser data as a zip file containing multiple netcdf files to a spooled buffer. 
+        The buffer is kept in memory unless it grows larger than spool_max_size, in which case it is moved to
+        a temporary file in the aqi_cache directory (removed when the buffer is closed). 
         
         Returns:
-            The name of the downloaded zip file (e.g. allPollutants_2019-11-08T14.zip).
+            The buffer containing the downloaded zip file (e.g. allPollutants_2019-11-08T14.zip).
         """
-        # connect to S3
-        s3 = boto3.client('s3',
-                        region_name=self.__s3_region,
-                        aws_access_key_id=self.__AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=self.__AWS_SECRET_ACCESS_KEY)
-                
-        # download the netcdf file to a specified location
-        file_out = self.__aqi_dir + '/' + aqi_zip_name
-        s3.download_file(self.__s3_bucketname, enfuser_data_key, file_out)
-        self.__temp_files_to_rm.append(aqi_zip_name)
-        return aqi_zip_name
+        # stream the zip file to a spooled buffer (with parallel ranged requests if the file is large)
+        aqi_zip = tempfile.SpooledTemporaryFile(max_size=self.__spool_max_size, dir=self.__aqi_dir)
+        try:
+            time1 = time.time()
+            self.__get_s3_client().download_fileobj(
+                self.__s3_bucketname, enfuser_data_key, aqi_zip, Config=self.__transfer_config
+            )
+            # ranged parts may be written out of order, hence the size is taken from the end of the buffer
+            aqi_zip.seek(0, os.SEEK_END)
+            self.__set_download_stats(enfuser_data_key, aqi_zip.tell(), time.time() - time1)
+        except Exception:
+            aqi_zip.close()
+            raise
+        aqi_zip.seek(0)
+        return aqi_zip
+
+    def __get_s3_client(self):
+        """Returns a long-lived S3 client, which is created on the first call. The connection pool of the client
+        is sized for parallel ranged downloads.
+        """
+        if (self.__s3_client is None):
+            self.__s3_client = boto3.client('s3',
+                            region_name=self.__s3_region,
+                            endpoint_url=self.__s3_endpoint_url,
+                            aws_access_key_id=self.__AWS_ACCESS_KEY_ID,
+                            aws_secret_access_key=self.__AWS_SECRET_ACCESS_KEY,
+                            config=Config(max_pool_connections=max(10, self.__transfer_config.max_request_concurrency)))
+        return self.__s3_client
+
+    def __set_download_stats(self, enfuser_data_key: str, size: int, duration: float) -> None:
+        mb_per_s = round(size / 2**20 / duration, 2) if duration > 0 else None
+        self.latest_download_stats = { 
+            'key': enfuser_data_key, 
+            'bytes': size, 
+            'seconds': round(duration, 3), 
+            'mb_per_s': mb_per_s 
+        }
+        self.log.info(f'Downloaded {round(size / 2**20, 2)} MB in {round(duration, 3)} s ({mb_per_s} MB/s)')
 
-    def __extract_zipped_aqi(self, aqi_zip_name: str) -> str:
-        """Extracts the contents of a zip file containing enfuser self files. 
+    def __extract_zipped_aqi(self, aqi_zip: IO[bytes]) -> Tuple[str, Optional[bytes]]:
+        """Decompresses only the allPollutants netCDF file from a zip archive of enfuser files. The file is
+        decompressed to memory, or to aqi_cache directory if it is larger than spool_max_size.
 
         Args:
-            aqi_zip_name: The name of the zip file to be extracted from (in aqi_cache directory).
+            aqi_zip: A zip file (or buffer) containing enfuser netCDF files.
         Returns:
-            The name of the extracted AQI nc file.
+            The name of the extracted AQI nc file and its content (or None if it was extracted to aqi_cache).
         """
-        # read zip file in
-        archive = zipfile.ZipFile(self.__aqi_dir + aqi_zip_name, 'r')
-        
-        # loop over files in zip archive
-        for file_name in archive.namelist():
-            # extract only files with allPollutants string match
-            if ('allPollutants' in file_name):
-                # extract selected file to aqi_dir directory
-                archive.extract(file_name, self.__aqi_dir)
-                aqi_nc_name = file_name
-        
+        with zipfile.ZipFile(aqi_zip, 'r') as archive:
+            nc_members = [
+                member for member in archive.infolist() 
+                if 'allPollutants' in member.filename and member.filename.endswith('.nc')
+            ]
+            if (not nc_members):
+                raise ValueError('No allPollutants netCDF file found in the enfuser zip archive')
+            member = nc_members[-1]
+            aqi_nc_name = os.path.basename(member.filename)
+            
+            if (member.file_size <= self.__spool_max_size):
+                return (aqi_nc_name, archive.read(member))
+            
+            with archive.open(member) as nc_src, open(self.__aqi_dir + aqi_nc_name, 'wb') as nc_dst:
+                shutil.copyfileobj(nc_src, nc_dst, 2**20)
+
         self.__temp_files_to_rm.append(aqi_nc_name)
-        return aqi_nc_name
+        return (aqi_nc_name, None)
 
-    def __convert_aqi_nc_to_raster(self, aqi_nc_name: str) -> str:
-        """Converts a netCDF file to a georeferenced raster file. xarray and rioxarray automatically scale and offset 
+    def __open_aqi_nc(self, aqi_nc_name: str, aqi_nc_data: bytes = None) -> xarray.Dataset:
+        """Opens a netCDF file lazily either from memory (aqi_nc_data) or from aqi_cache directory. Data of the
+        variables is read only when (and as far as) it is accessed.
+        """
+        if (aqi_nc_data is not None):
+            nc_dataset = netCDF4.Dataset(aqi_nc_name, mode='r', memory=aqi_nc_data)
+            return xarray.open_dataset(xarray.backends.NetCDF4DataStore(nc_dataset))
+        return xarray.open_dataset(self.__aqi_dir + aqi_nc_name)
+
+    def __convert_aqi_nc_to_raster(self, aqi_nc_name: str, aqi_nc_data: bytes = None) -> Tuple[RasterStack, Dict[str, RasterStack], float]:
+        """Converts a netCDF file to a georeferenced raster (in memory). xarray and rioxarray automatically scale and offset 
         each netCDF file opened with proper values from the file itself. No manual scaling or adding offset required.
-        CRS of the exported GeoTiff is set to WGS84.
+        CRS of the raster is set to WGS84. Only the first time step of the AQI variable is read from the file
+        (all time steps in forecast mode), and only the window within bounds if they are set. The first time step
+        of the pollutants (if any) is read from the same (open) file. Pollutants missing from the file are skipped.
+        The nodata value of AQI is detected on the whole grid of the first time step (see __get_nodata_threshold).
 
         Args:
-            aqi_nc_name: The filename of an nc file to be processed (in aqi_cache directory).
-                e.g. allPollutants_2019-09-11T15.nc
+            aqi_nc_name: The filename of an nc file to be processed (e.g. allPollutants_2019-09-11T15.nc).
+            aqi_nc_data: The content of the nc file, if it was extracted to memory (else it is read from aqi_cache).
         Returns:
-            The name of the exported tif file (e.g. aqi_2019-11-08T14.tif).
+            The AQI raster as a stack of time steps, named by the tif files to export (e.g. aqi_2019-11-08T14.tif),
+            and the rasters of the pollutants by variable name (e.g. no2_2019-11-08T14.tif), and the largest
+            value of AQI that is considered nodata.
         """
-        # read .nc file containing the AQI layer as a multidimensional array
-        data = xarray.open_dataset(self.__aqi_dir + aqi_nc_name)
+        # open .nc file containing the AQI layer as a multidimensional array
+        with self.__open_aqi_nc(aqi_nc_name, aqi_nc_data) as data:
                 
-        # retrieve AQI, AQI.data has shape (time, lat, lon)
-        # the values are automatically scaled and offset AQI values
-        aqi = data['AQI']
+            # retrieve AQI, AQI.data has shape (time, lat, lon)
+            # the values are automatically scaled and offset AQI values
+            aqi = self.__read_nc_variable(data, 'AQI', all_steps=self.__forecast)
 
-        # save AQI to raster (.tif geotiff file recommended)
-        aqi = aqi.rio.set_crs('epsg:4326')
-        
-        # parse date & time from nc filename and export raster
-        aqi_date_str = aqi_nc_name[:-3][-13:]
-        aqi_tif_name = 'aqi_'+ aqi_date_str +'.tif'
-        aqi.rio.to_raster(self.__aqi_dir + aqi_tif_name)
-        self.latest_aqi_tif = aqi_tif_name
-        return aqi_tif_name
-
-    def __fillna_in_raster(self, aqi_tif_name: str, na_val: float = 1.0) -> str:
-        """Fills nodata values in a raster by interpolating values from surrounding cells.
-        Value 1.0 is considered as nodata. If no nodata is found with that value, a small offset will be applied,
-        as sometimes the nodata value is slightly higher than 1.0 (assumably due to inaccuracy in netcdf to 
-        geotiff conversion).
+            # parse date & time from nc filename
+            aqi_date_str = aqi_nc_name[:-3][-13:]
+            aqi_tif_names = self.__get_aqi_tif_names(aqi, aqi_date_str)
+            aqi_raster = RasterStack(aqi_tif_names, aqi.values, aqi.rio.transform(), aqi.rio.crs)
+
+            # the share of nodata in a window of the grid can be anything, hence nodata is detected on the whole grid
+            full_aqi_band = aqi_raster.bands[0]
+            if (self.__bounds):
+                full_aqi_band = self.__read_nc_variable(data, 'AQI', all_steps=False, crop=False).values[0]
+            nodata_threshold = self.__get_nodata_threshold(full_aqi_band, na_val=1.0)
+
+            pollutant_rasters = {}
+            for variable in self.__pollutants:
+                if (variable not in data.variables):
+                    self.log.warning(f'Pollutant {variable} not found in {aqi_nc_name}')
+                    continue
+                pollutant = self.__read_nc_variable(data, variable, all_steps=False)
+                pollutant_tif_name = aqi_tif_names[0].replace('aqi_', variable.lower() +'_', 1)
+                pollutant_rasters[variable] = RasterStack([pollutant_tif_name], pollutant.values, pollutant.rio.transform(), pollutant.rio.crs)
+            return (aqi_raster, pollutant_rasters, nodata_threshold)
+
+    def __read_nc_variable(self, data: xarray.Dataset, variable: str, all_steps: bool, crop: bool = True) -> xarray.DataArray:
+        """Returns a variable of an Enfuser dataset as a (time, lat, lon) array within bounds (if set and crop is
+        True), either with all time steps or only with the first one.
+        """
+        values = data[variable]
+        values = values.rio.set_crs('epsg:4326')
+        if (self.__bounds and crop):
+            values = values.rio.clip_box(*self.__bounds)
+        if (values.ndim == 2):
+            values = values.expand_dims('time')
+        return values if all_steps else values[:1]
+
+    def __get_aqi_tif_names(self, aqi: xarray.DataArray, aqi_date_str: str) -> List[str]:
+        """Returns names of the tif files of the time steps of the AQI data (e.g. aqi_2019-11-08T14.tif, 
+        aqi_2019-11-08T15.tif, ...). The first step is named by the date of the nc file and the following
+        steps by their offsets from the first step in the time coordinates (or by hourly steps, if there
+        are no time coordinates).
+        """
+        step_count = aqi.shape[0]
+        if ('time' in aqi.coords and aqi['time'].size == step_count and step_count > 1):
+            times = pd.to_datetime(aqi['time'].values)
+            offsets = times - times[0]
+        else:
+            offsets = pd.to_timedelta(np.arange(step_count), unit='h')
+        first_step = datetime.strptime(aqi_date_str, '%Y-%m-%dT%H')
+        return ['aqi_'+ (first_step + offset).strftime('%Y-%m-%dT%H') +'.tif' for offset in offsets]
+
+    def __get_expected_nodata_count(self, shape: Tuple[int, int]) -> int:
+        """Returns the minimum count of nodata pixels expected in an AQI raster of the given shape. The count is 
+        90 % of the nodata count of the previous raster of the same grid, or nodata_share of the pixels of the grid.
+        """
+        if (self.__learned_nodata and self.__learned_nodata[0] == tuple(shape)):
+            return int(0.9 * self.__learned_nodata[1])
+        return int(self.__nodata_share * shape[0] * shape[1])
+
+    def __get_nodata_threshold(self, aqi_band: np.ndarray, na_val: float = 1.0) -> float:
+        """Returns the largest value of an AQI band (of the whole grid) that is considered nodata. Value 1.0 is 
+        considered as nodata. If not enough nodata is found with that value, a small offset will be applied, as 
+        sometimes the nodata value is slightly higher than 1.0 (assumably due to inaccuracy in netcdf conversion). 
+        If the expected count of nodata is not found with any offset, only values up to 1.0 are considered nodata
+        (rather than clean air values slightly above it). Counts of nodata by all offsets are computed from a 
+        sorted array of the candidate values (only one pass over the band).
+        """
+        thresholds = np.array([na_val + offset for offset in [0.0, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.12]], dtype=aqi_band.dtype)
+        candidates = np.sort(aqi_band[aqi_band <= thresholds[-1]], axis=None)
+        nodata_counts = np.searchsorted(candidates, thresholds, side='right')
+
+        # use the smallest offset with which the expected count of nodata values is found
+        expected_count = self.__get_expected_nodata_count(aqi_band.shape)
+        valid_offsets = np.flatnonzero(nodata_counts >= expected_count)
+        idx = valid_offsets[0] if len(valid_offsets) else 0
+        nodata_count = int(nodata_counts[idx])
+        self.log.info(f'Nodata offset: {round(float(thresholds[idx]) - na_val, 2)} nodata count: {nodata_count}')
+        if (len(valid_offsets)):
+            self.__learned_nodata = (tuple(aqi_band.shape), nodata_count)
+        else:
+            self.log.warning(f'Failed to set nodata values in the aqi raster, nodata count: {nodata_count} (expected {expected_count})')
+
+        return thresholds[idx]
+
+    def __fillna_in_raster(self, raster: RasterStack, nodata_mask: np.ndarray) -> RasterStack:
+        """Fills nodata values in a raster by interpolating values from surrounding cells. All time steps
+        of the raster are filled at once, as the nodata area is the same in all of them. 
         
         Args:
-            aqi_tif_name: The name of a raster file to be processed (in aqi_cache directory).
-            na_val: A value that represents nodata in the raster.
+            raster: The raster (stack of time steps) to be processed (AQI or a pollutant).
+            nodata_mask: A boolean mask of the nodata pixels (True = nodata) (see __get_nodata_threshold).
+        Returns:
+            The raster with filled nodata (as float32).
+        """
+        # fill nodata in the bands using nodata mask (the fill plan is recomputed only if the mask has changed)
+        band_fillna = self.__nodata_filler.fill(raster.bands, nodata_mask)
+        return raster._replace(bands=band_fillna.astype('float32'))
+
+    def __validate_aqi_fillna(self, aqi_raster: RasterStack) -> None:
+        """Validates AQI values after na fill.
         """
-        # open AQI band from AQI raster file
-        aqi_filepath = self.__aqi_dir + aqi_tif_name
-        aqi_raster = rasterio.open(aqi_filepath)
-        aqi_band = aqi_raster.read(1)
-
-        # create a nodata mask (map nodata values to 0)
-        # nodata value may be slightly higher than 1.0, hence try different offsets
-        na_offset = 0
-        for offset in [0.0, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.12]:
-            na_offset = na_val + offset
-            nodata_count = np.sum(aqi_band <= na_offset)
-            self.log.info('Nodata offset: '+ str(offset) + ' nodata count: '+ str(nodata_count))
-            # check if nodata values can be mapped with the current offset
-            if (nodata_count > 180000):
-                break
-        if (nodata_count < 180000):
-            self.log.info('Failed to set nodata values in the aqi tif, nodata count: ', str(nodata_count))
-
-        aqi_nodata_mask = np.where(aqi_band <= na_offset, 0, aqi_band)
-        # fill nodata in aqi_band using nodata mask
-        aqi_band_fillna = fill.fillnodata(aqi_band, mask=aqi_nodata_mask)
-
-        # validate AQI values after na fill
-        invalid_count = np.sum(aqi_band_fillna < 1.0)
+        invalid_count = np.sum(aqi_raster.bands < 1.0)
         if (invalid_count > 0):
             self.log.warning('AQI band has '+ str(invalid_count) +' below 1 aqi values after na fill')
 
-        # write raster with filled nodata
-        aqi_raster_fillna = rasterio.open(
-            aqi_filepath,
-            'w',
-            driver='GTiff',
-            height=aqi_raster.shape[0],
-            width=aqi_raster.shape[1],
-            count=1,
-            dtype='float32',
-            transform=aqi_raster.transform,
-            crs=aqi_raster.crs
-        )
-
-        aqi_raster_fillna.write(aqi_band_fillna, 1)
-        aqi_raster_fillna.close()
+    def __export_aqi_raster(self, aqi_raster: RasterBand) -> None:
+        """Writes the AQI raster to a GeoTiff file in aqi_cache directory. In in-memory mode, the file is written
+        in a background thread (if archive_tif is True), as it is not needed by AqiUpdater.
+        """
+        aqi_filepath = self.__aqi_dir + aqi_raster.name
+        if (not self.__in_memory):
+            write_raster_band(aqi_filepath, aqi_raster)
+            self.log.info('Exported aqi_tif: '+ aqi_raster.name)
+            return
+        if (not self.__archive_tif):
+            return
         
-        return aqi_tif_name
+        def write_archive_tif():
+            try:
+                write_raster_band(aqi_filepath, aqi_raster)
+                self.log.info('Archived aqi_tif: '+ aqi_raster.name)
+            except Exception:
+                self.log.error('Failed to archive aqi_tif: '+ aqi_raster.name)
+
+        # wait for the previous archival to finish
+        if (self.__archive_thread is not None):
+            self.__archive_thread.join()
+        self.__archive_thread = threading.Thread(target=write_archive_tif, daemon=True)
+        self.__archive_thread.start()
 
     def __remove_temp_files(self) -> None:
         """Removes temporary files created during AQI processing to aqi_cache, i.e. files in attribute self.__temp_files_to_rm.
@@ -0,0 +1,330 @@
+import sys
+sys.path.append('..')
+import queue
+import random
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional
+from common.logger import Logger
+from common.raster import RasterBand, RasterStack
+
+
+def get_backoff_delay(failures: int, base: float, max_delay: float, rng: random.Random) -> float:
+    """Returns a jittered exponential backoff delay (seconds) for a retry after the given number of consecutive
+    failures. The delay is between half and all of min(max_delay, base * 2^(failures - 1)).
+    """
+    delay = min(max_delay, base * 2 ** max(failures - 1, 0))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+def get_aqi_hour_start(aqi_tif_name: str) -> Optional[float]:
+    """Returns the start time (epoch seconds) of the hour of an AQI tif file (e.g. aqi_2019-11-08T14.tif).
+    """
+    try:
+        hour = datetime.strptime(aqi_tif_name[len('aqi_'):len('aqi_') + 13], '%Y-%m-%dT%H')
+        return hour.replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+class AqiFetchResult(NamedTuple):
+    """The result of the fetch stage that is handed to the update stage.
+    """
+    aqi_tif: str
+    aqi_raster: RasterBand
+    available_at: Optional[float]
+    aqi_forecast: Optional[RasterStack] = None
+    pollutant_rasters: Dict[str, RasterBand] = {}
+
+
+class StageState:
+    """The state of a stage (fetch, update or forecast) of the scheduler.
+
+    Attributes:
+        name: The name of the stage.
+        failures: The number of consecutive failures of the stage.
+        retry_at: The time (epoch seconds) after which a failed stage can be retried.
+        duration: The duration (seconds) of the latest successful run of the stage.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures: int = 0
+        self.retry_at: float = 0.0
+        self.duration: float = None
+
+    def is_due(self, now: float) -> bool:
+        return now >= self.retry_at
+
+
+class AqiScheduler:
+    """AqiScheduler runs the fetch (AqiFetcher) and update (AqiUpdater) stages when new Enfuser data is expected,
+    instead of polling at a fixed interval.
+
+    After the AQI data of the current hour has been processed, the scheduler sleeps until the data of the next
+    hour is expected, i.e. until the start of the next hour plus the (minimum) delay after which the data of
+    the previous hours were published in S3 (minus wake_margin). While the data is due but not yet published,
+    S3 is polled every poll_interval seconds. Failed stages are retried independently of each other with
+    jittered exponential backoff (e.g. a failed update does not trigger a new fetch). For each published
+    update, the time from the publishing of the Enfuser data in S3 to the publishing of the AQI update is
+    logged and collected to latencies. The forecast updates are exported after the AQI update of the hour has
+    been published, as a separate step: a failed forecast export is logged but neither retried (the forecast 
+    of the next hour replaces it) nor does it cause the already published AQI update to be repeated.
+
+    In pipelined mode, the stages run concurrently: the fetch stage (download, extract, convert and fill) runs 
+    in the thread of run_forever() and hands the filled AQI rasters to the update stage (sample and publish) 
+    in a worker thread via a bounded queue (of queue_size rasters). Hence the next raster can be fetched while
+    the previous one is being sampled and published, and a slow update only blocks the fetching if the queue 
+    is full. The cleanup of the stages (finish_aqi_fetch() and finish_aqi_update()) is run by another worker 
+    thread, off the critical path from a fetched raster to a published update. A stage and its cleanup never 
+    run at the same time.
+
+    Attributes:
+        log: An instance of Logger class for writing log messages.
+        aqi_fetcher: An instance of AqiFetcher (the fetch stage).
+        aqi_updater: An instance of AqiUpdater (the update stage).
+        fetch_state: The state of the fetch stage.
+        update_state: The state of the update stage.
+        forecast_state: The state of the forecast export (run after a successful update stage).
+        latencies: Timings of the latest published updates (AQI tif name, available_at, published_at and latency).
+        __poll_interval: The interval (seconds) of polling S3 while new data is expected.
+        __backoff_base: The delay (seconds) of the first retry of a failed stage.
+        __backoff_max: The maximum delay (seconds) between retries of a failed stage.
+        __wake_margin: How much earlier (seconds) than expected by the previous hours to start polling S3.
+        __publish_delays: Delays (seconds from the start of the hour) of publishing of the latest Enfuser files.
+        __clock: A function that returns the current time (epoch seconds).
+        __sleep: A function for sleeping (seconds).
+        __rng: A random number generator for the jitter of backoff delays.
+        __pipelined: A boolean variable indicating whether the stages run concurrently in worker threads.
+        __fetched_queue: A bounded queue of fetched AQI rasters waiting for the update stage (in pipelined mode).
+        __cleanup_queue: A queue of cleanup functions (with the lock of their stage) to run (in pipelined mode).
+        __fetch_lock: A lock held while the fetch stage or its cleanup is running.
+        __update_lock: A lock held while the update stage or its cleanup is running.
+        __workers: The update and cleanup worker threads (in pipelined mode).
+    """
+
+    def __init__(
+        self,
+        log: Logger,
+        aqi_fetcher,
+        aqi_updater,
+        poll_interval: float = 15,
+        backoff_base: float = 10,
+        backoff_max: float = 300,
+        wake_margin: float = 60,
+        pipelined: bool = False,
+        queue_size: int = 2,
+        clock = time.time,
+        sleep = time.sleep,
+        seed: int = None
+    ):
+        self.log = log
+        self.aqi_fetcher = aqi_fetcher
+        self.aqi_updater = aqi_updater
+        self.fetch_state = StageState('fetch')
+        self.update_state = StageState('update')
+        self.forecast_state = StageState('forecast')
+        self.latencies = deque(maxlen=48)
+        self.__poll_interval = poll_interval
+        self.__backoff_base = backoff_base
+        self.__backoff_max = backoff_max
+        self.__wake_margin = wake_margin
+        self.__publish_delays = deque(maxlen=24)
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__rng = random.Random(seed)
+        self.__pipelined = pipelined
+        self.__fetched_queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.__cleanup_queue = queue.Queue()
+        self.__fetch_lock = threading.Lock()
+        self.__update_lock = threading.Lock()
+        self.__workers: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Starts the update and cleanup worker threads (in pipelined mode).
+        """
+        if (not self.__pipelined or self.__workers):
+            return
+        for name, target in [('aqi-update', self.__run_update_worker), ('aqi-cleanup', self.__run_cleanup_worker)]:
+            worker = threading.Thread(target=target, name=name, daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def wait_until_idle(self) -> None:
+        """Waits until all fetched AQI rasters have been processed by the update stage and all cleanups have run.
+        """
+        self.__fetched_queue.join()
+        self.__cleanup_queue.join()
+
+    def run_forever(self) -> None:
+        self.start()
+        while True:
+            self.__sleep(self.run_once())
+
+    def run_once(self) -> float:
+        """Runs the stages that are due and have work to do. Returns the number of seconds to sleep until
+        the next run. In pipelined mode, only the fetch stage is run here and the fetched AQI raster is queued
+        for the update stage (waiting for space in the queue if the update stage is behind).
+        """
+        fetch_result = None
+        with self.__fetch_lock:
+            if (self.fetch_state.is_due(self.__clock()) and self.aqi_fetcher.new_aqi_available()):
+                if (self.__run_stage(self.fetch_state, self.__fetch)):
+                    fetch_result = self.__get_fetch_result()
+                self.__finish_stage(self.__fetch_lock, self.aqi_fetcher.finish_aqi_fetch)
+
+        if (self.__pipelined):
+            if (fetch_result is not None):
+                self.__fetched_queue.put(fetch_result)
+        elif (self.update_state.is_due(self.__clock()) and self.aqi_updater.new_update_available(self.aqi_fetcher.latest_aqi_tif)):
+            self.__update_fetched(self.__get_fetch_result())
+        return self.get_sleep_duration()
+
+    def get_sleep_duration(self) -> float:
+        """Returns the number of seconds until a failed stage is to be retried, new data is to be polled or
+        the data of the next hour is expected (whichever comes first). In pipelined mode, failed updates are
+        retried by the update worker.
+        """
+        now = self.__clock()
+        states = [self.fetch_state] if self.__pipelined else [self.fetch_state, self.update_state]
+        wake_times = [state.retry_at for state in states if state.failures]
+        current_hour_start = now - now % 3600
+        if (get_aqi_hour_start(self.aqi_fetcher.latest_aqi_tif) == current_hour_start):
+            wake_times.append(current_hour_start + 3600 + self.__get_expected_publish_delay())
+        else:
+            wake_times.append(now + self.__poll_interval)
+        return max(min(wake_times) - now, 1.0)
+
+    def __get_expected_publish_delay(self) -> float:
+        if (not self.__publish_delays):
+            return 0.0
+        return max(min(self.__publish_delays) - self.__wake_margin, 0.0)
+
+    def __run_stage(self, state: StageState, run: Callable[[], None]) -> bool:
+        """Runs a stage and updates its state. Returns True if the stage succeeded.
+        """
+        started_at = self.__clock()
+        try:
+            run()
+            state.failures = 0
+            state.retry_at = 0.0
+            state.duration = self.__clock() - started_at
+            return True
+        except Exception:
+            self.log.error(traceback.format_exc())
+            state.failures += 1
+            delay = get_backoff_delay(state.failures, self.__backoff_base, self.__backoff_max, self.__rng)
+            state.retry_at = self.__clock() + delay
+            self.log.error(f'AQI {state.name} failed {state.failures} time(s), retrying in {round(delay)}s')
+            return False
+
+    def __finish_stage(self, lock: threading.Lock, finish: Callable[[], None]) -> None:
+        """Runs the cleanup of a stage, or queues it for the cleanup worker in pipelined mode (the lock of the 
+        stage is held by the caller in the former case and by the cleanup worker in the latter).
+        """
+        if (self.__pipelined):
+            self.__cleanup_queue.put((lock, finish))
+        else:
+            finish()
+
+    def __fetch(self) -> None:
+        self.aqi_fetcher.fetch_process_current_aqi_data()
+        self.log.info('AQI fetch & processing succeeded')
+        hour_start = get_aqi_hour_start(self.aqi_fetcher.latest_aqi_tif)
+        available_at = self.aqi_fetcher.latest_aqi_available_at
+        if (hour_start is not None and available_at is not None and 0 <= available_at - hour_start < 3600):
+            self.__publish_delays.append(available_at - hour_start)
+
+    def __get_fetch_result(self) -> AqiFetchResult:
+        return AqiFetchResult(
+            self.aqi_fetcher.latest_aqi_tif,
+            self.aqi_fetcher.latest_aqi_raster,
+            self.aqi_fetcher.latest_aqi_available_at,
+            self.aqi_fetcher.latest_aqi_forecast,
+            self.aqi_fetcher.latest_pollutant_rasters
+        )
+
+    def __update_fetched(self, fetch_result: AqiFetchResult) -> bool:
+        """Runs the update stage for a fetched AQI raster, the forecast export if the update succeeded (and 
+        the cleanup of the stage). Returns True if the update succeeded (regardless of the forecast export).
+        """
+        with self.__update_lock:
+            updated = self.__run_stage(self.update_state, lambda: self.__update(fetch_result))
+            if (updated and fetch_result.aqi_forecast is not None):
+                self.__update_forecast(fetch_result)
+            self.__finish_stage(self.__update_lock, self.aqi_updater.finish_aqi_update)
+        return updated
+
+    def __update(self, fetch_result: AqiFetchResult) -> None:
+        started_at = self.__clock()
+        aqi_tif = fetch_result.aqi_tif
+        self.aqi_updater.create_aqi_update_csv(
+            aqi_tif, 
+            aqi_raster=fetch_result.aqi_raster, 
+            pollutant_rasters=fetch_result.pollutant_rasters
+        )
+        self.log.info('AQI update succeeded')
+        available_at = fetch_result.available_at
+        if (available_at is not None):
+            published_at = self.__clock()
+            self.latencies.append({
+                'aqi_tif': aqi_tif,
+                'available_at': available_at,
+                'published_at': published_at,
+                'latency': published_at - available_at
+            })
+            self.log.info(
+                f'Published AQI update of {aqi_tif} {round(published_at - available_at, 1)}s after the data '
+                f'was published in S3 (fetch: {round(self.fetch_state.duration or 0, 1)}s, '
+                f'update: {round(published_at - started_at, 1)}s)'
+            )
+
+    def __update_forecast(self, fetch_result: AqiFetchResult) -> None:
+        """Exports the forecast updates of a fetched AQI raster. A failure is logged but not retried.
+        """
+        started_at = self.__clock()
+        try:
+            self.aqi_updater.create_aqi_forecast_updates(fetch_result.aqi_forecast)
+            self.forecast_state.failures = 0
+            self.forecast_state.duration = self.__clock() - started_at
+            self.log.info('AQI forecast update succeeded')
+        except Exception:
+            self.log.error(traceback.format_exc())
+            self.forecast_state.failures += 1
+            self.log.error(
+                f'AQI forecast of {fetch_result.aqi_tif} failed ({self.forecast_state.failures} time(s) in a row), '
+                'skipping it'
+            )
+
+    def __run_update_worker(self) -> None:
+        """Runs the update stage for the fetched AQI rasters in the queue. A failed update is retried with backoff,
+        until it succeeds or a newer AQI raster is queued (that replaces the failed one).
+        """
+        while True:
+            fetch_result = self.__fetched_queue.get()
+            try:
+                if (not self.aqi_updater.new_update_available(fetch_result.aqi_tif)):
+                    continue
+                while (not self.__update_fetched(fetch_result)):
+                    if (not self.__fetched_queue.empty()):
+                        self.log.warning(f'Skipping failed AQI update of {fetch_result.aqi_tif} (newer data fetched)')
+                        break
+                    self.__sleep(max(self.update_state.retry_at - self.__clock(), 0.0))
+            except Exception:
+                self.log.error(traceback.format_exc())
+            finally:
+                self.__fetched_queue.task_done()
+
+    def __run_cleanup_worker(self) -> None:
+        while True:
+            lock, finish = self.__cleanup_queue.get()
+            try:
+                with lock:
+                    finish()
+            except Exception:
+                self.log.error(traceback.format_exc())
+            finally:
+                self.__cleanup_queue.task_done()
@@ -1,30 +1,176 @@
 from typing import List, Set, Dict, Tuple, Optional
 import sys
 sys.path.append('..')
-from math import floor
 import os
+import gzip
+import hashlib
+import multiprocessing
+import threading
+import traceback
+from datetime import datetime, timezone
 import numpy as np
 import json
-import rasterio
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import LineString
+import shapely
 import common.igraph as ig_utils
 from common.igraph import Edge as E
 from common.logger import Logger
+from common.raster import RasterBand, RasterStack, read_raster_band, share_rasters, attach_rasters
+from common.raster_sampler import PointSampler, LineSampler
+from common.edge_aggregates import EdgeAggregates
+from common.update_publisher import UpdatePublisher, write_atomically
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 class AqiUpdater():
+    """AqiUpdater samples AQI values from AQI rasters to the edges of a graph and exports them as AQI update files.
 
-    def __init__(self, log: Logger, graph, aqi_cache: str='aqi_cache/', aqi_updates: str='aqi_updates/'):
+    Edges are kept as plain NumPy arrays instead of GeoDataFrames in order to keep the memory footprint of the 
+    long-running process small and the updates fast. Edges with the same way id share a sample (i.e. the AQI of
+    the first edge of each way is sampled and fanned out to the other edges by a precomputed index). Edge 
+    geometries are only needed for initializing the sampler and are not kept in memory.
+
+    In delta mode (delta_updates=True), only the edges whose AQI changed by more than delta_threshold since it
+    was last published are exported (to aqi_<date>_delta.csv), except for every keyframe_interval:th update that
+    is a full update (keyframe, aqi_<date>.csv). The published AQI values, the sequence number of the latest 
+    update and the files published since the latest keyframe are kept in memory and persisted in aqi_updates 
+    (aqi_update_state.npz) for restarts. The files to apply (in order) are listed in aqi_update.json (which, as
+    its name is fixed, is listed only in the latest_files of the manifest).
+
+    Besides csv, each update can be exported in binary formats (binary_formats): 'parquet' writes the same
+    rows as the csv file as Parquet and 'npy' writes the current AQI of all edges as a dense little-endian 
+    float32 array indexed by id_ig (nan = no AQI), which can be memory-mapped by consumers (np.load with 
+    mmap_mode). In delta mode, the npy array holds the published AQI values (i.e. the result of applying 
+    the updates). 
+
+    All update files are written atomically (by UpdatePublisher). After all files of an update are
+    written, the update is published as a new version in aqi_updates/manifest.json (with checksums and row counts
+    of the files), which consumers can poll. Files of the latest keep_versions versions are kept.
+
+    AQI classes of the ways are exported for the AQI map to aqi_map.json, either as [id_way, aqi_class] pairs 
+    (aqi_map_encoding='pairs') or in a compact form (aqi_map_encoding='delta'), in which the way ids are 
+    sorted and delta encoded and the AQI classes (0-10) are given as a string of one character per way 
+    ('0'-'9' and 'a' for 10): {"encoding": "delta", "id_way": [first id, delta, ...], "aqi_class": "55a..."}. 
+    Precompressed variants (aqi_map.json.gz and, if brotli is installed, aqi_map.json.br) and a SHA-256 hash 
+    of the content (aqi_map.json.sha256, e.g. for ETag) are written next to it. The AQI map files are written
+    after the other files of an update and, as their names are fixed, they are listed only in the latest_files
+    of the manifest (not in the versions).
+
+    Concentrations of pollutants (e.g. NO2, PM25, PM10, O3) can be exported as additional columns of the updates
+    (named by the lower case variable names, e.g. no2), if their rasters (of the same grid as the AQI raster) are 
+    given with the AQI raster. The pollutants are sampled with the same (cached) pixel index or weights as AQI. 
+    Pollutant columns are not supported in delta mode, as the deltas are based on the changes of AQI only.
+
+    AQI forecasts (all hourly time steps of an Enfuser file) are sampled at once and exported as an update set
+    of full updates (one csv file per hour) to aqi_updates/forecast/, where each forecast is published as a 
+    version in its own manifest.json (e.g. for routing with future departure times). The files are named by
+    both the hour and the first hour of the forecast, as consecutive forecasts overlap in hours.
+
+    With aggregates=True, the AQI of each published update is added to running daily and rolling statistics of
+    the ways (EdgeAggregates), which are checkpointed to aqi_updates/aggregates/state/ (so that past updates are 
+    never re-read). The rolling aggregates (mean, max and count of hours of the latest aggregate_window hours) 
+    are published to aqi_updates/aggregates/ every aggregate_interval hours (e.g. aqi_24h_2020-10-10T08.csv) and 
+    the daily aggregates (mean, std, min, max and count of hours of a UTC day) of a completed day are published 
+    to aqi_updates/aggregates/daily/ (e.g. aqi_day_2020-10-10.csv), where they are kept for reporting.
+
+    Attributes:
+        log: An instance of Logger class for writing log messages.
+        wip_aqi_csv: The name of an AQI update csv file that is currently being produced.
+        latest_aqi_csv: The name of the latest exported AQI update csv file.
+        __edge_ids: An array of the ids (id_ig) of the edges with valid geometry.
+        __edge_sample_index: An array of indexes of the samples of the edges (i.e. rows of __sample_way_ids).
+        __sample_way_ids: An array of the way ids (id_way) of the samples.
+        __sampling_bounds: WGS84 bounds (minx, miny, maxx, maxy) of the edges that are sampled.
+        __aqi_cache: A directory from which the AQI rasters are read (and where sampler caches are written).
+        __aqi_updates: A directory to which the AQI update files are exported.
+        __sampler: A sampler (PointSampler or LineSampler) for joining AQI values to the samples.
+        __binary_formats: Binary formats ('parquet', 'npy') in which the updates are exported besides csv.
+        __publisher: Writes the update files atomically and publishes the versions to manifest.json.
+        __forecast_publisher: Writes and publishes the forecast update sets to aqi_updates/forecast/ (created on
+            the first forecast).
+        __aqi_map_encoding: The encoding of aqi_map.json: 'pairs' or 'delta'.
+        __pollutants: Names of the variables of the pollutants to export as additional columns (e.g. NO2, PM25).
+        __delta_updates: A boolean variable indicating whether delta updates are exported (instead of full updates).
+        __delta_threshold: The minimum change of AQI for an edge to be included in a delta update.
+        __keyframe_interval: The number of updates between full updates (keyframes) in delta mode.
+        __published_aqi: The latest published AQI values of the edges (nan = no AQI).
+        __sequence: The sequence number of the latest published update.
+        __keyframe_sequence: The sequence number of the latest full update (keyframe).
+        __published_files: The update files published since the latest keyframe (the keyframe first).
+        __aggregates: Running daily and rolling statistics of the AQI of the samples (if aggregates are enabled).
+        __aggregate_interval: The number of hours between publishing the rolling aggregates.
+        __aggregate_publisher: Writes and publishes the rolling aggregates to aqi_updates/aggregates/.
+        __daily_aggregate_publisher: Writes and publishes the daily aggregates to aqi_updates/aggregates/daily/.
+        __status: The status of the AQI updater - has the latest AQI update been done or not.
+    """
+
+    def __init__(
+        self, 
+        log: Logger, 
+        graph, 
+        aqi_cache: str='aqi_cache/', 
+        aqi_updates: str='aqi_updates/', 
+        sampling: str='point',
+        binary_formats: List[str] = [],
+        aqi_map_encoding: str = 'pairs',
+        delta_updates: bool = False,
+        delta_threshold: float = 0.05,
+        keyframe_interval: int = 24,
+        keep_versions: int = 2,
+        pollutants: List[str] = [],
+        aggregates: bool = False,
+        aggregate_window: int = 24,
+        aggregate_interval: int = 1
+    ):
         self.log = log
         self.wip_aqi_csv: str = ''
         self.latest_aqi_csv: str = ''
-        self.__edge_gdf = self.__get_sampling_point_gdf_from_graph(graph)
-        self.__sampling_gdf = self.__edge_gdf.drop_duplicates(E.id_way.name)
         self.__aqi_cache = aqi_cache
         self.__aqi_updates = aqi_updates
+        self.__edge_ids: np.ndarray = None
+        self.__edge_sample_index: np.ndarray = None
+        self.__sample_way_ids: np.ndarray = None
+        self.__sampling_bounds: Tuple[float, float, float, float] = None
+        self.__sampler = self.__init_edge_arrays_and_sampler(graph, sampling)
+        self.__binary_formats = self.__get_binary_formats(binary_formats)
+        self.__publisher = UpdatePublisher(log, aqi_updates, keep_versions=keep_versions)
+        self.__forecast_publisher: UpdatePublisher = None
+        if (aqi_map_encoding not in ('pairs', 'delta')):
+            raise ValueError(f'Unknown encoding of AQI map: {aqi_map_encoding}')
+        self.__aqi_map_encoding = aqi_map_encoding
+        if (pollutants and delta_updates):
+            raise ValueError('Pollutant columns are not supported with delta updates')
+        self.__pollutants = list(pollutants)
+        self.__delta_updates = delta_updates
+        self.__delta_threshold = delta_threshold
+        self.__keyframe_interval = keyframe_interval
+        self.__published_aqi: np.ndarray = None
+        self.__sequence: int = 0
+        self.__keyframe_sequence: int = 0
+        self.__published_files: List[str] = []
         self.__status = ''
+        if (self.__delta_updates):
+            self.__load_delta_state()
+        self.__aggregates: EdgeAggregates = None
+        self.__aggregate_interval = max(aggregate_interval, 1)
+        if (aggregates):
+            daily_aggregates_dir = aqi_updates + 'aggregates/daily/'
+            os.makedirs(daily_aggregates_dir, exist_ok=True)
+            self.__aggregates = EdgeAggregates(
+                log, aqi_updates + 'aggregates/state/', self.__sample_way_ids, window=aggregate_window
+            )
+            self.__aggregate_publisher = UpdatePublisher(log, aqi_updates + 'aggregates/', keep_versions=keep_versions)
+            self.__daily_aggregate_publisher = UpdatePublisher(log, daily_aggregates_dir, keep_versions=keep_versions)
+
+    def get_sampling_bounds(self, buffer: float = 0.02) -> Tuple[float, float, float, float]:
+        """Returns the WGS84 bounds (minx, miny, maxx, maxy) of the edges used in sampling, buffered by the given
+        distance in degrees. AQI data is not needed outside the bounds.
+        """
+        minx, miny, maxx, maxy = self.__sampling_bounds
+        return (minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
 
     def new_update_available(self, latest_aqi_tif_name: str) -> bool:
         """Returns False if the expected latest aqi file is either already processed or being processed at the moment, 
@@ -32,7 +178,8 @@ class AqiUpdater():
         """
         b_available = True
         status = ''
-        if (self.latest_aqi_csv == self.__get_aqi_csv_name(latest_aqi_tif_name)):
+        aqi_csv_names = [self.__get_aqi_csv_name(latest_aqi_tif_name), self.__get_aqi_csv_name(latest_aqi_tif_name, delta=True)]
+        if (self.latest_aqi_csv in aqi_csv_names):
             status = 'Latest AQI update already done'
             b_available = False
         else:
@@ -45,129 +192,411 @@ class AqiUpdater():
         
         return b_available
 
-    def create_aqi_update_csv(self, aqi_tif_name: str) -> None:
+    def create_aqi_update_csv(
+        self, 
+        aqi_tif_name: str, 
+        aqi_raster: RasterBand = None, 
+        pollutant_rasters: Dict[str, RasterBand] = {},
+        publish: bool = True
+    ) -> None:
+        """Samples AQI values to edges and exports them as a csv file. The AQI raster is read from the
+        given tif file in aqi_cache directory, unless it is given as in-memory raster (aqi_raster).
+        In delta mode, only the changed AQI values are exported, unless a keyframe is due. Values of the
+        pollutants are sampled from the given in-memory rasters (by variable name). If publish is False 
+        (e.g. when backfilling the updates of past hours), only the files of a full update are written, 
+        i.e. aqi_map.json, the manifest and the state of delta updates are left untouched.
+        """
         self.wip_aqi_csv = self.__get_aqi_csv_name(aqi_tif_name)
-        aqi_tif_file = self.__aqi_cache + aqi_tif_name
-        edge_aqi_df = self.__sample_aqi_to_point_gdf(aqi_tif_file)
-        # export sampled AQI values to json for AQI map
-        self.__export_aqi_map_json(edge_aqi_df)
+        if (aqi_raster is None):
+            aqi_raster = read_raster_band(self.__aqi_cache + aqi_tif_name)
+        sample_aqi = self.__sample_aqi(aqi_raster)
         # export sampled AQI values to csv
-        final_edge_aqi_samples = self.__combine_final_sample_df(edge_aqi_df)
-        final_edge_aqi_samples.to_csv(self.__aqi_updates + self.wip_aqi_csv, index=False)
-        self.log.info(f'Exported edge_aqi_csv: {self.wip_aqi_csv}')
+        edge_aqi = self.__get_edge_aqi(sample_aqi)
+        if (publish and self.__delta_updates and not self.__is_keyframe_due()):
+            self.wip_aqi_csv = self.__get_aqi_csv_name(aqi_tif_name, delta=True)
+            changed = self.__get_changed_edges(edge_aqi)
+            final_edge_aqi_samples = pd.DataFrame({ E.id_ig.name: self.__edge_ids[changed], 'aqi': edge_aqi[changed] })
+            current_edge_aqi = np.where(changed, edge_aqi, self.__published_aqi)
+        else:
+            changed = None
+            final_edge_aqi_samples = self.__get_final_sample_df(edge_aqi, self.__sample_pollutants(pollutant_rasters))
+            current_edge_aqi = edge_aqi
+        self.__publisher.write_file(
+            self.wip_aqi_csv, 
+            lambda f: final_edge_aqi_samples.to_csv(f, index=False), 
+            text=True, 
+            rows=len(final_edge_aqi_samples),
+            include_in_version=publish
+        )
+        self.log.info(f'Exported edge_aqi_csv: {self.wip_aqi_csv} ({len(final_edge_aqi_samples)} rows)')
+        self.__export_binary_updates(final_edge_aqi_samples, current_edge_aqi, include_in_version=publish)
+        if (not publish):
+            self.wip_aqi_csv = ''
+            return
+        # export sampled AQI values to json for AQI map (after the update files, as it replaces the previous map)
+        self.__export_aqi_map_json(sample_aqi)
+        update_info = self.__publish_delta_state(edge_aqi, changed) if self.__delta_updates else {}
+        self.__publisher.publish(self.wip_aqi_csv[:-len('.csv')], **update_info)
         self.latest_aqi_csv = self.wip_aqi_csv
+        if (self.__aggregates is not None):
+            self.__update_aggregates(aqi_tif_name, sample_aqi)
+
+    def create_aqi_forecast_updates(self, aqi_forecast: RasterStack) -> None:
+        """Samples AQI values of all time steps of a forecast to edges at once and exports the AQI of each step 
+        as a csv file named by the hour of the step and the first step (e.g. aqi_2019-11-08T15_f2019-11-08T14.csv)
+        to aqi_updates/forecast/. The files are published together as a version named by the first step (e.g. 
+        forecast_2019-11-08T14), so that the files of the kept versions are never overwritten by later forecasts.
+        """
+        if (self.__forecast_publisher is None):
+            forecast_dir = self.__aqi_updates + 'forecast/'
+            os.makedirs(forecast_dir, exist_ok=True)
+            self.__forecast_publisher = UpdatePublisher(self.log, forecast_dir, keep_versions=self.__publisher.keep_versions)
+        # AQI of the edges as an (edge, step) array
+        edge_aqi = self.__get_edge_aqi(self.__sample_aqi(aqi_forecast))
+        first_step = aqi_forecast.names[0][len('aqi_'):-len('.tif')]
+        for step, aqi_tif_name in enumerate(aqi_forecast.names):
+            final_edge_aqi_samples = self.__get_final_sample_df(edge_aqi[:, step])
+            self.__forecast_publisher.write_file(
+                self.__get_aqi_csv_name(aqi_tif_name).replace('.csv', f'_f{first_step}.csv'), 
+                lambda f: final_edge_aqi_samples.to_csv(f, index=False), 
+                text=True, 
+                rows=len(final_edge_aqi_samples)
+            )
+        forecast_name = 'forecast_'+ first_step
+        self.__forecast_publisher.publish(forecast_name, steps=len(aqi_forecast.names))
+        self.log.info(f'Exported AQI forecast: {forecast_name} ({len(aqi_forecast.names)} hours)')
+
+    def full_update_exists(self, aqi_tif_name: str) -> bool:
+        """Returns True if all files of a full AQI update (csv and the binary formats) of the given AQI tif file
+        exist in aqi_updates (e.g. written by an earlier backfill run). 
+        """
+        update_name = self.__get_aqi_csv_name(aqi_tif_name)[:-len('.csv')]
+        return all(
+            os.path.exists(self.__aqi_updates + update_name +'.'+ file_format) 
+            for file_format in ['csv'] + self.__binary_formats
+        )
 
     def finish_aqi_update(self) -> None:
         self.wip_aqi_csv = ''
         self.__remove_old_update_files()
+        if (self.__forecast_publisher is not None):
+            self.__forecast_publisher.remove_old_files()
+        if (self.__aggregates is not None):
+            self.__aggregate_publisher.remove_old_files()
+
+    def __get_aqi_csv_name(self, aqi_tif_name: str, delta: bool = False) -> str:
+        return aqi_tif_name.replace('.tif', '_delta.csv' if delta else '.csv')
+
+    def __get_binary_formats(self, binary_formats: List[str]) -> List[str]:
+        for binary_format in binary_formats:
+            if (binary_format not in ('parquet', 'npy')):
+                raise ValueError(f'Unknown binary format of AQI updates: {binary_format}')
+        return list(binary_formats)
+
+    def __export_binary_updates(
+        self, 
+        final_edge_aqi_samples: pd.DataFrame, 
+        current_edge_aqi: np.ndarray, 
+        include_in_version: bool = True
+    ) -> None:
+        """Exports the update in the selected binary formats (with the same name as the csv file). 
+        """
+        update_name = self.wip_aqi_csv[:-len('.csv')]
+        if ('parquet' in self.__binary_formats):
+            self.__publisher.write_file(
+                update_name + '.parquet', 
+                lambda f: final_edge_aqi_samples.to_parquet(f, index=False), 
+                rows=len(final_edge_aqi_samples),
+                include_in_version=include_in_version
+            )
+        if ('npy' in self.__binary_formats):
+            dense_aqi = self.__get_dense_aqi_array(current_edge_aqi)
+            self.__publisher.write_file(
+                update_name + '.npy', 
+                lambda f: np.save(f, dense_aqi), 
+                rows=len(dense_aqi), 
+                include_in_version=include_in_version
+            )
+        if (self.__binary_formats):
+            self.log.info(f'Exported AQI update as: {", ".join(self.__binary_formats)}')
 
-    def __get_aqi_csv_name(self, aqi_tif_name: str) -> str:
-        return aqi_tif_name.replace('.tif', '.csv')
+    def __get_dense_aqi_array(self, edge_aqi: np.ndarray) -> np.ndarray:
+        """Returns the AQI of the edges as a little-endian float32 array indexed by id_ig (nan = no AQI).
+        """
+        dense_aqi = np.full(int(self.__edge_ids.max()) + 1 if len(self.__edge_ids) else 0, np.nan, dtype='<f4')
+        dense_aqi[self.__edge_ids] = edge_aqi
+        return dense_aqi
 
-    def __get_sampling_point_gdf_from_graph(self, graph) -> gpd.GeoDataFrame:
-        """Filters out null geometries and adds point geometries.
+    def __init_edge_arrays_and_sampler(self, graph, sampling: str):
+        """Reads the ids and geometries of the edges from the graph, filters out edges with null geometry and
+        sets the arrays of edges and samples (one per way id). Returns a sampler initialized with the geometries
+        of the samples (the geometries are not kept after this). Instead of a graph, the edge attributes 
+        id_ig, id_way and geom_wgs can be given as columns by Edge (e.g. by ig_utils.read_graphml_columns_cached).
         """
-        edge_gdf = ig_utils.get_edge_gdf(graph, attrs=[E.id_ig, E.id_way], geom_attr=E.geom_wgs)
+        if (isinstance(graph, dict)):
+            edge_columns = graph
+        else:
+            edge_columns = { attr: graph.es[attr.value] for attr in [E.id_ig, E.id_way, E.geom_wgs] }
+        geoms = np.array(edge_columns[E.geom_wgs], dtype=object)
         # filter out edges with null geometry
-        edge_gdf = edge_gdf[edge_gdf[E.geom_wgs.name].apply(lambda x: isinstance(x, LineString))]
-        edge_gdf['point_geom'] = [geom.interpolate(0.5, normalized=True) for geom in edge_gdf[E.geom_wgs.name]]
-        return edge_gdf
+        valid = shapely.get_type_id(geoms) == shapely.GeometryType.LINESTRING
+        geoms = geoms[valid]
+        self.__edge_ids = np.asarray(edge_columns[E.id_ig])[valid]
+        way_ids = np.asarray(edge_columns[E.id_way])[valid]
+        # edges of the same way (with similar geometry) are sampled only once
+        self.__sample_way_ids, sample_edges, self.__edge_sample_index = np.unique(
+            way_ids, return_index=True, return_inverse=True
+        )
+        # keep samples in the order of the edges
+        order = np.argsort(sample_edges, kind='stable')
+        self.__sample_way_ids = self.__sample_way_ids[order]
+        self.__edge_sample_index = np.argsort(order)[self.__edge_sample_index.reshape(-1)]
+        sample_geoms = geoms[sample_edges[order]]
+        self.__sampling_bounds = tuple(shapely.total_bounds(sample_geoms))
+        return self.__get_sampler(sampling, sample_geoms)
+
+    def __get_sampler(self, sampling: str, geoms: np.ndarray):
+        """Returns a sampler for joining AQI values to edges. With sampling 'point', the AQI of the pixel at the
+        center point of each edge is used. With sampling 'line', the length-weighted mean AQI of all pixels
+        that the edge crosses is used. Weight matrices of the line sampler are cached to aqi_cache directory.
+        """
+        if (sampling == 'point'):
+            points = shapely.line_interpolate_point(geoms, 0.5, normalized=True)
+            return PointSampler(shapely.get_x(points), shapely.get_y(points))
+        if (sampling == 'line'):
+            return LineSampler(geoms, cache_dir=self.__aqi_cache)
+        raise ValueError(f'Unknown AQI sampling method: {sampling}')
 
-    def __sample_aqi_to_point_gdf(self, aqi_tif_file: str) -> gpd.GeoDataFrame:
-        """Joins AQI values from an AQI raster file to edges (edge_gdf) of a graph by spatial sampling. 
-        Column 'aqi' will be added to the G.edge_gdf. Center points of the edges are used in the spatial join. 
-        Exports a csv file of ege keys and corresponding AQI values to use for updating AQI values to a graph.
+    def __sample_aqi(self, aqi_raster) -> np.ndarray:
+        """Joins AQI values from an AQI raster to the samples (ways) of the graph by spatial sampling. 
+        Depending on the sampling method, either center points of the edges or the whole edge geometries 
+        are used in the spatial join. The sampler caches the mapping of the edges to the pixels of the raster 
+        grid, as the grid is normally the same from hour to hour.
 
         Args:
-            G: A GraphHandler object that has edge_gdf and graph as properties.
-            aqi_tif_name: The filename of an AQI raster (GeoTiff) file (in aqi_cache directory).
-        Todo:
-            Implement more precise join for longer edges. 
+            aqi_raster: An AQI raster (RasterBand) or a stack of AQI rasters of the same grid (RasterStack).
         Returns:
-            The name of the exported csv file (e.g. aqi_2019-11-08T14.csv).
+            An array of sampled AQI values (nan for invalid AQI) in the order of __sample_way_ids 
+            (as a (sample, band) array for a stack of rasters).
         """
-        gdf = self.__sampling_gdf.copy()
-        aqi_raster = rasterio.open(aqi_tif_file)
-        # get coordinates of edge centers as list of tuples
-        coords = [ (x, y) for x, y in zip([point.x for point in gdf['point_geom']], [point.y for point in gdf['point_geom']]) ]
-        coords = self.__round_coordinates(coords)
-        # extract aqi values at coordinates from raster using sample method from rasterio
-        gdf['aqi'] = [round(x.item(), 2) for x in aqi_raster.sample(coords)]
+        band = aqi_raster.bands if isinstance(aqi_raster, RasterStack) else aqi_raster.band
+        # extract aqi values to samples from the band with precomputed pixel index or weights
+        aqi = np.round(self.__sampler.sample(band, aqi_raster.transform), 2)
 
         # validate sampled aqi values
-        if (self.__validate_df_aqi(gdf, debug_to_file=False) == False):
+        if (self.__validate_aqi(aqi) == False):
             self.log.error('AQI sampling failed')
 
-        gdf['aqi'] = [self.__get_valid_aqi_or_nan(aqi) for aqi in gdf['aqi']]
-        return gdf
+        return self.__get_valid_aqi_or_nan(aqi)
 
-    def __get_valid_aqi_or_nan(self, aqi: float):
-        if (np.isfinite(aqi)):
-            if (aqi < 0.95):
-                return np.nan
-            elif (aqi < 1):
-                return 1.0
-            else:
-                return aqi
-        else:
-            return np.nan
+    def __sample_pollutants(self, pollutant_rasters: Dict[str, RasterBand]) -> Dict[str, np.ndarray]:
+        """Joins values of the pollutants to the edges with the same sampler as AQI. Returns the values (nan for
+        invalid values) by column name. Values of pollutants without a raster are nan.
+        """
+        edge_pollutants = {}
+        for variable in self.__pollutants:
+            if (variable not in pollutant_rasters):
+                self.log.warning(f'No raster of pollutant {variable} for AQI update')
+                edge_pollutants[variable.lower()] = np.full(len(self.__edge_ids), np.nan)
+                continue
+            pollutant_raster = pollutant_rasters[variable]
+            values = np.round(self.__sampler.sample(pollutant_raster.band, pollutant_raster.transform), 2)
+            with np.errstate(invalid='ignore'):
+                values = np.where(np.isfinite(values) & (values >= 0), values, np.nan)
+            edge_pollutants[variable.lower()] = values[self.__edge_sample_index]
+        return edge_pollutants
+
+    def __get_valid_aqi_or_nan(self, aqi: np.ndarray) -> np.ndarray:
+        """Returns the AQI values with values slightly below 1 set to 1.0 and invalid values set to nan.
+        """
+        finite_aqi = np.where(np.isfinite(aqi), aqi, np.nan)
+        with np.errstate(invalid='ignore'):
+            return np.where(finite_aqi >= 1, finite_aqi, np.where(finite_aqi >= 0.95, 1.0, np.nan))
 
-    def __get_aqi_class(self, aqi: float):
-        """Returns AQI class identifier, that is in the range from 2 to 10. Returns 0 if the given AQI is invalid.
+    def __get_aqi_class(self, aqi: np.ndarray) -> np.ndarray:
+        """Returns AQI class identifiers, that are in the range from 2 to 10. AQI class is 0 for invalid AQI.
         AQI classes represent (9x) 0.5 intervals in the original AQI scale from 1.0 to 5.0.
         """
-        return floor(aqi * 2) if np.isfinite(aqi) else 0
+        return np.where(np.isfinite(aqi), np.floor(np.nan_to_num(aqi) * 2), 0).astype(np.int64)
 
-    def __export_aqi_map_json(self, sample_gdf: gpd.GeoDataFrame):
-        gdf = sample_gdf[[E.id_way.name, 'aqi']].copy()
-        gdf = gdf[gdf['aqi'].notnull()]
-        gdf['aqi_class'] = [self.__get_aqi_class(aqi) for aqi in gdf['aqi']]
-        id_aqi_pairs = list(zip(gdf[E.id_way.name].tolist(), gdf['aqi_class'].tolist()))
-        with open(self.__aqi_updates + 'aqi_map.json', 'w') as json_file:
-            json.dump({ 'data': id_aqi_pairs }, json_file, separators=(',', ':'))
+    def __export_aqi_map_json(self, sample_aqi: np.ndarray):
+        """Exports AQI classes of the ways with valid AQI to aqi_map.json, together with its precompressed 
+        variants and content hash. The files have fixed names, hence they are listed only in the latest files
+        of the manifest.
+        """
+        has_aqi = ~np.isnan(sample_aqi)
+        way_ids = self.__sample_way_ids[has_aqi]
+        aqi_classes = self.__get_aqi_class(sample_aqi[has_aqi])
+        if (self.__aqi_map_encoding == 'delta'):
+            order = np.argsort(way_ids, kind='stable')
+            aqi_map = {
+                'encoding': 'delta',
+                'id_way': np.diff(way_ids[order], prepend=0).tolist(),
+                'aqi_class': ''.join(np.array(list('0123456789a'))[aqi_classes[order]].tolist())
+            }
+        else:
+            aqi_map = { 'data': list(zip(way_ids.tolist(), aqi_classes.tolist())) }
+        aqi_map_json = json.dumps(aqi_map, separators=(',', ':')).encode('utf-8')
+
+        self.__publisher.write_file('aqi_map.json', lambda f: f.write(aqi_map_json), latest_only=True)
+        self.__publisher.write_file('aqi_map.json.gz', lambda f: f.write(gzip.compress(aqi_map_json, compresslevel=9, mtime=0)), latest_only=True)
+        if (brotli is not None):
+            self.__publisher.write_file('aqi_map.json.br', lambda f: f.write(brotli.compress(aqi_map_json)), latest_only=True)
+        self.__publisher.write_file('aqi_map.json.sha256', lambda f: f.write(hashlib.sha256(aqi_map_json).hexdigest().encode('ascii')), latest_only=True)
         self.log.info(f'Exported current AQI for map: {self.__aqi_updates}aqi_map.json')
 
-    def __combine_final_sample_df(self, sampling_gdf) -> gpd.GeoDataFrame:
-        edge_gdf_copy = self.__edge_gdf[[E.id_ig.name, E.id_way.name]].copy()
-        final_sample_df = pd.merge(edge_gdf_copy, sampling_gdf[[E.id_way.name, 'aqi']], on=E.id_way.name, how='left')
-        sample_count_all = len(final_sample_df)
-        final_sample_df = final_sample_df[final_sample_df['aqi'].notnull()]
-        self.log.info(f'Found valid AQI samples for {round(100 * len(final_sample_df)/sample_count_all, 2)} % edges')
-        return final_sample_df[[E.id_ig.name, 'aqi']]
-
-    def __round_coordinates(self, coords_list: List[tuple], digits=6) -> List[tuple]:
-        return [(round(coords[0], digits), round(coords[1], digits)) for coords in coords_list]
-
-    def __validate_df_aqi(self, edge_gdf: 'pandas DataFrame', debug_to_file: bool=False) -> bool:
-        """Validates a dataframe containing AQI values. Checks the validity of the AQI values with several tests.
-        Returns True if all AQI values are valid, else returns False. Missing AQI values (AQI=0.0) are ignored (considered valid).
-        """
-        def validate_aqi_exp(aqi):
-            if (not isinstance(aqi, float)):
-                return 4
-            elif (aqi < 0):
-                return 3
-            elif (aqi == 0.0): # aqi is just missing
-                return 1
-            elif (aqi < 1):
-                return 2
-            else:
-                return 0
+    def __get_edge_aqi(self, sample_aqi: np.ndarray) -> np.ndarray:
+        """Fans out the sampled AQI values to all edges (by way ids).
+        """
+        edge_aqi = sample_aqi[self.__edge_sample_index]
+        self.log.info(f'Found valid AQI samples for {round(100 * np.sum(~np.isnan(edge_aqi)) / edge_aqi.size, 2)} % edges')
+        return edge_aqi
 
-        edge_gdf_copy = edge_gdf[['aqi']].copy()
-        edge_gdf_copy['aqi_validity'] = [validate_aqi_exp(aqi) for aqi in edge_gdf_copy['aqi']]
-        row_count = len(edge_gdf_copy.index)
-        aqi_ok_count = len(edge_gdf_copy[edge_gdf_copy['aqi_validity'] <= 1].index)
-        
-        if (debug_to_file == True):
-            edge_gdf_copy['geometry'] = list(edge_gdf_copy['center_wgs'])
-            edge_gdf_copy.crs = {'init' :'epsg:4326'}
-            edge_gdf_copy.drop(columns=['uvkey', 'center_wgs']).to_file('debug/debug.gpkg', layer='edge_centers_wgs', driver="GPKG")
+    def __get_final_sample_df(self, edge_aqi: np.ndarray, edge_pollutants: Dict[str, np.ndarray] = {}) -> pd.DataFrame:
+        """Returns a DataFrame of the edges with valid AQI (and the values of the pollutants of the edges).
+        """
+        has_aqi = ~np.isnan(edge_aqi)
+        columns = { E.id_ig.name: self.__edge_ids[has_aqi], 'aqi': edge_aqi[has_aqi] }
+        for column, values in edge_pollutants.items():
+            columns[column] = values[has_aqi]
+        return pd.DataFrame(columns)
+
+    def __is_keyframe_due(self) -> bool:
+        return (
+            self.__published_aqi is None 
+            or not self.__published_files 
+            or self.__sequence - self.__keyframe_sequence >= self.__keyframe_interval
+        )
+
+    def __get_changed_edges(self, edge_aqi: np.ndarray) -> np.ndarray:
+        """Returns a boolean mask of the edges whose AQI changed by more than delta_threshold from the published 
+        AQI, or that got or lost AQI. Edges that lost AQI are exported with empty AQI (nan) in delta updates.
+        """
+        published_aqi = self.__published_aqi
+        with np.errstate(invalid='ignore'):
+            changed = np.abs(edge_aqi - published_aqi) > self.__delta_threshold
+        return changed | (np.isnan(edge_aqi) != np.isnan(published_aqi))
+
+    def __publish_delta_state(self, edge_aqi: np.ndarray, changed: np.ndarray = None) -> dict:
+        """Updates the published AQI values (all values for a keyframe, else only the changed ones) and the sequence 
+        number after an exported update, persists them and writes the list of files to apply to aqi_update.json.
+        Returns the sequence numbers of the update and the latest keyframe.
+        """
+        self.__sequence += 1
+        if (changed is None):
+            self.__published_aqi = edge_aqi.copy()
+            self.__keyframe_sequence = self.__sequence
+            self.__published_files = [self.wip_aqi_csv]
+        else:
+            self.__published_aqi[changed] = edge_aqi[changed]
+            self.__published_files.append(self.wip_aqi_csv)
+        self.__save_delta_state()
+        update_info = {
+            'sequence': self.__sequence,
+            'keyframe_sequence': self.__keyframe_sequence,
+            'delta_threshold': self.__delta_threshold,
+            'files': self.__published_files
+        }
+        # the file has a fixed name, hence it is listed only in the latest files of the manifest
+        self.__publisher.write_file('aqi_update.json', lambda f: json.dump(update_info, f, indent=2), text=True, latest_only=True)
+        self.log.info(f'Published AQI update {self.__sequence} (keyframe {self.__keyframe_sequence})')
+        return { 'sequence': self.__sequence, 'keyframe_sequence': self.__keyframe_sequence }
+
+    def __get_delta_state_filepath(self) -> str:
+        return self.__aqi_updates + 'aqi_update_state.npz'
+
+    def __save_delta_state(self) -> None:
+        def write_delta_state(tmp_filepath: str):
+            # written via a file object, as np.savez would add .npz to the name of the temporary file
+            with open(tmp_filepath, 'wb') as f:
+                np.savez(
+                    f,
+                    edge_ids=self.__edge_ids,
+                    published_aqi=self.__published_aqi,
+                    sequence=self.__sequence,
+                    keyframe_sequence=self.__keyframe_sequence,
+                    published_files=np.array(self.__published_files, dtype=str)
+                )
+        write_atomically(self.__get_delta_state_filepath(), write_delta_state)
+
+    def __load_delta_state(self) -> None:
+        """Loads the persisted state of delta updates. The published AQI values are discarded (i.e. the next update 
+        will be a keyframe) if the edges of the graph have changed or if some of the published files are missing.
+        """
+        filepath = self.__get_delta_state_filepath()
+        if (not os.path.exists(filepath)):
+            return
+        try:
+            with np.load(filepath) as state:
+                self.__sequence = int(state['sequence'])
+                self.__keyframe_sequence = int(state['keyframe_sequence'])
+                published_files = state['published_files'].tolist()
+                if (not np.array_equal(state['edge_ids'], self.__edge_ids)):
+                    self.log.info('Edges have changed since the latest AQI update, next update will be a keyframe')
+                    return
+                if (not all(os.path.exists(self.__aqi_updates + file_n) for file_n in published_files)):
+                    self.log.info('Published AQI update files are missing, next update will be a keyframe')
+                    return
+                self.__published_aqi = state['published_aqi']
+                self.__published_files = published_files
+            self.log.info(f'Loaded state of delta AQI updates (sequence {self.__sequence})')
+        except Exception:
+            self.log.warning(f'Could not load state of delta AQI updates from {filepath}')
+
+    def __update_aggregates(self, aqi_tif_name: str, sample_aqi: np.ndarray) -> None:
+        """Adds the sampled AQI of an update to the aggregates. The daily aggregates of the previous day are 
+        published before the first hour of a new day is added, and the rolling aggregates after every 
+        aggregate_interval:th hour. A failure of the aggregation does not fail the update.
+        """
+        try:
+            aqi_hour = datetime.strptime(aqi_tif_name[len('aqi_'):len('aqi_') + 13], '%Y-%m-%dT%H')
+            hour = int(aqi_hour.replace(tzinfo=timezone.utc).timestamp() // 3600)
+            latest_hour = self.__aggregates.latest_hour
+            if (latest_hour is not None and hour > latest_hour and hour // 24 != self.__aggregates.day):
+                self.__export_aggregates(
+                    self.__daily_aggregate_publisher,
+                    'aqi_day_'+ datetime.utcfromtimestamp(self.__aggregates.day * 86400).strftime('%Y-%m-%d'),
+                    self.__aggregates.get_daily_stats()
+                )
+            if (self.__aggregates.add(hour, sample_aqi) and hour % self.__aggregate_interval == 0):
+                self.__export_aggregates(
+                    self.__aggregate_publisher,
+                    f'aqi_{self.__aggregates.window}h_'+ aqi_tif_name[len('aqi_'):-len('.tif')],
+                    self.__aggregates.get_rolling_stats()
+                )
+        except Exception:
+            self.log.error(f'Failed to aggregate AQI of {aqi_tif_name}:\n{traceback.format_exc()}')
+
+    def __export_aggregates(self, publisher: UpdatePublisher, name: str, stats: Dict[str, np.ndarray]) -> None:
+        """Fans out the aggregates of the samples to the edges and exports the edges with any AQI in the aggregated
+        hours to a csv file (e.g. with columns id_ig, aqi_mean, aqi_max and hours) that is published as a version.
+        """
+        has_aqi = stats['count'][self.__edge_sample_index] > 0
+        edge_sample_index = self.__edge_sample_index[has_aqi]
+        columns = { E.id_ig.name: self.__edge_ids[has_aqi] }
+        for stat, values in stats.items():
+            if (stat != 'count'):
+                columns['aqi_'+ stat] = np.round(values[edge_sample_index], 2)
+        columns['hours'] = stats['count'][edge_sample_index]
+        aggregates_df = pd.DataFrame(columns)
+        publisher.write_file(
+            name + '.csv', lambda f: aggregates_df.to_csv(f, index=False), text=True, rows=len(aggregates_df)
+        )
+        publisher.publish(name)
+        self.log.info(f'Exported AQI aggregates: {name}.csv ({len(aggregates_df)} rows)')
+
+    def __validate_aqi(self, aqi: np.ndarray) -> bool:
+        """Validates an array of AQI values. Returns True if all AQI values are valid, else returns False. 
+        Missing AQI values (AQI=0.0 or nan) are ignored (considered valid).
+        """
+        row_count = aqi.size
+        with np.errstate(invalid='ignore'):
+            error_count = int(np.sum((aqi < 0) | ((aqi > 0) & (aqi < 1))))
+        aqi_ok_count = row_count - error_count
         
-        if (row_count == aqi_ok_count):
+        if (error_count == 0):
             return True
         else:
-            error_count = row_count - aqi_ok_count
             valid_ratio = round(100 * aqi_ok_count/row_count, 2)
             self.log.warning('Row count: '+ str(row_count) +' of which has valid aqi: '+
                 str(aqi_ok_count)+ ' = '+ str(valid_ratio) + ' %')
@@ -175,18 +604,177 @@ class AqiUpdater():
             return False
 
     def __remove_old_update_files(self) -> None:
-        """Removes all edge_aqi_csv files older than the latest from from __aqi_updates folder.
+        """Removes edge_aqi_csv files (and the corresponding binary files) of versions older than the latest 
+        keep_versions from __aqi_updates folder. In delta mode, the files published since the latest keyframe 
+        are kept.
+        """
+        keep_files = [self.latest_aqi_csv] + (self.__published_files if self.__delta_updates else [])
+        self.__publisher.remove_old_files(keep_files=keep_files)
+
+
+def create_graph_aqi_updater(log: Logger, graph_file: str, **updater_kwargs) -> AqiUpdater:
+    """Reads the edges of a graph from a GraphML file (via its binary snapshot) and returns an AqiUpdater for them.
+    """
+    _, edge_columns = ig_utils.read_graphml_columns_cached(graph_file, e_attrs=[E.id_ig, E.id_way, E.geom_wgs], log=log)
+    return AqiUpdater(log, edge_columns, **updater_kwargs)
+
+
+def run_aqi_updater_worker(connection, log: Logger, graph_file: str, updater_kwargs: dict) -> None:
+    """Runs an AqiUpdater of a graph in a worker process of AqiUpdaterPool. Reads the edges of the graph, sends
+    back the bounds of the edges and then calls the methods of the updater requested via the connection (with 
+    the rasters in shared memory) and sends back their results, until None is received.
+    """
+    try:
+        aqi_updater = create_graph_aqi_updater(log, graph_file, **updater_kwargs)
+        connection.send(('ok', aqi_updater.get_sampling_bounds(buffer=0)))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+        return
+
+    while True:
+        request = connection.recv()
+        if (request is None):
+            break
+        method, kwargs = request
+        shared_memories = []
+        try:
+            response = ('ok', getattr(aqi_updater, method)(**attach_rasters(kwargs, shared_memories)))
+        except Exception:
+            response = ('error', traceback.format_exc())
+        for shm in shared_memories:
+            shm.close()
+        connection.send(response)
+
+
+class AqiUpdaterPool():
+    """AqiUpdaterPool serves AQI updates of multiple graphs (e.g. of different regions) from the same AQI rasters,
+    so that the rasters need to be fetched and processed only once. Each graph has its own AqiUpdater in a worker
+    process, with its own output directory (aqi_updates/<graph name>/). The graphs are sampled and their updates
+    are exported in parallel. The rasters are passed to the workers in shared memory (once for all graphs).
+
+    AqiUpdaterPool has the same interface as AqiUpdater (as used by AqiScheduler). If the update of some graphs 
+    fails, only the graphs without the latest update are updated on the next try.
+
+    Attributes:
+        log: An instance of Logger class for writing log messages.
+        graph_names: The names of the graphs.
+        __connections: Connections to the worker processes by graph name.
+        __workers: The worker processes by graph name.
+        __sampling_bounds: WGS84 bounds (minx, miny, maxx, maxy) of the edges of all graphs.
+        __lock: A lock held while requests are sent to the workers and responses are received (as the methods 
+            can be called from different threads).
+    """
+
+    def __init__(self, log: Logger, graph_files: Dict[str, str], aqi_updates: str = 'aqi_updates/', **updater_kwargs):
+        self.log = log
+        self.graph_names: List[str] = list(graph_files)
+        self.__connections = {}
+        self.__workers = {}
+        self.__lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        for graph_name, graph_file in graph_files.items():
+            graph_aqi_updates = aqi_updates + graph_name + '/'
+            os.makedirs(graph_aqi_updates, exist_ok=True)
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(
+                target=run_aqi_updater_worker,
+                args=(worker_connection, log, graph_file, { **updater_kwargs, 'aqi_updates': graph_aqi_updates }),
+                name=f'aqi-updater-{graph_name}',
+                daemon=True
+            )
+            worker.start()
+            self.__connections[graph_name] = connection
+            self.__workers[graph_name] = worker
+        try:
+            graph_bounds = np.array(list(self.__receive_responses(self.graph_names).values()))
+        except Exception:
+            self.close()
+            raise
+        self.__sampling_bounds = (*graph_bounds[:, :2].min(axis=0), *graph_bounds[:, 2:].max(axis=0))
+        self.log.info(f'Started AQI updaters of graphs: {", ".join(self.graph_names)}')
+
+    def get_sampling_bounds(self, buffer: float = 0.02) -> Tuple[float, float, float, float]:
+        """Returns the WGS84 bounds (minx, miny, maxx, maxy) of the edges of all graphs, buffered by the given
+        distance in degrees.
+        """
+        minx, miny, maxx, maxy = self.__sampling_bounds
+        return (minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+
+    def new_update_available(self, latest_aqi_tif_name: str) -> bool:
+        return any(self.__get_graphs_to_update(latest_aqi_tif_name))
+
+    def create_aqi_update_csv(
+        self, 
+        aqi_tif_name: str, 
+        aqi_raster: RasterBand = None, 
+        pollutant_rasters: Dict[str, RasterBand] = {}
+    ) -> None:
+        """Creates the AQI updates of the graphs that do not have the update yet (in parallel). 
         """
-        rm_count = 0
-        error_count = 0
-        for file_n in os.listdir(self.__aqi_updates):
-            if (file_n.endswith('.csv') and file_n != self.latest_aqi_csv):
+        graph_names = self.__get_graphs_to_update(aqi_tif_name)
+        self.__call_workers(
+            'create_aqi_update_csv', 
+            graph_names, 
+            aqi_tif_name=aqi_tif_name, 
+            aqi_raster=aqi_raster, 
+            pollutant_rasters=pollutant_rasters
+        )
+
+    def create_aqi_forecast_updates(self, aqi_forecast: RasterStack) -> None:
+        self.__call_workers('create_aqi_forecast_updates', self.graph_names, aqi_forecast=aqi_forecast)
+
+    def finish_aqi_update(self) -> None:
+        self.__call_workers('finish_aqi_update', self.graph_names)
+
+    def close(self) -> None:
+        """Stops the worker processes.
+        """
+        with self.__lock:
+            for graph_name, worker in self.__workers.items():
                 try:
-                    os.remove(self.__aqi_updates + file_n)
-                    rm_count += 1
+                    if (worker.is_alive()):
+                        self.__connections[graph_name].send(None)
+                    worker.join(timeout=10)
                 except Exception:
-                    error_count += 1
-                    pass
-        self.log.info('Removed '+ str(rm_count) +' old edge aqi csv files')
-        if (error_count > 0):
-            self.log.warning(f'Could not remove {error_count} old edge aqi csv files')
+                    worker.terminate()
+                self.__connections[graph_name].close()
+            self.__workers = {}
+            self.__connections = {}
+
+    def __get_graphs_to_update(self, latest_aqi_tif_name: str) -> List[str]:
+        new_update_available = self.__call_workers('new_update_available', self.graph_names, latest_aqi_tif_name=latest_aqi_tif_name)
+        return [graph_name for graph_name in self.graph_names if new_update_available[graph_name]]
+
+    def __call_workers(self, method: str, graph_names: List[str], **kwargs) -> dict:
+        """Calls a method of the AqiUpdaters of the given graphs (in parallel) and returns the results by graph name.
+        Rasters in the arguments are passed to the workers in shared memory. Raises RuntimeError if the method 
+        failed for any of the graphs.
+        """
+        shared_memories = []
+        with self.__lock:
+            try:
+                shared_kwargs = share_rasters(kwargs, shared_memories)
+                for graph_name in graph_names:
+                    self.__connections[graph_name].send((method, shared_kwargs))
+                return self.__receive_responses(graph_names)
+            finally:
+                for shm in shared_memories:
+                    shm.close()
+                    shm.unlink()
+
+    def __receive_responses(self, graph_names: List[str]) -> dict:
+        results = {}
+        failed = []
+        for graph_name in graph_names:
+            try:
+                status, result = self.__connections[graph_name].recv()
+            except EOFError:
+                status, result = ('error', 'AQI updater process exited')
+            if (status == 'ok'):
+                results[graph_name] = result
+            else:
+                self.log.error(f'AQI updater of graph {graph_name} failed: {result}')
+                failed.append(graph_name)
+        if (failed):
+            raise RuntimeError(f'AQI updaters of graphs failed: {", ".join(failed)}')
+        return results
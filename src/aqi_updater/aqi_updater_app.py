@@ -1,55 +1,71 @@
 import os
-import time
-import traceback
-from datetime import datetime
 from aqi_fetcher import AqiFetcher
-from aqi_updater import AqiUpdater
-from load_env_vars import load_env_vars
+from aqi_updater import AqiUpdater, AqiUpdaterPool
+from aqi_scheduler import AqiScheduler
+from load_env_vars import load_env_vars, get_bool_env, get_json_env
 from common.logger import Logger
 import common.igraph as ig_utils
 from common.igraph import Edge as E
 
 
-log = Logger(printing=True, log_file='aqi_updater_app.log')
-load_env_vars(log)
+def main():
+    # the app is set up only in the main process (not in the worker processes of AqiUpdaterPool)
+    log = Logger(printing=True, log_file='aqi_updater_app.log')
+    load_env_vars(log)
 
-graph_subset = eval(os.getenv('GRAPH_SUBSET', 'False'))
-graph = ig_utils.read_graphml('graph/kumpula.graphml' if graph_subset else 'graph/hma.graphml')
+    graph_subset = get_bool_env('GRAPH_SUBSET', False)
+    # e.g. {"kumpula": "graph/kumpula.graphml", "hma": "graph/hma.graphml"}
+    aqi_graphs = get_json_env('AQI_GRAPHS', None)
+    in_memory = get_bool_env('AQI_IN_MEMORY', False)
+    delta_updates = get_bool_env('AQI_DELTA_UPDATES', False)
+    pollutants = [p for p in os.getenv('AQI_POLLUTANTS', '').split(',') if p]
+    updater_kwargs = dict(
+        sampling=os.getenv('AQI_SAMPLING', 'point'),
+        binary_formats=[f for f in os.getenv('AQI_BINARY_FORMATS', '').split(',') if f],
+        aqi_map_encoding=os.getenv('AQI_MAP_ENCODING', 'pairs'),
+        delta_updates=delta_updates,
+        delta_threshold=float(os.getenv('AQI_DELTA_THRESHOLD', '0.05')),
+        keyframe_interval=int(os.getenv('AQI_KEYFRAME_INTERVAL', '24')),
+        keep_versions=int(os.getenv('AQI_KEEP_VERSIONS', '2')),
+        pollutants=pollutants,
+        aggregates=get_bool_env('AQI_AGGREGATES', False),
+        aggregate_window=int(os.getenv('AQI_AGGREGATE_WINDOW', '24')),
+        aggregate_interval=int(os.getenv('AQI_AGGREGATE_INTERVAL', '1'))
+    )
 
-aqi_fetcher = AqiFetcher(log)
-aqi_updater = AqiUpdater(log, graph)
+    if (aqi_graphs):
+        # updates of all graphs are created from the same AQI rasters (in parallel)
+        aqi_updater = AqiUpdaterPool(log, aqi_graphs, **updater_kwargs)
+    else:
+        _, edge_columns = ig_utils.read_graphml_columns_cached(
+            'graph/kumpula.graphml' if graph_subset else 'graph/hma.graphml',
+            e_attrs=[E.id_ig, E.id_way, E.geom_wgs],
+            log=log
+        )
+        aqi_updater = AqiUpdater(log, edge_columns, **updater_kwargs)
+        del edge_columns
 
+    aqi_fetcher = AqiFetcher(
+        log,
+        in_memory=in_memory,
+        bounds=aqi_updater.get_sampling_bounds(),
+        forecast=get_bool_env('AQI_FORECAST', False),
+        pollutants=pollutants
+    )
 
-def fetch_process_aqi_data():
-    try:
-        aqi_fetcher.fetch_process_current_aqi_data()
-        log.info('AQI fetch & processing succeeded')
-    except Exception:
-        log.error(traceback.format_exc())
-        log.error(f'Failed to process AQI data to {aqi_fetcher.wip_aqi_tif}, retrying in 30s')
-        time.sleep(30)
-    finally:
-        aqi_fetcher.finish_aqi_fetch()
+    aqi_scheduler = AqiScheduler(
+        log,
+        aqi_fetcher,
+        aqi_updater,
+        poll_interval=float(os.getenv('AQI_POLL_INTERVAL', '15')),
+        backoff_max=float(os.getenv('AQI_BACKOFF_MAX', '300')),
+        pipelined=get_bool_env('AQI_PIPELINED', True),
+        queue_size=int(os.getenv('AQI_QUEUE_SIZE', '2'))
+    )
 
-
-def create_aqi_update_csv():
-    try:
-        aqi_updater.create_aqi_update_csv(aqi_fetcher.latest_aqi_tif)
-        log.info('AQI update succeeded')
-    except Exception:
-        log.error(traceback.format_exc())
-        log.error(f'Failed to update AQI from {aqi_fetcher.latest_aqi_tif}, retrying in 30s')
-        time.sleep(30)
-    finally:
-        aqi_updater.finish_aqi_update()
+    log.info('Starting AQI updater app')
+    aqi_scheduler.run_forever()
 
 
 if (__name__ == '__main__'):
-    log.info('Starting AQI updater app')
-
-    while True:
-        if (aqi_fetcher.new_aqi_available()):
-            fetch_process_aqi_data()
-        if (aqi_updater.new_update_available(aqi_fetcher.latest_aqi_tif)):
-            create_aqi_update_csv()
-        time.sleep(10)
+    main()
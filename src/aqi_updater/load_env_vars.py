@@ -1,4 +1,5 @@
 import os
+import json
 from glob import glob
 import csv
 import traceback
@@ -30,3 +31,28 @@ def load_env_vars(log):
     except Exception:
         log.warning('No .env file found')
         pass
+
+
+def get_bool_env(name: str, default: bool = False) -> bool:
+    """Returns the value of a boolean env variable ('true' or 'false', case-insensitive), or default if it is not
+    set. Raises ValueError if the value is anything else.
+    """
+    value = os.getenv(name, '').strip()
+    if (value == ''):
+        return default
+    if (value.lower() not in ('true', 'false')):
+        raise ValueError(f'Env variable {name} must be true or false, got: {value}')
+    return value.lower() == 'true'
+
+
+def get_json_env(name: str, default=None):
+    """Returns the value of an env variable parsed as JSON, or default if it is not set. Raises ValueError
+    if the value is not valid JSON.
+    """
+    value = os.getenv(name, '').strip()
+    if (value == ''):
+        return default
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError(f'Env variable {name} is not valid JSON: {e}')
@@ -0,0 +1,196 @@
+"""Incremental temporal aggregates (daily and rolling statistics) of hourly values of a fixed set of features
+(e.g. the AQI of the edges of a graph).
+
+The statistics are kept as running NumPy arrays, so that adding the values of an hour costs O(features) and
+the values of the past hours never need to be re-read. The statistics of the current (UTC) day are kept as
+count, sum, sum of squares, min and max per feature. The values of the latest window hours are kept in a ring
+buffer (with running sum and count per feature) for the rolling statistics.
+
+The state is checkpointed to state_dir in formats that can be memory-mapped (np.load with mmap_mode):
+    ids.npy                             The ids of the features (the state is discarded if the ids change).
+    rolling_values.npy                  The ring buffer (window + 1 rows of float32 values), written in place.
+    day_stats_<hour>.npy                The statistics of the current day as (count, sum, sum_sq, min, max) rows.
+    aggregate_state.json                The latest hour, the day, the hours of the ring rows and the name of
+                                        the current day_stats file (replaced atomically after each hour).
+
+The ring buffer has one row more than the window, so that the row written in place for a new hour always
+holds an hour that has already left the window (i.e. a crash before the json is replaced loses nothing).
+Hours are given as epoch hours (hours since 1970-01-01T00 UTC).
+
+"""
+
+import json
+import os
+from typing import Dict, Optional
+import numpy as np
+from common.logger import Logger
+from common.update_publisher import write_atomically
+
+
+class EdgeAggregates:
+    """EdgeAggregates maintains daily and rolling statistics of hourly values of features (e.g. edges).
+
+    Attributes:
+        log: An instance of Logger class for writing log messages.
+        latest_hour: The latest added hour (epoch hours), or None.
+        day: The current (UTC) day (epoch days) of the daily statistics, or None.
+        window: The number of hours in the rolling statistics.
+        __state_dir: A directory to which the state is checkpointed.
+        __ids: The ids of the features.
+        __day_stats: The count, sum, sum of squares, min and max of the values of the current day (float64 rows).
+        __ring: The values of the latest hours (window + 1 rows of float32, memory-mapped from rolling_values.npy).
+        __ring_hours: The hours of the rows of the ring buffer (-1 = empty row).
+        __rolling_sum: The sum of the values in the rolling window.
+        __rolling_count: The count of the values in the rolling window.
+    """
+
+    def __init__(self, log: Logger, state_dir: str, ids: np.ndarray, window: int = 24):
+        self.log = log
+        self.latest_hour: int = None
+        self.day: int = None
+        self.window = window
+        self.__state_dir = state_dir
+        self.__ids = np.asarray(ids)
+        self.__day_stats: np.ndarray = None
+        self.__ring: np.ndarray = None
+        self.__ring_hours: np.ndarray = None
+        self.__rolling_sum: np.ndarray = None
+        self.__rolling_count: np.ndarray = None
+        os.makedirs(state_dir, exist_ok=True)
+        if (not self.__load_state()):
+            self.__init_state()
+
+    def add(self, hour: int, values: np.ndarray) -> bool:
+        """Adds the values (nan = no value) of an hour to the statistics and checkpoints the state. The daily
+        statistics are reset if the hour is of a new day. Hours older than the latest hour are ignored
+        (returns False).
+        """
+        if (self.latest_hour is not None and hour <= self.latest_hour):
+            self.log.warning(f'Ignored aggregation of hour {hour} (latest hour is {self.latest_hour})')
+            return False
+        values = np.asarray(values, dtype=np.float64)
+        has_value = ~np.isnan(values)
+
+        if (hour // 24 != self.day):
+            self.__reset_day_stats(hour // 24)
+        count, total, total_sq, min_value, max_value = self.__day_stats
+        count += has_value
+        total += np.where(has_value, values, 0)
+        total_sq += np.where(has_value, values ** 2, 0)
+        np.fmin(min_value, values, out=min_value)
+        np.fmax(max_value, values, out=max_value)
+
+        # drop the hours that leave the rolling window (incl. the hour of the row to write)
+        for row in np.flatnonzero((self.__ring_hours >= 0) & (self.__ring_hours <= hour - self.window)):
+            self.__remove_ring_row(row)
+        row = hour % len(self.__ring_hours)
+        self.__ring[row] = values
+        self.__ring_hours[row] = hour
+        self.__rolling_sum += np.where(has_value, values, 0)
+        self.__rolling_count += has_value
+
+        self.latest_hour = hour
+        self.__save_state()
+        return True
+
+    def get_daily_stats(self) -> Dict[str, np.ndarray]:
+        """Returns the count (hours), mean, standard deviation, min and max of the values of the current day
+        (nan for features without values).
+        """
+        count, total, total_sq, min_value, max_value = self.__day_stats
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(total_sq / count - mean ** 2, 0))
+        return { 'count': count.astype(np.int32), 'mean': mean, 'std': std, 'min': min_value, 'max': max_value }
+
+    def get_rolling_stats(self) -> Dict[str, np.ndarray]:
+        """Returns the count (hours), mean and max of the values of the latest window hours (nan for features
+        without values).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.__rolling_sum / self.__rolling_count
+        rows = np.flatnonzero(self.__ring_hours >= 0)
+        max_value = np.fmax.reduce(self.__ring[rows], axis=0) if len(rows) else np.full(len(self.__ids), np.nan)
+        return { 'count': self.__rolling_count.astype(np.int32), 'mean': mean, 'max': max_value.astype(np.float64) }
+
+    def __reset_day_stats(self, day: Optional[int]) -> None:
+        self.day = day
+        self.__day_stats = np.zeros((5, len(self.__ids)), dtype=np.float64)
+        self.__day_stats[3:] = np.nan
+
+    def __remove_ring_row(self, row: int) -> None:
+        values = self.__ring[row].astype(np.float64)
+        has_value = ~np.isnan(values)
+        self.__rolling_sum -= np.where(has_value, values, 0)
+        self.__rolling_count -= has_value
+        self.__ring[row] = np.nan
+        self.__ring_hours[row] = -1
+
+    def __get_filepath(self, filename: str) -> str:
+        return os.path.join(self.__state_dir, filename)
+
+    def __get_day_stats_filename(self) -> str:
+        return f'day_stats_{self.latest_hour}.npy'
+
+    def __init_state(self) -> None:
+        self.latest_hour = None
+        self.__reset_day_stats(None)
+        self.__ring_hours = np.full(self.window + 1, -1, dtype=np.int64)
+        self.__ring = np.lib.format.open_memmap(
+            self.__get_filepath('rolling_values.npy'), mode='w+', dtype='<f4', shape=(self.window + 1, len(self.__ids))
+        )
+        self.__ring[:] = np.nan
+        self.__rolling_sum = np.zeros(len(self.__ids), dtype=np.float64)
+        self.__rolling_count = np.zeros(len(self.__ids), dtype=np.int32)
+        np.save(self.__get_filepath('ids.npy'), self.__ids)
+
+    def __save_state(self) -> None:
+        """Flushes the ring buffer, writes the statistics of the current day to a new file and replaces the json
+        that points to it (after which the day_stats file of the previous hour is removed).
+        """
+        self.__ring.flush()
+        np.save(self.__get_filepath(self.__get_day_stats_filename()), self.__day_stats)
+        state = {
+            'latest_hour': self.latest_hour,
+            'day': self.day,
+            'window': self.window,
+            'ring_hours': self.__ring_hours.tolist(),
+            'day_stats': self.__get_day_stats_filename()
+        }
+        def write_state(tmp_filepath: str):
+            with open(tmp_filepath, 'w') as f:
+                json.dump(state, f)
+        write_atomically(self.__get_filepath('aggregate_state.json'), write_state)
+        for file_n in os.listdir(self.__state_dir):
+            if (file_n.startswith('day_stats_') and file_n != state['day_stats']):
+                os.remove(self.__get_filepath(file_n))
+
+    def __load_state(self) -> bool:
+        """Loads the checkpointed state (if any). The state is discarded if the ids or the window have changed.
+        The running sums of the rolling window are recomputed from the ring buffer. Returns True if loaded.
+        """
+        filepath = self.__get_filepath('aggregate_state.json')
+        if (not os.path.exists(filepath)):
+            return False
+        try:
+            with open(filepath) as f:
+                state = json.load(f)
+            if (state['window'] != self.window or not np.array_equal(np.load(self.__get_filepath('ids.npy')), self.__ids)):
+                self.log.info('Features or window of aggregates have changed, aggregation is restarted')
+                return False
+            self.latest_hour = state['latest_hour']
+            self.day = state['day']
+            self.__day_stats = np.load(self.__get_filepath(state['day_stats']))
+            self.__ring_hours = np.array(state['ring_hours'], dtype=np.int64)
+            self.__ring = np.load(self.__get_filepath('rolling_values.npy'), mmap_mode='r+')
+            # rows written after the latest checkpoint or left from the window are dropped
+            self.__ring_hours[self.__ring_hours <= self.latest_hour - self.window] = -1
+            self.__ring[self.__ring_hours < 0] = np.nan
+            ring_values = self.__ring[self.__ring_hours >= 0]
+            self.__rolling_sum = np.nansum(ring_values, axis=0, dtype=np.float64)
+            self.__rolling_count = np.sum(~np.isnan(ring_values), axis=0, dtype=np.int32)
+            self.log.info(f'Loaded state of aggregates (latest hour: {self.latest_hour})')
+            return True
+        except Exception:
+            self.log.warning(f'Could not load state of aggregates from {self.__state_dir}')
+            return False
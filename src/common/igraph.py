@@ -9,16 +9,33 @@ GraphML files. The attribute names in the exported files are compact to reduce f
 On the other hand, the (descriptive) names of the enums are used as column names when edge or node data
 is read to pandas DataFrame object. 
 
+Loading large GraphML files is slow, as all attribute values need to be parsed from text. Hence the module 
+also provides a compact binary snapshot format (see read_graphml_cached) in which numeric attributes are 
+stored as typed arrays and geometries as WKB. Snapshots are built automatically from GraphML files and 
+read from the binary files on later loads. Processes that only need a few attributes of the nodes or edges 
+(and not the topology of the graph) can read them as columns with read_graphml_columns_cached, in which case 
+the snapshot is built by streaming only those attributes of the GraphML file and numeric columns are 
+memory-mapped from the snapshot.
+
 """
 
 import ast
+import hashlib
+import json
+import os
+import pickle
+import shutil
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterable
+from xml.parsers import expat
+import numpy as np
 import geopandas as gpd
 import igraph as ig
+import shapely
 from pyproj import CRS
 from shapely import wkt
 from shapely.geometry import LineString
+from shapely.geometry.base import BaseGeometry
 
 
 # enum names are used as dataframe column names 
@@ -87,6 +104,91 @@ def to_tuple(value):
    return ast.literal_eval(value) if value != 'None' else None
 
 
+
+# column converters convert all values of an attribute at once (values are read as text from GraphML)
+
+def __parse_number(text: str):
+    return int(text) if text.lstrip('-').isdigit() else float(text)
+
+def __parse_key(text: str):
+    return text[1:-1] if text[:1] in ('\'', '"') and text[-1:] == text[:1] else __parse_number(text)
+
+def __parse_dict(value: str) -> dict:
+    """Parses text representation of a flat dictionary with numeric values, e.g. {60: 12.5, 65: 3.2},
+    faster than ast.literal_eval. Falls back to ast.literal_eval for any other kind of literal.
+    """
+    if value == 'None':
+        return None
+    try:
+        body = value[1:-1].strip() if value[:1] == '{' and value[-1:] == '}' else None
+        if not body:
+            return {} if body == '' else ast.literal_eval(value)
+        parsed = {}
+        for item in body.split(', '):
+            key, sep, item_value = item.partition(': ')
+            parsed[__parse_key(key)] = __parse_number(item_value)
+        return parsed
+    except Exception:
+        return ast.literal_eval(value)
+
+def __parse_tuple(value: str) -> tuple:
+    """Parses text representation of a flat tuple of numbers, e.g. (12, 15), faster than ast.literal_eval.
+    """
+    if value == 'None':
+        return None
+    try:
+        if value[:1] != '(' or value[-1:] != ')':
+            return ast.literal_eval(value)
+        return tuple(__parse_number(item.strip()) for item in value[1:-1].split(',') if item.strip())
+    except Exception:
+        return ast.literal_eval(value)
+
+def __with_nones(values: np.ndarray, mask: np.ndarray) -> list:
+    """Returns a list of the values where mask is True and None elsewhere.
+    """
+    if mask.all():
+        return values.tolist()
+    column = np.full(len(mask), None, dtype=object)
+    column[mask] = values.astype(object)
+    return column.tolist()
+
+def to_str_column(values: list) -> list:
+    return [value if value != 'None' else None for value in values]
+def to_int_column(values: list) -> list:
+    text = np.array(values, dtype=str)
+    mask = text != 'None'
+    return __with_nones(text[mask].astype(np.int64), mask)
+def to_float_column(values: list) -> list:
+    text = np.array(values, dtype=str)
+    mask = text != 'None'
+    return __with_nones(text[mask].astype(np.float64), mask)
+def to_geom_column(values: list) -> list:
+    text = np.array(values, dtype=object)
+    text[text == 'None'] = None
+    return shapely.from_wkt(text).tolist()
+def to_bool_column(values: list) -> list:
+    text = np.array(values, dtype=str)
+    mask = text != 'None'
+    if not np.isin(text[mask], ['True', 'False']).all():
+        return [to_bool(value) for value in values]
+    return __with_nones(text[mask] == 'True', mask)
+def to_dict_column(values: list) -> list:
+    return [__parse_dict(value) for value in values]
+def to_tuple_column(values: list) -> list:
+    return [__parse_tuple(value) for value in values]
+
+
+__column_converter_by_value_converter = {
+    to_str: to_str_column,
+    to_int: to_int_column,
+    to_float: to_float_column,
+    to_geom: to_geom_column,
+    to_bool: to_bool_column,
+    to_dict: to_dict_column,
+    to_tuple: to_tuple_column
+}
+
+
 __value_converter_by_edge_attribute = {
     Edge.id_ig: to_int,
     Edge.id_otp: to_str,
@@ -146,6 +248,35 @@ def get_edge_dicts(G: ig.Graph, attrs: List[Enum] = [Edge.geometry]) -> list:
     return edge_dicts
 
 
+def __get_attribute_columns(seq, attrs: List[Enum] = [], ig_attrs: List[str] = []) -> dict:
+    """Returns the selected attributes of a vertex or edge sequence as a dictionary of value lists
+    (columns). Attributes are read in bulk from the sequence instead of iterating vertices or edges.
+    The names of the enums are used as keys (column names) for graph attributes and the names 
+    of igraph attributes (e.g. index, source or target) as such. 
+    """
+    columns = {}
+    attribute_names = seq.attribute_names()
+    for attr in attrs:
+        if attr.value in attribute_names:
+            columns[attr.name] = seq[attr.value]
+
+    if not len(seq):
+        return columns
+
+    edgelist = seq.graph.get_edgelist() if isinstance(seq, ig.EdgeSeq) else None
+    for attr in ig_attrs:
+        if attr == 'index':
+            columns[attr] = seq.indices
+        elif edgelist is not None and attr in ('source', 'target', 'tuple'):
+            columns[attr] = [edgelist[idx] for idx in seq.indices]
+            if attr != 'tuple':
+                columns[attr] = [uv[0 if attr == 'source' else 1] for uv in columns[attr]]
+        elif hasattr(seq[0], attr):
+            columns[attr] = [getattr(item, attr) for item in seq]
+
+    return columns
+
+
 def get_edge_gdf(
     G: ig.Graph, 
     id_attr: Enum = None, 
@@ -157,26 +288,10 @@ def get_edge_gdf(
     """Returns all edges of a graph as GeoPandas GeoDataFrame. The default is to load the projected geometry,
     but it can be overridden by defining another geom_attr and the corresponding epsg. 
     """
-
-    edge_dicts = []
-    ids = []
-    for edge in G.es:
-        edge_dict = {}
-        edge_attrs = edge.attributes()
-        ids.append(edge_attrs[id_attr.value] if id_attr else edge.index)
-        edge_dict[geom_attr.name] = edge_attrs[geom_attr.value]
-        
-        for attr in attrs:
-            if attr.value in edge_attrs:
-                edge_dict[attr.name] = edge_attrs[attr.value]
-
-        for attr in ig_attrs:
-            if (hasattr(edge, attr)):
-                edge_dict[attr] = getattr(edge, attr)
-        
-        edge_dicts.append(edge_dict)
-
-    return gpd.GeoDataFrame(edge_dicts, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
+    ids = G.es[id_attr.value] if id_attr else list(range(G.ecount()))
+    geoms = gpd.array.from_shapely(np.array(G.es[geom_attr.value], dtype=object))
+    columns = { geom_attr.name: geoms, **__get_attribute_columns(G.es, attrs, ig_attrs) }
+    return gpd.GeoDataFrame(columns, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
 
 
 def get_node_gdf(
@@ -190,58 +305,187 @@ def get_node_gdf(
     """Returns all nodes of a graph as pandas GeoDataFrame. The default is to load the projected geometry,
     but it can be overridden by defining another geom_attr and a corresponding epsg. 
     """
-    
-    node_dicts = []
-    ids = []
-    for node in G.vs:
-        node_dict = {}
-        node_attrs = node.attributes()
-        ids.append(node_attrs[id_attr.value] if id_attr else node.index)
-        node_dict[geom_attr.name] = node_attrs[geom_attr.value]
+    ids = G.vs[id_attr.value] if id_attr else list(range(G.vcount()))
+    geoms = gpd.array.from_shapely(np.array(G.vs[geom_attr.value], dtype=object))
+    columns = { geom_attr.name: geoms, **__get_attribute_columns(G.vs, attrs, ig_attrs) }
+    return gpd.GeoDataFrame(columns, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
 
-        for attr in attrs:
-            if attr.value in node_attrs:
-                node_dict[attr.name] = node_attrs[attr.value]
-        
-        for attr in ig_attrs:
-            if (hasattr(node, attr)):
-                node_dict[attr] = getattr(node, attr)
-        
-        node_dicts.append(node_dict)
-
-    return gpd.GeoDataFrame(node_dicts, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
 
-
-def read_graphml(graph_file: str, log = None) -> ig.Graph:
+def read_graphml(
+    graph_file: str, 
+    log = None, 
+    n_attrs: List[Node] = None, 
+    e_attrs: List[Edge] = None
+) -> ig.Graph:
     """Loads an igraph graph object from GraphML file, including all edge and node
-    attributes that are found in the data and recognized by this module. 
+    attributes that are found in the data and recognized by this module. If n_attrs or e_attrs
+    are given, only the listed node or edge attributes are loaded (an empty list loads none). 
     
     Since all attributes are saved in text format, an attribute specific converter must be found 
-    in the dictionary __value_converter_by_node_attribute for each attribute. 
+    in the dictionary __value_converter_by_node_attribute for each attribute. The values of each
+    attribute are converted at once by the corresponding column converter. 
     Attributes for which a converter is not found are omitted. 
     """
     
     G = ig.Graph()
     G = G.Read_GraphML(graph_file)
     del(G.vs['id'])
+    __delete_unselected_attributes(G.vs, n_attrs)
+    __delete_unselected_attributes(G.es, e_attrs)
 
-    for attr in G.vs[0].attributes():
+    for attr in G.vs.attribute_names():
         try:
-            converter = __value_converter_by_node_attribute[Node(attr)]
-            G.vs[attr] = [converter(value) for value in list(G.vs[attr])]
+            converter = __column_converter_by_value_converter[__value_converter_by_node_attribute[Node(attr)]]
+            G.vs[attr] = converter(G.vs[attr])
         except Exception:
             if log: log.warning(f'Failed to read node attribute {attr}')
             
-    for attr in G.es[0].attributes():
+    for attr in G.es.attribute_names():
         try:
-            converter = __value_converter_by_edge_attribute[Edge(attr)]
-            G.es[attr] = [converter(value) for value in list(G.es[attr])]
+            converter = __column_converter_by_value_converter[__value_converter_by_edge_attribute[Edge(attr)]]
+            G.es[attr] = converter(G.es[attr])
         except Exception:
             if log: log.warning(f'Failed to read edge attribute {attr}')
 
     return G
 
 
+def __stream_graphml(graph_file: str, n_attrs: List[Node] = None, e_attrs: List[Edge] = None, read_edges: bool = False) -> dict:
+    """Parses a GraphML file incrementally (with expat) and returns the text values of the selected node and edge
+    attributes by attribute name (all attributes if n_attrs or e_attrs is None), in the order of the nodes and 
+    edges in the file. Only the values of the selected attributes are kept in memory. Missing values are read 
+    as 'None'. If read_edges is True, the edges are also returned as (source, target) node indexes.
+    """
+    selected_by_domain = { 
+        'node': None if n_attrs is None else set(attr.value for attr in n_attrs), 
+        'edge': None if e_attrs is None else set(attr.value for attr in e_attrs) 
+    }
+    values_by_domain = { 'node': {}, 'edge': {} }
+    attr_by_key = { 'node': {}, 'edge': {} }
+    graph = { 'directed': True, 'node_count': 0, 'edges': [] }
+    node_index = {}
+    # the selected attributes of the current node or edge and the text of the current data element
+    current = { 'keys': None, 'row': None, 'attr': None }
+    text = []
+
+    def start_element(name: str, attrs: dict) -> None:
+        tag = name.rpartition(' ')[2]
+        if (tag == 'data'):
+            if (current['keys'] is not None):
+                current['attr'] = current['keys'].get(attrs.get('key'))
+                text.clear()
+        elif (tag in ('node', 'edge')):
+            current['keys'] = attr_by_key[tag] if attr_by_key[tag] else None
+            current['row'] = {}
+            if (tag == 'node'):
+                node_index[attrs.get('id')] = graph['node_count']
+                graph['node_count'] += 1
+            elif (read_edges):
+                graph['edges'].append((node_index[attrs.get('source')], node_index[attrs.get('target')]))
+        elif (tag == 'key'):
+            domain = attrs.get('for')
+            attr = attrs.get('attr.name')
+            if (domain in values_by_domain and (selected_by_domain[domain] is None or attr in selected_by_domain[domain])):
+                attr_by_key[domain][attrs.get('id')] = attr
+                values_by_domain[domain][attr] = []
+        elif (tag == 'graph'):
+            graph['directed'] = attrs.get('edgedefault', 'directed') == 'directed'
+
+    def end_element(name: str) -> None:
+        tag = name.rpartition(' ')[2]
+        if (tag == 'data'):
+            if (current['attr'] is not None):
+                current['row'][current['attr']] = ''.join(text)
+                current['attr'] = None
+        elif (tag in ('node', 'edge')):
+            row = current['row']
+            for attr, column in values_by_domain[tag].items():
+                column.append(row.get(attr, 'None'))
+            current['keys'] = None
+
+    def character_data(data: str) -> None:
+        if (current['attr'] is not None):
+            text.append(data)
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    with open(graph_file, 'rb') as f:
+        parser.ParseFile(f)
+    return { **graph, 'node': values_by_domain['node'], 'edge': values_by_domain['edge'] }
+
+
+def read_graphml_columns(
+    graph_file: str, 
+    n_attrs: List[Node] = [], 
+    e_attrs: List[Edge] = [], 
+    log = None
+) -> Tuple[Dict[Node, np.ndarray], Dict[Edge, np.ndarray]]:
+    """Reads the selected node and edge attributes from a GraphML file as typed arrays (by attribute enums),
+    without building a graph object. The file is parsed incrementally (with expat) and only the values of 
+    the selected attributes are kept in memory, which keeps the peak memory use low when only a few attributes 
+    of a large graph are needed. Values are in the order of the nodes and edges in the file (i.e. by their 
+    indexes in a graph loaded with read_graphml). See read_graphml_columns_cached for repeated loads.
+
+    Integer, float and boolean attributes are returned as NumPy arrays of the corresponding dtype 
+    (or as object arrays if some values are None), geometries as arrays of Shapely geometries and 
+    other attributes as object arrays. Missing values are read as None. Attributes that are not found 
+    in the file or that fail to convert are omitted.
+    """
+    graphml = __stream_graphml(graph_file, n_attrs=n_attrs, e_attrs=e_attrs)
+    n_columns = __convert_columns(graphml['node'], n_attrs, __value_converter_by_node_attribute, log)
+    e_columns = __convert_columns(graphml['edge'], e_attrs, __value_converter_by_edge_attribute, log)
+    return (n_columns, e_columns)
+
+
+def __convert_columns(values: Dict[str, list], attrs: List[Enum], converter_by_attribute: dict, log = None) -> dict:
+    columns = {}
+    for attr in attrs:
+        if attr.value not in values:
+            continue
+        try:
+            columns[attr] = __to_typed_array(values[attr.value], converter_by_attribute[attr])
+        except Exception:
+            if log: log.warning(f'Failed to read attribute {attr.value}')
+    return columns
+
+
+def __to_typed_array(values: List[str], converter) -> np.ndarray:
+    """Converts text values of an attribute to a NumPy array. Numeric and boolean attributes without
+    None values are converted to arrays of the corresponding dtype and geometries to arrays of geometries. 
+    """
+    kind = __snapshot_kind_by_converter[converter]
+    if kind == 'geom':
+        text = np.array(values, dtype=object)
+        text[text == 'None'] = None
+        return shapely.from_wkt(text)
+    if kind in ('int', 'float', 'bool') and 'None' not in values:
+        text = np.array(values, dtype=str)
+        if kind == 'int':
+            return text.astype(np.int64)
+        if kind == 'float':
+            return text.astype(np.float64)
+        if np.isin(text, ['True', 'False']).all():
+            return text == 'True'
+    column = np.empty(len(values), dtype=object)
+    column[:] = __column_converter_by_value_converter[converter](values)
+    return column
+
+
+def __delete_unselected_attributes(seq, attrs: List[Enum] = None) -> None:
+    """Deletes the attributes that are not listed in attrs from a vertex or edge sequence. 
+    Nothing is deleted if attrs is None.
+    """
+    if attrs is None:
+        return
+    selected = [attr.value for attr in attrs]
+    for attr in seq.attribute_names():
+        if attr not in selected:
+            del(seq[attr])
+
+
 def export_to_graphml(
     G: ig.Graph, 
     graph_file: str, 
@@ -281,3 +525,425 @@ def export_to_graphml(
                 del(Gc.es[edge_attr])
 
     Gc.save(graph_file, format='graphml')
+
+
+# binary graph snapshots
+
+__snapshot_format_version = 1
+
+__snapshot_kind_by_converter = {
+    to_int: 'int',
+    to_float: 'float',
+    to_bool: 'bool',
+    to_str: 'str',
+    to_geom: 'geom',
+    to_dict: 'object',
+    to_tuple: 'object'
+}
+
+__snapshot_value_check_by_kind = {
+    'int': lambda value: isinstance(value, int),
+    'float': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'bool': lambda value: isinstance(value, bool),
+    'str': lambda value: isinstance(value, str),
+    'geom': lambda value: isinstance(value, BaseGeometry)
+}
+
+__snapshot_dtype_by_kind = {
+    'int': np.int64,
+    'float': np.float64,
+    'bool': np.bool_
+}
+
+
+def get_file_hash(filepath: str, chunk_size: int = 2**20) -> str:
+    """Returns a SHA-1 hash (hex digest) of the content of the given file.
+    """
+    file_hash = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def __get_snapshot_kind(attr: str, values: list, converter_by_attribute: dict, enum_class) -> str:
+    """Returns the type of storage to use for an attribute in a snapshot. Attributes that are not recognized
+    by this module or the values of which are not of the expected type are stored as pickled objects.
+    """
+    try:
+        kind = __snapshot_kind_by_converter[converter_by_attribute[enum_class(attr)]]
+    except Exception:
+        return 'object'
+    if kind == 'object':
+        return kind
+    value_check = __snapshot_value_check_by_kind[kind]
+    if all(value is None or value_check(value) for value in values):
+        return kind
+    return 'object'
+
+
+def __write_snapshot_column(snapshot_dir: str, name: str, values: list, kind: str) -> None:
+    """Writes the values of a single attribute to binary file(s) in the snapshot directory. Missing values (None)
+    are recorded in a separate mask array, if there are any. 
+    """
+    col_path = os.path.join(snapshot_dir, name)
+    if kind == 'object':
+        with open(col_path + '.pkl', 'wb') as f:
+            pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+
+    mask = np.array([value is not None for value in values], dtype=bool)
+    if not mask.all():
+        np.save(col_path + '_mask.npy', mask)
+
+    if kind in __snapshot_dtype_by_kind:
+        fill_value = __snapshot_dtype_by_kind[kind](0)
+        array = np.array([value if value is not None else fill_value for value in values], 
+            dtype=__snapshot_dtype_by_kind[kind])
+        np.save(col_path + '.npy', array)
+        return
+
+    # geometries are stored as WKB and strings as UTF-8, both as a single byte array with offsets
+    if kind == 'geom':
+        chunks = [wkb if wkb is not None else b'' for wkb in shapely.to_wkb(np.array(values, dtype=object))]
+    else:
+        chunks = [value.encode('utf-8') if value is not None else b'' for value in values]
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+    np.save(col_path + '.npy', np.frombuffer(b''.join(chunks), dtype=np.uint8))
+    np.save(col_path + '_offsets.npy', offsets)
+
+
+def __read_snapshot_array(snapshot_dir: str, name: str, kind: str) -> np.ndarray:
+    """Reads the values of a single attribute from a snapshot directory as a NumPy array. Numeric and boolean 
+    attributes without missing values are returned as read-only memory-mapped arrays. Other attributes are 
+    decoded to object arrays (or to arrays of geometries), with None for missing values.
+    """
+    col_path = os.path.join(snapshot_dir, name)
+    if kind == 'object':
+        with open(col_path + '.pkl', 'rb') as f:
+            values = pickle.load(f)
+        column = np.empty(len(values), dtype=object)
+        for idx, value in enumerate(values):
+            column[idx] = value
+        return column
+
+    mask = np.load(col_path + '_mask.npy') if os.path.exists(col_path + '_mask.npy') else None
+    array = np.load(col_path + '.npy', mmap_mode='r')
+
+    if kind in __snapshot_dtype_by_kind:
+        if mask is None:
+            return array
+        values = np.array(array).astype(object)
+        values[~mask] = None
+        return values
+
+    offsets = np.load(col_path + '_offsets.npy').tolist()
+    buffer = array.tobytes()
+    chunks = [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    if kind == 'geom':
+        values = shapely.from_wkb(np.array(chunks, dtype=object))
+        if mask is not None:
+            values[~mask] = None
+        return values
+    values = np.array([chunk.decode('utf-8') for chunk in chunks] if chunks else [], dtype=object)
+    if mask is not None:
+        values[~mask] = None
+    return values
+
+
+def __read_snapshot_column(snapshot_dir: str, name: str, kind: str) -> list:
+    """Reads the values of a single attribute from a snapshot directory as a list of Python values 
+    (as needed for the attributes of a graph object).
+    """
+    if kind == 'object':
+        with open(os.path.join(snapshot_dir, name + '.pkl'), 'rb') as f:
+            return pickle.load(f)
+    return __read_snapshot_array(snapshot_dir, name, kind).tolist()
+
+
+def export_to_snapshot(G: ig.Graph, snapshot_dir: str, source_hash: str = '') -> None:
+    """Writes the given graph object to a binary snapshot directory. Numeric and boolean attributes are
+    written as typed NumPy arrays, geometries as WKB and strings as UTF-8 byte arrays. Dictionary and tuple
+    valued attributes (and any attributes of unexpected type) are pickled. The snapshot directory is replaced
+    as a whole (by renaming a temporary directory).
+    """
+    __write_snapshot(
+        snapshot_dir,
+        np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2),
+        G.is_directed(),
+        G.vcount(),
+        ((domain, attr, seq[attr]) for domain, seq in [('node', G.vs), ('edge', G.es)] for attr in seq.attribute_names()),
+        source_hash
+    )
+
+
+def export_graphml_to_snapshot(
+    graph_file: str, 
+    snapshot_dir: str, 
+    source_hash: str = '', 
+    log = None, 
+    n_attrs: List[Node] = None, 
+    e_attrs: List[Edge] = None
+) -> None:
+    """Writes a binary snapshot directory of a GraphML file (see export_to_snapshot) without building a graph 
+    object. The file is parsed incrementally (with expat) and the values of each attribute are converted at once
+    by the corresponding column converter (as in read_graphml). Attributes for which a converter is not found 
+    are stored as text.
+    
+    If n_attrs or e_attrs are given, only the listed node or edge attributes are read to the snapshot (and the 
+    selection is recorded in its metadata). The attributes are converted and written one at a time, so that 
+    the text values of each attribute are released once it has been written.
+    """
+    graphml = __stream_graphml(graph_file, n_attrs=n_attrs, e_attrs=e_attrs, read_edges=True)
+
+    def convert_columns():
+        for domain, converter_by_attribute, enum_class in [
+            ('node', __value_converter_by_node_attribute, Node), 
+            ('edge', __value_converter_by_edge_attribute, Edge)
+        ]:
+            for attr in list(graphml[domain]):
+                values = graphml[domain].pop(attr)
+                try:
+                    converter = __column_converter_by_value_converter[converter_by_attribute[enum_class(attr)]]
+                    values = converter(values)
+                except Exception:
+                    if log: log.warning(f'Failed to read {domain} attribute {attr}')
+                    values = [value if value != 'None' else None for value in values]
+                yield (domain, attr, values)
+
+    __write_snapshot(
+        snapshot_dir,
+        np.array(graphml['edges'], dtype=np.int64).reshape(-1, 2),
+        graphml['directed'],
+        graphml['node_count'],
+        convert_columns(),
+        source_hash,
+        n_selection=None if n_attrs is None else [attr.value for attr in n_attrs],
+        e_selection=None if e_attrs is None else [attr.value for attr in e_attrs]
+    )
+
+
+def __write_snapshot(
+    snapshot_dir: str, 
+    edges: np.ndarray, 
+    directed: bool, 
+    node_count: int, 
+    columns: Iterable[Tuple[str, str, list]], 
+    source_hash: str,
+    n_selection: List[str] = None,
+    e_selection: List[str] = None
+) -> None:
+    """Writes a snapshot directory of the given (domain, attribute, values) columns (domain being node or edge). 
+    The selections record the names of the node and edge attributes that were read from the source (None for all).
+    """
+    # a directory version of common.update_publisher.write_atomically (that this module does not depend on); the
+    # temporary directory is unique per process, as several processes may build the same snapshot at once
+    tmp_dir = snapshot_dir.rstrip('/') + f'.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, 'edges.npy'), edges)
+    
+    kinds_by_domain = { 'node': {}, 'edge': {} }
+    for domain, attr, values in columns:
+        converter_by_attribute, enum_class = (
+            (__value_converter_by_node_attribute, Node) if domain == 'node' else (__value_converter_by_edge_attribute, Edge)
+        )
+        kinds_by_domain[domain][attr] = __get_snapshot_kind(attr, values, converter_by_attribute, enum_class)
+        __write_snapshot_column(tmp_dir, domain[0] +'_'+ attr, values, kinds_by_domain[domain][attr])
+
+    meta = {
+        'version': __snapshot_format_version,
+        'source_hash': source_hash,
+        'directed': directed,
+        'node_count': node_count,
+        'edge_count': len(edges),
+        'node_attributes': kinds_by_domain['node'],
+        'edge_attributes': kinds_by_domain['edge'],
+        'node_selection': n_selection,
+        'edge_selection': e_selection
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(tmp_dir, snapshot_dir)
+
+
+def read_snapshot_meta(snapshot_dir: str) -> dict:
+    """Returns the metadata of a graph snapshot or None if the snapshot does not exist or it was
+    written in an incompatible format.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except Exception:
+        return None
+    return meta if meta.get('version') == __snapshot_format_version else None
+
+
+def __snapshot_includes(meta: dict, n_attrs: List[Node] = None, e_attrs: List[Edge] = None) -> bool:
+    """Returns True if the given node and edge attributes (all attributes if None) were read to a snapshot 
+    (i.e. they are in the snapshot unless they are missing from the source).
+    """
+    for selection, attrs in [(meta.get('node_selection'), n_attrs), (meta.get('edge_selection'), e_attrs)]:
+        if selection is not None and (attrs is None or any(attr.value not in selection for attr in attrs)):
+            return False
+    return True
+
+
+def read_snapshot(snapshot_dir: str, n_attrs: List[Node] = None, e_attrs: List[Edge] = None) -> ig.Graph:
+    """Loads an igraph graph object from a binary snapshot directory written by export_to_snapshot.
+    If n_attrs or e_attrs are given, only the listed node or edge attributes are read.
+    """
+    meta = read_snapshot_meta(snapshot_dir)
+    if not meta:
+        raise ValueError(f'No valid graph snapshot found in {snapshot_dir}')
+
+    edges = np.load(os.path.join(snapshot_dir, 'edges.npy'), mmap_mode='r')
+    G = ig.Graph(n=meta['node_count'], edges=edges.tolist(), directed=meta['directed'])
+
+    for attr, kind in meta['node_attributes'].items():
+        if n_attrs is not None and attr not in [n_attr.value for n_attr in n_attrs]:
+            continue
+        G.vs[attr] = __read_snapshot_column(snapshot_dir, 'n_'+ attr, kind)
+
+    for attr, kind in meta['edge_attributes'].items():
+        if e_attrs is not None and attr not in [e_attr.value for e_attr in e_attrs]:
+            continue
+        G.es[attr] = __read_snapshot_column(snapshot_dir, 'e_'+ attr, kind)
+
+    return G
+
+
+def read_snapshot_columns(
+    snapshot_dir: str, 
+    n_attrs: List[Node] = [], 
+    e_attrs: List[Edge] = []
+) -> Tuple[Dict[Node, np.ndarray], Dict[Edge, np.ndarray]]:
+    """Reads the selected node and edge attributes from a binary snapshot directory as arrays (by attribute enums),
+    without building a graph object (see read_graphml_columns). Numeric and boolean attributes without missing
+    values are memory-mapped, i.e. they are only read from disk as far as they are accessed. Attributes that are 
+    not found in the snapshot are omitted.
+    """
+    meta = read_snapshot_meta(snapshot_dir)
+    if not meta:
+        raise ValueError(f'No valid graph snapshot found in {snapshot_dir}')
+    n_columns = { 
+        attr: __read_snapshot_array(snapshot_dir, 'n_'+ attr.value, meta['node_attributes'][attr.value])
+        for attr in n_attrs if attr.value in meta['node_attributes']
+    }
+    e_columns = { 
+        attr: __read_snapshot_array(snapshot_dir, 'e_'+ attr.value, meta['edge_attributes'][attr.value])
+        for attr in e_attrs if attr.value in meta['edge_attributes']
+    }
+    return (n_columns, e_columns)
+
+
+def get_snapshot_dir(graph_file: str, cache_dir: str = None, source_hash: str = None) -> str:
+    """Returns the path to the snapshot directory of a GraphML file. The directory name contains the name
+    of the GraphML file and (the beginning of) the hash of its content. By default, snapshots are stored
+    next to the GraphML file.
+    """
+    if not source_hash:
+        source_hash = get_file_hash(graph_file)
+    cache_dir = cache_dir if cache_dir else os.path.dirname(graph_file)
+    graph_name = os.path.splitext(os.path.basename(graph_file))[0]
+    return os.path.join(cache_dir, f'{graph_name}_{source_hash[:16]}.snapshot')
+
+
+def __remove_old_snapshots(snapshot_dir: str, graph_file: str) -> None:
+    """Removes snapshots of older versions of the given GraphML file from the snapshot directory.
+    """
+    cache_dir = os.path.dirname(snapshot_dir)
+    graph_name = os.path.splitext(os.path.basename(graph_file))[0]
+    for file_n in os.listdir(cache_dir if cache_dir else '.'):
+        old_dir = os.path.join(cache_dir, file_n)
+        if (file_n.startswith(graph_name +'_') and file_n.endswith('.snapshot') and old_dir != snapshot_dir):
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_graphml_cached(
+    graph_file: str, 
+    cache_dir: str = None, 
+    log = None, 
+    n_attrs: List[Node] = None, 
+    e_attrs: List[Edge] = None
+) -> ig.Graph:
+    """Loads an igraph graph object from a binary snapshot of the given GraphML file. On the first load 
+    (or if the content of the GraphML file has changed) the graph is read with read_graphml and a new 
+    snapshot is written for later loads. Snapshots of older versions of the GraphML file are removed.
+    
+    Snapshots written here include all attributes, but only the attributes listed in n_attrs or e_attrs
+    are read from them if specified (see read_graphml). A snapshot that was built with only some of the
+    attributes (by read_graphml_columns_cached) is used only if it includes the listed attributes.
+    """
+    source_hash = get_file_hash(graph_file)
+    snapshot_dir = get_snapshot_dir(graph_file, cache_dir=cache_dir, source_hash=source_hash)
+    
+    meta = read_snapshot_meta(snapshot_dir)
+    if meta and meta['source_hash'] == source_hash and __snapshot_includes(meta, n_attrs, e_attrs):
+        try:
+            G = read_snapshot(snapshot_dir, n_attrs=n_attrs, e_attrs=e_attrs)
+            if log: log.info(f'Loaded graph from snapshot: {snapshot_dir}')
+            return G
+        except Exception:
+            if log: log.warning(f'Failed to read graph snapshot {snapshot_dir}, rebuilding it')
+    
+    G = read_graphml(graph_file, log=log)
+    try:
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+        export_to_snapshot(G, snapshot_dir, source_hash=source_hash)
+        __remove_old_snapshots(snapshot_dir, graph_file)
+        if log: log.info(f'Wrote graph snapshot: {snapshot_dir}')
+    except Exception:
+        if log: log.warning(f'Failed to write graph snapshot {snapshot_dir}')
+    __delete_unselected_attributes(G.vs, n_attrs)
+    __delete_unselected_attributes(G.es, e_attrs)
+    return G
+
+
+def read_graphml_columns_cached(
+    graph_file: str, 
+    cache_dir: str = None, 
+    n_attrs: List[Node] = [], 
+    e_attrs: List[Edge] = [], 
+    log = None
+) -> Tuple[Dict[Node, np.ndarray], Dict[Edge, np.ndarray]]:
+    """Reads the selected node and edge attributes of a GraphML file as arrays (see read_graphml_columns) from 
+    a binary snapshot of the file (see read_snapshot_columns). On the first load (or if the content of the 
+    GraphML file has changed) the snapshot is built by streaming the selected attributes of the GraphML file 
+    (export_graphml_to_snapshot), which keeps the peak memory use of the first load close to that of
+    read_graphml_columns. If the snapshot lacks some of the selected attributes, it is rebuilt with both its 
+    attributes and the selected ones. Snapshots of older versions of the GraphML file are removed. If the 
+    snapshot cannot be written or read, the attributes are read from the GraphML file.
+    """
+    source_hash = get_file_hash(graph_file)
+    snapshot_dir = get_snapshot_dir(graph_file, cache_dir=cache_dir, source_hash=source_hash)
+
+    meta = read_snapshot_meta(snapshot_dir)
+    if not (meta and meta['source_hash'] == source_hash and __snapshot_includes(meta, n_attrs, e_attrs)):
+        snapshot_n_attrs, snapshot_e_attrs = n_attrs, e_attrs
+        if meta and meta['source_hash'] == source_hash:
+            # the attributes of the current snapshot are kept (the snapshot is complete if its selection is None)
+            snapshot_n_attrs = None if meta.get('node_selection') is None else (
+                n_attrs + [Node(attr) for attr in meta['node_selection'] if Node(attr) not in n_attrs])
+            snapshot_e_attrs = None if meta.get('edge_selection') is None else (
+                e_attrs + [Edge(attr) for attr in meta['edge_selection'] if Edge(attr) not in e_attrs])
+        try:
+            if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+            export_graphml_to_snapshot(
+                graph_file, snapshot_dir, source_hash=source_hash, log=log, n_attrs=snapshot_n_attrs, e_attrs=snapshot_e_attrs)
+            __remove_old_snapshots(snapshot_dir, graph_file)
+            if log: log.info(f'Wrote graph snapshot: {snapshot_dir}')
+        except Exception:
+            if log: log.warning(f'Failed to write graph snapshot {snapshot_dir}')
+            return read_graphml_columns(graph_file, n_attrs=n_attrs, e_attrs=e_attrs, log=log)
+    try:
+        columns = read_snapshot_columns(snapshot_dir, n_attrs=n_attrs, e_attrs=e_attrs)
+        if log: log.info(f'Loaded graph columns from snapshot: {snapshot_dir}')
+        return columns
+    except Exception:
+        if log: log.warning(f'Failed to read graph snapshot {snapshot_dir}')
+        return read_graphml_columns(graph_file, n_attrs=n_attrs, e_attrs=e_attrs, log=log)
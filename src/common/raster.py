@@ -0,0 +1,132 @@
+"""Utilities for passing single band rasters between processing steps in memory (also between processes via 
+shared memory) and for reading and writing them as GeoTIFF files.
+
+"""
+
+from multiprocessing import shared_memory
+from typing import List, NamedTuple, Optional
+import numpy as np
+import rasterio
+from affine import Affine
+from common.update_publisher import write_atomically
+
+
+class RasterBand(NamedTuple):
+    """A single raster band with its georeferencing.
+
+    Attributes:
+        name: The name of the raster (e.g. the name of the corresponding GeoTIFF file aqi_2019-11-08T14.tif).
+        band: A 2D array of the values of the raster.
+        transform: An affine transform from pixel coordinates (col, row) to the coordinates of the CRS.
+        crs: The coordinate reference system of the raster (e.g. 'epsg:4326').
+    """
+    name: str
+    band: np.ndarray
+    transform: Affine
+    crs: object
+
+
+class RasterStack(NamedTuple):
+    """A stack of raster bands of the same grid (e.g. the hourly time steps of a forecast) with its georeferencing.
+
+    Attributes:
+        names: The names of the bands (e.g. aqi_2019-11-08T14.tif, aqi_2019-11-08T15.tif, ...).
+        bands: A 3D array of the values of the bands (band, row, col).
+        transform: An affine transform from pixel coordinates (col, row) to the coordinates of the CRS.
+        crs: The coordinate reference system of the raster (e.g. 'epsg:4326').
+    """
+    names: List[str]
+    bands: np.ndarray
+    transform: Affine
+    crs: object
+
+    def get_band(self, index: int) -> RasterBand:
+        return RasterBand(self.names[index], self.bands[index], self.transform, self.crs)
+
+
+class SharedArray(NamedTuple):
+    """A reference to an array in shared memory, which can be sent to another process instead of the array.
+
+    Attributes:
+        name: The name of the shared memory block.
+        shape: The shape of the array.
+        dtype: The data type of the array (e.g. '<f4').
+    """
+    name: str
+    shape: tuple
+    dtype: str
+
+
+def __get_band_field(value) -> Optional[str]:
+    """Returns the name of the field of the values of a raster (RasterBand or RasterStack), or None if the value
+    is not a raster.
+    """
+    fields = getattr(value, '_fields', ())
+    return 'band' if 'band' in fields else 'bands' if 'bands' in fields else None
+
+
+def share_rasters(value, shared_memories: list):
+    """Copies the values of the rasters in a value (a raster or a dict of rasters) to shared memory and returns the
+    value with the values of the rasters replaced by references to the shared memory (SharedArray). The created
+    shared memory blocks are appended to shared_memories, to be closed and unlinked by the caller once the 
+    rasters are no longer needed by other processes.
+    """
+    if (isinstance(value, dict)):
+        return { key: share_rasters(item, shared_memories) for key, item in value.items() }
+    band_field = __get_band_field(value)
+    if (band_field is None):
+        return value
+    array = np.ascontiguousarray(getattr(value, band_field))
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_memories.append(shm)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return value._replace(**{ band_field: SharedArray(shm.name, array.shape, array.dtype.str) })
+
+
+def attach_rasters(value, shared_memories: list):
+    """Returns a value (a raster or a dict of rasters) shared by share_rasters() with the references to shared memory
+    replaced by (read-only) arrays in the shared memory. The attached shared memory blocks are appended to 
+    shared_memories, to be closed by the caller once the arrays are no longer used.
+    """
+    if (isinstance(value, dict)):
+        return { key: attach_rasters(item, shared_memories) for key, item in value.items() }
+    band_field = __get_band_field(value)
+    if (band_field is None or not isinstance(getattr(value, band_field), SharedArray)):
+        return value
+    shared_array = getattr(value, band_field)
+    shm = shared_memory.SharedMemory(name=shared_array.name)
+    shared_memories.append(shm)
+    array = np.ndarray(shared_array.shape, dtype=shared_array.dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return value._replace(**{ band_field: array })
+
+
+def read_raster_band(filepath: str, name: str = None) -> RasterBand:
+    """Reads the first band of a raster file to a RasterBand object.
+    """
+    with rasterio.open(filepath) as raster:
+        return RasterBand(
+            name if name else filepath.split('/')[-1],
+            raster.read(1),
+            raster.transform,
+            raster.crs
+        )
+
+
+def write_raster_band(filepath: str, raster: RasterBand) -> None:
+    """Writes a RasterBand object to a GeoTIFF file (atomically).
+    """
+    def write_tmp_file(tmp_filepath: str):
+        with rasterio.open(
+            tmp_filepath,
+            'w',
+            driver='GTiff',
+            height=raster.band.shape[0],
+            width=raster.band.shape[1],
+            count=1,
+            dtype=raster.band.dtype,
+            transform=raster.transform,
+            crs=raster.crs
+        ) as out_raster:
+            out_raster.write(raster.band, 1)
+    write_atomically(filepath, write_tmp_file)
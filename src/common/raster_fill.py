@@ -0,0 +1,118 @@
+"""Nodata filling of rasters with a reusable fill plan.
+
+The nodata area of a raster series (e.g. sea and the area outside the model domain in hourly AQI rasters) is
+often the same from hour to hour. NodataFiller computes once per nodata mask the source pixels and weights
+from which each nodata pixel is interpolated and caches them as a fill plan. Filling a band with the same
+nodata mask is then a cheap gather and weighted sum. The plan is recomputed automatically if the mask changes.
+
+The interpolation is the same as that of rasterio.fill.fillnodata (GDALFillNodata without smoothing): each
+nodata pixel gets an inverse distance weighted mean of the valid pixels found by a four direction cone search
+(one pixel per quadrant) within max_search_distance pixels. Nodata pixels without any valid pixels within the
+distance are left as is.
+
+"""
+
+import hashlib
+from typing import Tuple
+import numpy as np
+
+
+def get_mask_key(nodata_mask: np.ndarray) -> str:
+    """Returns a hash that identifies a nodata mask by its shape and values.
+    """
+    mask_bits = np.packbits(nodata_mask, axis=None).tobytes()
+    return hashlib.sha1(repr(nodata_mask.shape).encode('utf-8') + mask_bits).hexdigest()
+
+
+class NodataFiller:
+    """NodataFiller fills nodata pixels of rasters by a fill plan that is cached for the latest nodata mask.
+
+    Attributes:
+        max_search_distance: The maximum distance (in pixels) to search for valid pixels to interpolate from.
+        __mask_key: The key of the nodata mask for which the fill plan was computed.
+        __targets: Flat indexes of the nodata pixels that can be filled.
+        __sources: Flat indexes of the source pixels of the targets (targets x 4 quadrants).
+        __weights: Normalized weights of the source pixels (targets x 4 quadrants).
+    """
+
+    def __init__(self, max_search_distance: float = 100):
+        self.max_search_distance = max_search_distance
+        self.__mask_key = None
+        self.__targets = None
+        self.__sources = None
+        self.__weights = None
+
+    def fill(self, band: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
+        """Returns a copy of the band in which the pixels of the nodata mask (True = nodata) are filled by
+        interpolating values from the surrounding valid pixels. A stack of bands (band, row, col) with the same 
+        nodata mask (row, col) is filled at once.
+        """
+        targets, sources, weights = self.get_fill_plan(nodata_mask)
+        band_fillna = band.copy()
+        band_values = band.reshape(band.shape[:-2] + (-1,))
+        band_fillna.reshape(band_values.shape)[..., targets] = (band_values[..., sources] * weights).sum(axis=-1)
+        return band_fillna
+
+    def get_fill_plan(self, nodata_mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the (cached) fill plan of the nodata mask as arrays of target pixels, source pixels and weights
+        (as flat indexes to the raster).
+        """
+        mask_key = get_mask_key(nodata_mask)
+        if (self.__mask_key != mask_key):
+            self.__targets, self.__sources, self.__weights = self.__compute_fill_plan(nodata_mask)
+            self.__mask_key = mask_key
+        return (self.__targets, self.__sources, self.__weights)
+
+    def __compute_fill_plan(self, nodata_mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Finds the nearest valid pixel in each quadrant of each nodata pixel by the four direction cone search
+        of GDALFillNodata: the candidates of a quadrant are the nearest valid pixels above and below the nodata
+        pixel in each column on its side, scanned outwards column by column until no nearer pixel can be found.
+        Of candidates at equal distance, the one in the nearest column is kept (as in GDAL).
+        """
+        rows, cols = nodata_mask.shape
+        nodata_rows, nodata_cols = np.nonzero(nodata_mask)
+        if (len(nodata_rows) == 0 or nodata_mask.all()):
+            return (np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.int64), np.zeros((0, 4)))
+
+        # the row of the nearest valid pixel above (or on) and below each row in each column (-1 if none)
+        row_indexes = np.arange(rows)[:, None]
+        valid_above = np.maximum.accumulate(np.where(nodata_mask, -1, row_indexes), axis=0)
+        valid_below = np.minimum.accumulate(np.where(nodata_mask, rows, row_indexes)[::-1], axis=0)[::-1]
+        valid_below = np.vstack([valid_below[1:], np.full((1, cols), rows)])
+        valid_below = np.where(valid_below == rows, -1, valid_below)
+
+        max_step = int(np.floor(self.max_search_distance))
+        distances = np.full((len(nodata_rows), 4), self.max_search_distance + 1, dtype=np.float64)
+        sources = np.zeros((len(nodata_rows), 4), dtype=np.int64)
+        searching = np.arange(len(nodata_rows))
+        for step in range(max_step + 1):
+            # candidates at the step are at least step pixels away, so the search of a pixel ends when all
+            # of its quadrants have a nearer source
+            searching = searching[step <= np.floor(distances[searching].max(axis=1))]
+            if (len(searching) == 0):
+                break
+            target_rows = nodata_rows[searching]
+            target_cols = nodata_cols[searching]
+            left_cols = np.maximum(target_cols - step, 0)
+            right_cols = np.minimum(target_cols + step, cols - 1)
+            quadrant_candidates = [(0, left_cols, valid_above), (1, left_cols, valid_below)]
+            if (step > 0):
+                quadrant_candidates += [(2, right_cols, valid_above), (3, right_cols, valid_below)]
+            for quadrant, candidate_cols, valid_rows in quadrant_candidates:
+                candidate_rows = valid_rows[target_rows, candidate_cols]
+                distance_sq = (
+                    (candidate_cols - target_cols).astype(np.float64) ** 2 +
+                    (candidate_rows - target_rows).astype(np.float64) ** 2
+                )
+                nearer = (candidate_rows >= 0) & (distance_sq < distances[searching, quadrant] ** 2)
+                distances[searching[nearer], quadrant] = np.sqrt(distance_sq[nearer])
+                sources[searching[nearer], quadrant] = candidate_rows[nearer] * cols + candidate_cols[nearer]
+
+        # inverse distance weights of the sources within the maximum search distance
+        found = distances <= self.max_search_distance
+        weights = np.where(found, 1 / distances, 0)
+        sources = np.where(found, sources, 0)
+        weight_sums = weights.sum(axis=1)
+        fillable = weight_sums > 0
+        targets = nodata_rows[fillable] * cols + nodata_cols[fillable]
+        return (targets, sources[fillable], weights[fillable] / weight_sums[fillable, None])
@@ -0,0 +1,223 @@
+"""Raster sampling utilities for joining raster (e.g. AQI) values to a fixed set of graph features.
+
+The samplers precompute the mapping from sampling locations to raster pixels once per raster grid
+and reuse it for every raster that shares the same grid (transform and shape). Hence sampling a new
+band of the same grid (e.g. the AQI of the next hour) is a cheap NumPy array operation.
+
+PointSampler samples a single pixel per feature (e.g. at the center point of an edge), whereas LineSampler 
+computes length-weighted averages of all pixels that each line crosses. 
+
+"""
+
+import hashlib
+import os
+from typing import Tuple
+import numpy as np
+import shapely
+from affine import Affine
+from scipy import sparse
+
+
+def get_grid_key(transform: Affine, shape: Tuple[int, int]) -> tuple:
+    """Returns a hashable key that identifies a raster grid by its transform and shape.
+    """
+    return (tuple(transform)[:6], tuple(shape))
+
+
+class PointSampler:
+    """PointSampler samples raster values at a fixed set of points (e.g. center points of edges).
+
+    The (row, col) pixel index of each point is computed once for a raster grid and cached. The pixel index
+    is recomputed only if a band of a different grid (transform or shape) is sampled.
+
+    Attributes:
+        xs: An array of x coordinates of the sampling points (in the CRS of the raster).
+        ys: An array of y coordinates of the sampling points (in the CRS of the raster).
+        __grid_key: The key of the raster grid for which the pixel index was computed.
+        __rows: Row indexes of the sampling points (only valid where __inside is True).
+        __cols: Column indexes of the sampling points (only valid where __inside is True).
+        __inside: A boolean mask of sampling points that are within the raster grid.
+    """
+
+    def __init__(self, xs: np.ndarray, ys: np.ndarray, digits: int = 6):
+        self.xs = np.round(np.asarray(xs, dtype=np.float64), digits)
+        self.ys = np.round(np.asarray(ys, dtype=np.float64), digits)
+        self.__grid_key = None
+        self.__rows = None
+        self.__cols = None
+        self.__inside = None
+
+    def get_pixel_index(self, transform: Affine, shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the (cached) row and column indexes of the sampling points in the given raster grid,
+        as well as a mask of points that fall within the grid.
+        """
+        grid_key = get_grid_key(transform, shape)
+        if (self.__grid_key != grid_key):
+            cols, rows = ~transform * (self.xs, self.ys)
+            rows = np.floor(rows).astype(np.int64)
+            cols = np.floor(cols).astype(np.int64)
+            self.__inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+            self.__rows = np.where(self.__inside, rows, 0)
+            self.__cols = np.where(self.__inside, cols, 0)
+            self.__grid_key = grid_key
+        return (self.__rows, self.__cols, self.__inside)
+
+    def sample(self, band: np.ndarray, transform: Affine) -> np.ndarray:
+        """Returns the values of the band at the sampling points as float64 array. Points outside the raster
+        get value nan. A stack of bands (band, row, col) of the same grid is sampled at once, in which case 
+        the values are returned as a (point, band) array.
+        """
+        rows, cols, inside = self.get_pixel_index(transform, band.shape[-2:])
+        values = band[..., rows, cols].astype(np.float64)
+        values[..., ~inside] = np.nan
+        return values.T
+
+
+class LineSampler:
+    """LineSampler samples length-weighted mean raster values along a fixed set of lines (e.g. edge geometries).
+
+    Each line is intersected with the raster grid once and the result is stored as a sparse matrix of
+    weights (lines x pixels), where each weight is the share of the length of the line within the pixel.
+    Sampling a band is then a single sparse matrix-vector product. The weight matrix is cached in memory
+    and optionally on disk (as .npz), keyed by a hash of the line geometries and the raster grid. 
+    Parts of lines that fall outside the raster are ignored. Lines entirely outside the raster get value nan.
+
+    Attributes:
+        geometry_hash: A hash of the coordinates of the lines, used in the names of the cache files.
+        __coords: An array of the coordinates of all lines.
+        __line_index: An array of line indexes of the coordinates.
+        __line_count: The number of lines.
+        __geographic: A boolean variable indicating whether the coordinates are geographic (lon, lat) degrees,
+            in which case lengths of segments are scaled by latitude.
+        __cache_dir: A directory for caching weight matrices (or None for in-memory caching only).
+        __grid_key: The key of the raster grid for which the current weight matrix was computed.
+        __weights: A sparse weight matrix (CSR) with a row for each line and a column for each pixel.
+        __has_weights: A boolean mask of lines that have any weights (i.e. that overlap the raster).
+    """
+
+    def __init__(self, geoms: np.ndarray, cache_dir: str = None, geographic: bool = True):
+        geoms = np.asarray(geoms, dtype=object)
+        self.__coords, self.__line_index = shapely.get_coordinates(geoms, return_index=True)
+        self.__line_count = len(geoms)
+        self.__geographic = geographic
+        self.__cache_dir = cache_dir
+        self.geometry_hash = hashlib.sha1(self.__coords.tobytes() + self.__line_index.tobytes()).hexdigest()
+        self.__grid_key = None
+        self.__weights = None
+        self.__has_weights = None
+
+    def get_weight_matrix(self, transform: Affine, shape: Tuple[int, int]) -> sparse.csr_matrix:
+        """Returns the (cached) weight matrix of the lines for the given raster grid. The matrix is read from
+        the cache directory if it exists there, else it is computed (and written to the cache directory).
+        """
+        grid_key = get_grid_key(transform, shape)
+        if (self.__grid_key == grid_key):
+            return self.__weights
+        
+        cache_file = self.__get_cache_file(grid_key)
+        weights = None
+        if cache_file and os.path.exists(cache_file):
+            try:
+                weights = sparse.load_npz(cache_file).tocsr()
+            except Exception:
+                weights = None
+        if weights is None or weights.shape != (self.__line_count, shape[0] * shape[1]):
+            weights = self.__compute_weight_matrix(transform, shape)
+            if cache_file:
+                os.makedirs(self.__cache_dir, exist_ok=True)
+                # the cache may be written by several processes at once (e.g. by the workers of a backfill)
+                tmp_file = cache_file[:-4] + f'.{os.getpid()}.tmp.npz'
+                sparse.save_npz(tmp_file, weights)
+                os.replace(tmp_file, cache_file)
+
+        self.__weights = weights
+        self.__has_weights = np.diff(weights.indptr) > 0
+        self.__grid_key = grid_key
+        return weights
+
+    def sample(self, band: np.ndarray, transform: Affine) -> np.ndarray:
+        """Returns the length-weighted mean values of the band along the lines as float64 array. A stack of bands
+        (band, row, col) of the same grid is sampled at once (as a single sparse matrix product), in which case
+        the values are returned as a (line, band) array.
+        """
+        weights = self.get_weight_matrix(transform, band.shape[-2:])
+        values = weights @ band.reshape(band.shape[:-2] + (-1,)).astype(np.float64).T
+        values[~self.__has_weights] = np.nan
+        return values
+
+    def __get_cache_file(self, grid_key: tuple) -> str:
+        if not self.__cache_dir:
+            return None
+        grid_hash = hashlib.sha1(repr(grid_key).encode('utf-8')).hexdigest()
+        return os.path.join(self.__cache_dir, f'line_weights_{self.geometry_hash[:16]}_{grid_hash[:16]}.npz')
+
+    def __compute_weight_matrix(self, transform: Affine, shape: Tuple[int, int]) -> sparse.csr_matrix:
+        """Splits all line segments at the pixel boundaries of the raster grid and returns a sparse matrix 
+        of the lengths of the pieces per pixel, normalized by the total length of each line within the grid. 
+        Lines of zero length are assigned to the pixel of their first vertex.
+        """
+        # segments are pairs of consecutive coordinates of the same line
+        seg_mask = self.__line_index[:-1] == self.__line_index[1:]
+        seg_line = self.__line_index[:-1][seg_mask]
+        start = self.__coords[:-1][seg_mask]
+        end = self.__coords[1:][seg_mask]
+
+        # segment coordinates and lengths in pixel space
+        c0, r0 = ~transform * (start[:, 0], start[:, 1])
+        c1, r1 = ~transform * (end[:, 0], end[:, 1])
+        dx = end[:, 0] - start[:, 0]
+        dy = end[:, 1] - start[:, 1]
+        if self.__geographic:
+            dx = dx * np.cos(np.radians((start[:, 1] + end[:, 1]) / 2))
+        seg_length = np.hypot(dx, dy)
+
+        # relative positions (0-1) of all pixel boundary crossings along the segments
+        seg_ids = [np.arange(len(seg_line)), np.arange(len(seg_line))]
+        seg_ts = [np.zeros(len(seg_line)), np.ones(len(seg_line))]
+        for p0, p1 in [(c0, c1), (r0, r1)]:
+            first = np.floor(np.minimum(p0, p1)).astype(np.int64) + 1
+            counts = np.abs(np.floor(p1).astype(np.int64) - np.floor(p0).astype(np.int64))
+            cross_seg = np.repeat(np.arange(len(seg_line)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            boundary = first[cross_seg] + offsets
+            seg_ids.append(cross_seg)
+            seg_ts.append((boundary - p0[cross_seg]) / (p1 - p0)[cross_seg])
+        seg_ids = np.concatenate(seg_ids)
+        seg_ts = np.clip(np.concatenate(seg_ts), 0, 1)
+        order = np.lexsort((seg_ts, seg_ids))
+        seg_ids = seg_ids[order]
+        seg_ts = seg_ts[order]
+
+        # pieces of segments between consecutive crossings, located by their midpoints
+        piece_mask = (seg_ids[:-1] == seg_ids[1:]) & (seg_ts[1:] > seg_ts[:-1])
+        piece_seg = seg_ids[:-1][piece_mask]
+        t0 = seg_ts[:-1][piece_mask]
+        t_mid = (t0 + seg_ts[1:][piece_mask]) / 2
+        piece_length = (seg_ts[1:][piece_mask] - t0) * seg_length[piece_seg]
+        rows = np.floor(r0[piece_seg] + t_mid * (r1 - r0)[piece_seg]).astype(np.int64)
+        cols = np.floor(c0[piece_seg] + t_mid * (c1 - c0)[piece_seg]).astype(np.int64)
+        lines = seg_line[piece_seg]
+
+        # lines of zero length are assigned to the pixel of their first vertex
+        line_length = np.bincount(lines, weights=piece_length, minlength=self.__line_count)
+        line_ids = np.arange(self.__line_count)
+        first_vertex = np.minimum(np.searchsorted(self.__line_index, line_ids), len(self.__line_index) - 1)
+        zero_lines = np.flatnonzero((line_length == 0) & (self.__line_index[first_vertex] == line_ids))
+        zero_cols, zero_rows = ~transform * (self.__coords[first_vertex[zero_lines], 0], self.__coords[first_vertex[zero_lines], 1])
+        valid = piece_length > 0
+        lines = np.concatenate([lines[valid], zero_lines])
+        rows = np.concatenate([rows[valid], np.floor(zero_rows).astype(np.int64)])
+        cols = np.concatenate([cols[valid], np.floor(zero_cols).astype(np.int64)])
+        piece_length = np.concatenate([piece_length[valid], np.ones(len(zero_lines))])
+
+        # drop pieces outside the grid and normalize weights by the length of each line within the grid
+        inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        lines = lines[inside]
+        piece_length = piece_length[inside]
+        pixels = rows[inside] * shape[1] + cols[inside]
+        line_length = np.bincount(lines, weights=piece_length, minlength=self.__line_count)
+        weights = sparse.coo_matrix(
+            (piece_length / line_length[lines], (lines, pixels)), 
+            shape=(self.__line_count, shape[0] * shape[1])
+        )
+        return weights.tocsr()
@@ -0,0 +1,179 @@
+"""Atomic versioned publishing of update files to a directory shared with update consumers.
+
+Files are written atomically (see write_atomically). Once all files of an update (version) are written, 
+the version is added to manifest.json in the same directory. Consumers can poll the (small) manifest to find the latest version
+and its files, instead of listing the directory or re-reading the large files. Only the files of the latest
+keep_versions versions are kept, so that the files of the previous version(s) do not vanish from under
+a reader that is still reading them. Files with a fixed name that is overwritten by every version (e.g.
+aqi_map.json) are not part of the versions but listed in latest_files, as they only hold for the latest one.
+
+Example manifest.json:
+    {
+        "latest": "aqi_2020-10-10T09",
+        "updated": "2020-10-10T09:05:12Z",
+        "latest_files": {
+            "aqi_map.json": { "sha256": "...", "bytes": 39373 }
+        },
+        "versions": [
+            {
+                "version": "aqi_2020-10-10T09",
+                "published": "2020-10-10T09:05:12Z",
+                "files": {
+                    "aqi_2020-10-10T09.csv": { "sha256": "...", "bytes": 87908, "rows": 8994 }
+                }
+            },
+            ...
+        ]
+    }
+
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Callable, Dict, IO, List
+from common.logger import Logger
+
+
+def get_file_sha256(filepath: str, chunk_size: int = 2**20) -> str:
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_utc_timestamp() -> str:
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def write_atomically(filepath: str, write: Callable[[str], None]) -> None:
+    """Writes a file by calling write with a temporary filepath (filepath + '.tmp') and then renaming the
+    temporary file to filepath. As the rename is atomic, a reader of filepath never sees a partially written
+    file, but either the previous or the new one (also if the writing fails or the process is killed midway).
+    """
+    tmp_filepath = filepath + '.tmp'
+    write(tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+
+
+class UpdatePublisher:
+    """UpdatePublisher writes update files atomically and maintains a manifest of the published versions.
+
+    Attributes:
+        log: An instance of Logger class for writing log messages.
+        publish_dir: The directory to which the files and the manifest are published.
+        keep_versions: The number of latest versions whose files are kept.
+        manifest: The current manifest (latest version, update time, files of the latest version only and the kept
+            versions, latest first).
+        __file_extensions: Extensions of versioned update files (other files of the directory are never removed).
+        __pending_files: Names and metadata of the files written after the latest published version.
+        __pending_latest_files: Names and metadata of the fixed name files written after the latest published version.
+    """
+
+    def __init__(
+        self,
+        log: Logger,
+        publish_dir: str,
+        keep_versions: int = 2,
+        file_extensions: List[str] = ['.csv', '.parquet', '.npy']
+    ):
+        self.log = log
+        self.publish_dir = publish_dir
+        self.keep_versions = max(keep_versions, 1)
+        self.__file_extensions = file_extensions
+        self.__pending_files: Dict[str, dict] = {}
+        self.__pending_latest_files: Dict[str, dict] = {}
+        self.manifest: dict = self.__read_manifest()
+
+    def write_file(
+        self, 
+        filename: str, 
+        write: Callable[[IO], None], 
+        text: bool = False, 
+        rows: int = None, 
+        include_in_version: bool = True,
+        latest_only: bool = False
+    ) -> None:
+        """Writes a file to the publish directory (atomically) with the given function (that takes a file object).
+        The file will be included in the next published version (if include_in_version is True),
+        or only in the latest files of the manifest (if latest_only is True, for files with a fixed name).
+        """
+        file_meta = {}
+        def write_tmp_file(tmp_filepath: str):
+            with (open(tmp_filepath, 'w', newline='') if text else open(tmp_filepath, 'wb')) as f:
+                write(f)
+            file_meta.update(sha256=get_file_sha256(tmp_filepath), bytes=os.path.getsize(tmp_filepath))
+        write_atomically(os.path.join(self.publish_dir, filename), write_tmp_file)
+        if (rows is not None):
+            file_meta['rows'] = int(rows)
+        if (latest_only):
+            self.__pending_latest_files[filename] = file_meta
+        elif (include_in_version):
+            self.__pending_files[filename] = file_meta
+
+    def publish(self, version: str, **info) -> dict:
+        """Publishes the files written since the previous version as a new version by adding it to the manifest
+        (with any additional info). Fixed name files that were not rewritten for the version keep their previous
+        entries in the latest files. Returns the manifest entry of the version.
+        """
+        published = get_utc_timestamp()
+        entry = { 'version': version, 'published': published, **info, 'files': self.__pending_files }
+        versions = [v for v in self.manifest.get('versions', []) if v['version'] != version]
+        latest_files = { **self.manifest.get('latest_files', {}), **self.__pending_latest_files }
+        self.manifest = {
+            'latest': version,
+            'updated': published,
+            **({ 'latest_files': latest_files } if latest_files else {}),
+            'versions': ([entry] + versions)[:self.keep_versions]
+        }
+        self.__write_manifest()
+        self.__pending_files = {}
+        self.__pending_latest_files = {}
+        self.log.info(f'Published version {version} to {self.publish_dir}manifest.json')
+        return entry
+
+    def get_latest_version(self) -> str:
+        return self.manifest.get('latest', '')
+
+    def remove_old_files(self, keep_files: List[str] = []) -> None:
+        """Removes update files (by file_extensions) that do not belong to the kept versions. Files with the same
+        name as keep_files (regardless of the extension) are also kept. Unpublished files are removed as well.
+        """
+        self.__pending_files = {}
+        self.__pending_latest_files = {}
+        kept_files = set(file_n for version in self.manifest.get('versions', []) for file_n in version['files'])
+        keep_names = set(os.path.splitext(file_n)[0] for file_n in keep_files)
+        rm_count = 0
+        error_count = 0
+        for file_n in os.listdir(self.publish_dir):
+            name, ext = os.path.splitext(file_n)
+            if (ext in self.__file_extensions and file_n not in kept_files and name not in keep_names):
+                try:
+                    os.remove(os.path.join(self.publish_dir, file_n))
+                    rm_count += 1
+                except Exception:
+                    error_count += 1
+        self.log.info(f'Removed {rm_count} old update files')
+        if (error_count > 0):
+            self.log.warning(f'Could not remove {error_count} old update files')
+
+    def __get_manifest_filepath(self) -> str:
+        return os.path.join(self.publish_dir, 'manifest.json')
+
+    def __read_manifest(self) -> dict:
+        if (not os.path.exists(self.__get_manifest_filepath())):
+            return {}
+        try:
+            with open(self.__get_manifest_filepath()) as f:
+                return json.load(f)
+        except Exception:
+            self.log.warning(f'Could not read {self.__get_manifest_filepath()}')
+            return {}
+
+    def __write_manifest(self) -> None:
+        def write_manifest(tmp_filepath: str):
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.manifest, f, indent=2)
+        write_atomically(self.__get_manifest_filepath(), write_manifest)
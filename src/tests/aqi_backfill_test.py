@@ -0,0 +1,83 @@
+import pytest
+from ..aqi_updater.aqi_backfill import AqiBackfill, get_backfill_hours
+from ..common.logger import Logger
+import os
+from datetime import datetime
+from functools import partial
+from botocore.exceptions import ClientError
+
+
+log = Logger(printing=False)
+
+
+class FakeFetcher:
+    """Fails to process the data of the hours in failing_hours and finds no data of the hours in missing_hours.
+    """
+    def __init__(self, missing_hours: list = [], failing_hours: list = [], bounds=None):
+        self.missing_hours = missing_hours
+        self.failing_hours = failing_hours
+        self.bounds = bounds
+        self.latest_aqi_tif = ''
+        self.latest_aqi_raster = None
+        self.latest_pollutant_rasters = {}
+    def fetch_process_aqi_data(self, aqi_hour: datetime):
+        if (aqi_hour.hour in self.missing_hours):
+            raise ClientError({ 'Error': { 'Code': '404' } }, 'GetObject')
+        if (aqi_hour.hour in self.failing_hours):
+            raise RuntimeError('processing failed')
+        self.latest_aqi_tif = 'aqi_'+ aqi_hour.strftime('%Y-%m-%dT%H') +'.tif'
+        self.latest_aqi_raster = self.bounds
+    def finish_aqi_fetch(self):
+        pass
+
+
+class FakeUpdater:
+    def __init__(self, aqi_updates: str):
+        self.aqi_updates = aqi_updates
+    def get_sampling_bounds(self):
+        return (24.9, 60.2, 25.0, 60.3)
+    def full_update_exists(self, aqi_tif_name: str) -> bool:
+        return os.path.exists(self.aqi_updates + aqi_tif_name.replace('.tif', '.csv'))
+    def create_aqi_update_csv(self, aqi_tif_name: str, aqi_raster=None, pollutant_rasters={}, publish=True):
+        assert not publish
+        # the fetcher is created with the sampling bounds of the updater
+        assert aqi_raster == self.get_sampling_bounds()
+        with open(self.aqi_updates + aqi_tif_name.replace('.tif', '.csv'), 'w') as f:
+            f.write(str(os.getpid()))
+
+
+def test_get_backfill_hours():
+    hours = get_backfill_hours(datetime(2020, 10, 10, 22, 30), datetime(2020, 10, 11, 1))
+    assert hours == [datetime(2020, 10, 10, 22), datetime(2020, 10, 10, 23), datetime(2020, 10, 11, 0)]
+    assert get_backfill_hours(datetime(2020, 10, 10, 22), datetime(2020, 10, 10, 22)) == []
+
+
+def test_hours_are_backfilled_in_worker_processes(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_backfill = AqiBackfill(
+        log,
+        partial(FakeFetcher, missing_hours=[3], failing_hours=[5]),
+        partial(FakeUpdater, aqi_updates),
+        processes=2,
+        max_pending=3
+    )
+    counts = aqi_backfill.run(datetime(2020, 10, 10, 0), datetime(2020, 10, 10, 8))
+    assert counts == { 'done': 6, 'skipped': 0, 'missing': 1, 'failed': 1 }
+    assert sorted(os.listdir(aqi_updates)) == [f'aqi_2020-10-10T{hour:02d}.csv' for hour in [0, 1, 2, 4, 6, 7]]
+    worker_pids = set(open(aqi_updates + file_n).read() for file_n in os.listdir(aqi_updates))
+    assert str(os.getpid()) not in worker_pids
+    failed = [result for result in aqi_backfill.results if result['status'] == 'failed']
+    assert failed[0]['aqi_tif'] == 'aqi_2020-10-10T05.tif'
+    assert 'processing failed' in failed[0]['error']
+
+
+def test_backfill_is_resumed(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    AqiBackfill(log, partial(FakeFetcher, failing_hours=[1]), partial(FakeUpdater, aqi_updates), processes=2).run(
+        datetime(2020, 10, 10, 0), datetime(2020, 10, 10, 3)
+    )
+    # only the failed hour is processed again
+    counts = AqiBackfill(log, FakeFetcher, partial(FakeUpdater, aqi_updates), processes=2).run(
+        datetime(2020, 10, 10, 0), datetime(2020, 10, 10, 3)
+    )
+    assert counts == { 'done': 1, 'skipped': 2, 'missing': 0, 'failed': 0 }
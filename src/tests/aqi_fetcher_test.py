@@ -0,0 +1,237 @@
+import pytest
+from ..aqi_updater.aqi_fetcher import AqiFetcher
+from ..common.logger import Logger
+import os
+import io
+import zipfile
+import boto3
+import numpy as np
+import xarray
+from datetime import datetime, timedelta
+from moto import mock_aws
+
+
+log = Logger(printing=False)
+s3_bucketname = 'enfusernow2'
+
+
+def create_enfuser_zip(tmp_path, date_str: str, padding_size: int = 0, steps: int = 1, clean_air: float = None) -> bytes:
+    """Creates an Enfuser like zip archive with AQI (nodata = 1.0 in 3/4 of the columns) and NO2 layers of hourly
+    time steps (AQI = 2.0 + step). Optionally adds a padding file to the archive for testing downloads of larger archives.
+    If clean_air is given, AQI of the area east of longitude 25.0 is set to it (without nodata).
+    """
+    lats = np.arange(60.30, 60.10, -0.0004)
+    lons = np.arange(24.80, 25.20, 0.0008)
+    aqi = np.full((steps, len(lats), len(lons)), 2.0, dtype='float32') + np.arange(steps, dtype='float32')[:, None, None]
+    aqi[:, :, np.arange(len(lons)) % 4 != 0] = 1.0
+    if clean_air:
+        aqi[:, :, lons >= 25.0] = clean_air
+    times = np.datetime64(date_str) + np.arange(steps) * np.timedelta64(1, 'h')
+    data = xarray.Dataset(
+        { 'AQI': (('time', 'latitude', 'longitude'), aqi), 'NO2': (('time', 'latitude', 'longitude'), aqi * 10) },
+        coords={ 'time': times, 'latitude': lats, 'longitude': lons }
+    )
+    nc_file = str(tmp_path / f'allPollutants_{date_str}.nc')
+    data.to_netcdf(nc_file)
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.write(nc_file, f'allPollutants_{date_str}.nc')
+        if padding_size:
+            archive.writestr('padding.bin', np.random.default_rng(0).bytes(padding_size), compress_type=zipfile.ZIP_STORED)
+    os.remove(nc_file)
+    return zip_buffer.getvalue()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('ENFUSER_S3_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('ENFUSER_S3_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        client = boto3.client('s3', region_name='eu-central-1')
+        client.create_bucket(
+            Bucket=s3_bucketname, 
+            CreateBucketConfiguration={ 'LocationConstraint': 'eu-central-1' }
+        )
+        yield client
+
+
+def put_current_enfuser_zip(s3, tmp_path, padding_size: int = 0, steps: int = 1, clean_air: float = None) -> str:
+    date_str = datetime.utcnow().strftime('%Y-%m-%dT%H')
+    s3.put_object(
+        Bucket=s3_bucketname, 
+        Key=f'Finland/pks/allPollutants_{date_str}.zip', 
+        Body=create_enfuser_zip(tmp_path, date_str, padding_size, steps, clean_air)
+    )
+    return date_str
+
+
+def test_fetch_process_current_aqi_data(s3, tmp_path):
+    date_str = put_current_enfuser_zip(s3, tmp_path)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/')
+    assert aqi_fetcher.new_aqi_available()
+    aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_fetcher.finish_aqi_fetch()
+    assert aqi_fetcher.latest_aqi_tif == f'aqi_{date_str}.tif'
+    assert os.listdir(tmp_path) == [f'aqi_{date_str}.tif']
+    aqi_band = aqi_fetcher.latest_aqi_raster.band
+    assert aqi_band.shape == (500, 500)
+    # nodata (1.0) is filled with interpolated values
+    assert aqi_band.min() == pytest.approx(2.0)
+    assert not aqi_fetcher.new_aqi_available()
+
+
+def test_aqi_raster_is_cropped_to_bounds(s3, tmp_path):
+    put_current_enfuser_zip(s3, tmp_path)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', bounds=(24.9, 60.18, 25.0, 60.22))
+    aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_fetcher.finish_aqi_fetch()
+    aqi_raster = aqi_fetcher.latest_aqi_raster
+    assert aqi_raster.band.shape == (101, 126)
+    assert aqi_raster.transform.c == pytest.approx(24.9 - 0.0004, abs=0.0004)
+    assert aqi_raster.transform.f == pytest.approx(60.22 + 0.0002, abs=0.0002)
+    assert aqi_raster.band.min() == pytest.approx(2.0)
+
+
+def test_forecast_steps_are_processed_at_once(s3, tmp_path):
+    date_str = put_current_enfuser_zip(s3, tmp_path, steps=3)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', in_memory=True, archive_tif=False, forecast=True)
+    aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_fetcher.finish_aqi_fetch()
+    aqi_forecast = aqi_fetcher.latest_aqi_forecast
+    first_step = datetime.strptime(date_str, '%Y-%m-%dT%H')
+    assert aqi_forecast.names == [
+        'aqi_'+ (first_step + timedelta(hours=step)).strftime('%Y-%m-%dT%H') +'.tif' for step in range(3)
+    ]
+    assert aqi_forecast.bands.shape == (3, 500, 500)
+    # all steps are filled (with the nodata mask of the first step)
+    assert [aqi_forecast.bands[step].min() for step in range(3)] == pytest.approx([2.0, 3.0, 4.0])
+    assert aqi_fetcher.latest_aqi_tif == f'aqi_{date_str}.tif'
+    assert np.array_equal(aqi_fetcher.latest_aqi_raster.band, aqi_forecast.bands[0])
+
+
+def test_only_first_step_is_processed_without_forecast(s3, tmp_path):
+    put_current_enfuser_zip(s3, tmp_path, steps=3)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', in_memory=True, archive_tif=False)
+    aqi_fetcher.fetch_process_current_aqi_data()
+    assert aqi_fetcher.latest_aqi_forecast is None
+    assert aqi_fetcher.latest_aqi_raster.band.max() == pytest.approx(2.0)
+
+
+def test_pollutants_are_processed_with_aqi(s3, tmp_path):
+    date_str = put_current_enfuser_zip(s3, tmp_path)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', in_memory=True, archive_tif=False, pollutants=['NO2', 'PM25'])
+    aqi_fetcher.fetch_process_current_aqi_data()
+    # missing pollutants are skipped
+    assert list(aqi_fetcher.latest_pollutant_rasters) == ['NO2']
+    no2_raster = aqi_fetcher.latest_pollutant_rasters['NO2']
+    assert no2_raster.name == f'no2_{date_str}.tif'
+    assert no2_raster.transform == aqi_fetcher.latest_aqi_raster.transform
+    # pollutants are filled with the nodata mask of AQI
+    assert np.allclose(no2_raster.band, aqi_fetcher.latest_aqi_raster.band * 10)
+
+
+def test_parallel_ranged_download(s3, tmp_path):
+    put_current_enfuser_zip(s3, tmp_path, padding_size=6 * 2**20)
+    aqi_fetcher = AqiFetcher(
+        log, 
+        aqi_dir=str(tmp_path) + '/', 
+        in_memory=True, 
+        archive_tif=False, 
+        download_concurrency=4, 
+        download_chunk_size=2**20
+    )
+    aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_fetcher.finish_aqi_fetch()
+    download_stats = aqi_fetcher.latest_download_stats
+    assert download_stats['bytes'] > 6 * 2**20
+    assert download_stats['mb_per_s'] > 0
+    assert aqi_fetcher.latest_aqi_raster.band.shape == (500, 500)
+    assert os.listdir(tmp_path) == []
+
+
+def test_new_aqi_available_only_when_published(s3, tmp_path):
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/')
+    assert not aqi_fetcher.new_aqi_available()
+    put_current_enfuser_zip(s3, tmp_path)
+    assert aqi_fetcher.new_aqi_available()
+
+
+def test_zip_changed_in_s3_is_refetched_only_if_not_yet_processed(s3, tmp_path):
+    put_current_enfuser_zip(s3, tmp_path)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', in_memory=True, archive_tif=False)
+    def fail_fillna(*args, **kwargs):
+        raise RuntimeError('fill failed')
+    aqi_fetcher._AqiFetcher__fillna_in_raster = fail_fillna
+    assert aqi_fetcher.new_aqi_available()
+    with pytest.raises(RuntimeError):
+        aqi_fetcher.fetch_process_current_aqi_data()
+    download_stats = aqi_fetcher.latest_download_stats
+
+    # the cached results of the failed processing are discarded as the zip file changed
+    put_current_enfuser_zip(s3, tmp_path, clean_air=3.0)
+    del aqi_fetcher._AqiFetcher__fillna_in_raster
+    assert aqi_fetcher.new_aqi_available()
+    aqi_fetcher.fetch_process_current_aqi_data()
+    assert aqi_fetcher.latest_download_stats is not download_stats
+    assert aqi_fetcher.latest_aqi_raster.band.max() == pytest.approx(3.0)
+
+    # only the existence of the zip file of the processed hour is probed
+    put_current_enfuser_zip(s3, tmp_path)
+    assert not aqi_fetcher.new_aqi_available()
+
+
+def test_failed_processing_is_resumed_without_download(s3, tmp_path):
+    date_str = put_current_enfuser_zip(s3, tmp_path)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', spool_max_size=2**10)
+    assert aqi_fetcher.new_aqi_available()
+    fillna_in_raster = aqi_fetcher._AqiFetcher__fillna_in_raster
+    def fail_fillna(*args, **kwargs):
+        raise RuntimeError('fill failed')
+    aqi_fetcher._AqiFetcher__fillna_in_raster = fail_fillna
+    with pytest.raises(RuntimeError):
+        aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_fetcher.finish_aqi_fetch()
+    # extracted nc file is kept for resuming
+    assert f'allPollutants_{date_str}.nc' in os.listdir(tmp_path)
+    download_stats = aqi_fetcher.latest_download_stats
+    
+    aqi_fetcher._AqiFetcher__fillna_in_raster = fillna_in_raster
+    assert aqi_fetcher.new_aqi_available()
+    aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_fetcher.finish_aqi_fetch()
+    assert aqi_fetcher.latest_download_stats is download_stats
+    assert aqi_fetcher.latest_aqi_tif == f'aqi_{date_str}.tif'
+    assert os.listdir(tmp_path) == [f'aqi_{date_str}.tif']
+
+
+def test_nodata_threshold_with_offset():
+    aqi_fetcher = AqiFetcher(log, nodata_share=0.5)
+    aqi_band = np.full((100, 100), 2.0, dtype='float32')
+    aqi_band[:, :60] = 1.015
+    aqi_band[0, 60:] = 1.05
+    nodata_threshold = aqi_fetcher._AqiFetcher__get_nodata_threshold(aqi_band)
+    assert (aqi_band <= nodata_threshold).sum() == 6000
+    assert not (aqi_band[0, 60:] <= nodata_threshold).any()
+    # nodata count of the previous raster is used as the expected count
+    assert aqi_fetcher._AqiFetcher__get_expected_nodata_count((100, 100)) == 5400
+    assert aqi_fetcher._AqiFetcher__get_expected_nodata_count((200, 100)) == 10000
+
+
+def test_clean_air_is_not_nodata_if_expected_nodata_is_not_found():
+    aqi_fetcher = AqiFetcher(log, nodata_share=0.8)
+    aqi_band = np.full((100, 100), 2.0, dtype='float32')
+    aqi_band[:, :10] = 1.0
+    aqi_band[:, 10:60] = 1.05
+    nodata_threshold = aqi_fetcher._AqiFetcher__get_nodata_threshold(aqi_band)
+    assert (aqi_band <= nodata_threshold).sum() == 1000
+
+
+def test_nodata_is_detected_on_the_whole_grid_with_bounds(s3, tmp_path):
+    # only a few pixels of the window are nodata and the rest of it is clean air (slightly above 1.0)
+    put_current_enfuser_zip(s3, tmp_path, clean_air=1.05)
+    aqi_fetcher = AqiFetcher(log, aqi_dir=str(tmp_path) + '/', in_memory=True, archive_tif=False, bounds=(24.99, 60.18, 25.15, 60.22))
+    aqi_fetcher.fetch_process_current_aqi_data()
+    aqi_raster = aqi_fetcher.latest_aqi_raster
+    lons = aqi_raster.transform.c + (np.arange(aqi_raster.band.shape[1]) + 0.5) * aqi_raster.transform.a
+    assert aqi_raster.band[:, lons < 25.0].max() == pytest.approx(2.0)
+    assert aqi_raster.band[:, lons > 25.0] == pytest.approx(1.05)
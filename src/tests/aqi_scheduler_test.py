@@ -0,0 +1,194 @@
+import pytest
+from ..aqi_updater.aqi_scheduler import AqiScheduler, get_backoff_delay, get_aqi_hour_start
+from ..common.logger import Logger
+import random
+import threading
+from datetime import datetime, timezone
+
+
+log = Logger(printing=False)
+hour_start = datetime(2020, 10, 10, 8, tzinfo=timezone.utc).timestamp()
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeFetcher:
+    """Publishes the AQI data of each hour at 10 minutes past the hour.
+    """
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.latest_aqi_tif = ''
+        self.latest_aqi_raster = None
+        self.latest_aqi_available_at = None
+        self.latest_aqi_forecast = None
+        self.latest_pollutant_rasters = {}
+        self.fetch_count = 0
+    def current_hour(self) -> float:
+        return self.clock.now - self.clock.now % 3600
+    def new_aqi_available(self) -> bool:
+        current_aqi_tif = 'aqi_'+ datetime.fromtimestamp(self.current_hour(), timezone.utc).strftime('%Y-%m-%dT%H') +'.tif'
+        return self.latest_aqi_tif != current_aqi_tif and self.clock.now >= self.current_hour() + 600
+    def fetch_process_current_aqi_data(self):
+        self.fetch_count += 1
+        self.clock.now += 20
+        self.latest_aqi_tif = 'aqi_'+ datetime.fromtimestamp(self.current_hour(), timezone.utc).strftime('%Y-%m-%dT%H') +'.tif'
+        self.latest_aqi_available_at = self.current_hour() + 600
+    def finish_aqi_fetch(self):
+        pass
+
+
+class FakeUpdater:
+    def __init__(self, clock: Clock, fail_count: int = 0, release: threading.Event = None, forecast_fail_count: int = 0):
+        self.clock = clock
+        self.fail_count = fail_count
+        self.forecast_fail_count = forecast_fail_count
+        self.forecast_count = 0
+        self.release = release
+        self.latest_aqi_tif = ''
+        self.update_count = 0
+        self.updated_aqi_tifs = []
+    def new_update_available(self, latest_aqi_tif: str) -> bool:
+        return latest_aqi_tif != self.latest_aqi_tif
+    def create_aqi_update_csv(self, aqi_tif_name: str, aqi_raster=None, pollutant_rasters={}):
+        if (self.release is not None):
+            assert self.release.wait(timeout=5)
+        self.update_count += 1
+        self.clock.now += 5
+        if (self.fail_count):
+            self.fail_count -= 1
+            raise RuntimeError('update failed')
+        self.latest_aqi_tif = aqi_tif_name
+        self.updated_aqi_tifs.append(aqi_tif_name)
+    def create_aqi_forecast_updates(self, aqi_forecast):
+        self.forecast_count += 1
+        if (self.forecast_fail_count):
+            self.forecast_fail_count -= 1
+            raise RuntimeError('forecast failed')
+    def finish_aqi_update(self):
+        pass
+
+
+def test_get_aqi_hour_start():
+    assert get_aqi_hour_start('aqi_2020-10-10T08.tif') == hour_start
+    assert get_aqi_hour_start('') is None
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    rng = random.Random(0)
+    for failures, max_delay in [(1, 10), (2, 20), (3, 40), (10, 300)]:
+        delays = [get_backoff_delay(failures, 10, 300, rng) for _ in range(50)]
+        assert min(delays) >= max_delay / 2
+        assert max(delays) <= max_delay
+        assert len(set(delays)) > 1
+
+
+def test_sleeps_until_next_hour_is_expected():
+    clock = Clock(hour_start + 300)
+    fetcher = FakeFetcher(clock)
+    updater = FakeUpdater(clock)
+    scheduler = AqiScheduler(log, fetcher, updater, poll_interval=15, wake_margin=60, clock=clock)
+    # data of the hour is not published yet
+    assert scheduler.run_once() == 15
+    clock.now = hour_start + 605
+    sleep = scheduler.run_once()
+    assert (fetcher.fetch_count, updater.update_count) == (1, 1)
+    assert updater.latest_aqi_tif == 'aqi_2020-10-10T08.tif'
+    assert scheduler.latencies[-1]['latency'] == pytest.approx(30)
+    # wakes up a minute before the data of the next hour is expected
+    assert clock.now + sleep == hour_start + 3600 + 540
+    clock.now += sleep
+    assert scheduler.run_once() == 15
+    assert fetcher.fetch_count == 1
+
+
+def test_failed_update_is_retried_with_backoff():
+    clock = Clock(hour_start + 600)
+    fetcher = FakeFetcher(clock)
+    updater = FakeUpdater(clock, fail_count=2)
+    scheduler = AqiScheduler(log, fetcher, updater, backoff_base=10, clock=clock, seed=0)
+    sleep = scheduler.run_once()
+    assert scheduler.update_state.failures == 1
+    assert 5 <= sleep <= 10
+    clock.now += sleep
+    sleep = scheduler.run_once()
+    assert scheduler.update_state.failures == 2
+    assert 10 <= sleep <= 20
+    clock.now += sleep
+    scheduler.run_once()
+    assert scheduler.update_state.failures == 0
+    # the data is fetched only once
+    assert (fetcher.fetch_count, updater.update_count) == (1, 3)
+    assert updater.latest_aqi_tif == 'aqi_2020-10-10T08.tif'
+
+
+def test_failed_forecast_does_not_repeat_update():
+    clock = Clock(hour_start + 600)
+    fetcher = FakeFetcher(clock)
+    fetcher.latest_aqi_forecast = 'forecast'
+    updater = FakeUpdater(clock, forecast_fail_count=1)
+    scheduler = AqiScheduler(log, fetcher, updater, clock=clock, seed=0)
+    scheduler.run_once()
+    assert (updater.update_count, updater.forecast_count) == (1, 1)
+    assert (scheduler.update_state.failures, scheduler.forecast_state.failures) == (0, 1)
+    # the published update is not repeated for the failed forecast
+    scheduler.run_once()
+    assert (fetcher.fetch_count, updater.update_count, updater.forecast_count) == (1, 1, 1)
+    # the forecast of the next hour is exported
+    clock.now = hour_start + 3600 + 600
+    scheduler.run_once()
+    assert (updater.update_count, updater.forecast_count) == (2, 2)
+    assert scheduler.forecast_state.failures == 0
+
+
+def test_pipelined_fetch_does_not_wait_for_update():
+    clock = Clock(hour_start + 600)
+    fetcher = FakeFetcher(clock)
+    release_update = threading.Event()
+    updater = FakeUpdater(clock, release=release_update)
+    scheduler = AqiScheduler(log, fetcher, updater, pipelined=True, queue_size=2, clock=clock)
+    scheduler.start()
+    scheduler.run_once()
+    # the data of the next hour is fetched while the update of the previous hour is still running
+    clock.now = hour_start + 3600 + 600
+    scheduler.run_once()
+    assert fetcher.fetch_count == 2
+    assert updater.update_count == 0
+    release_update.set()
+    scheduler.wait_until_idle()
+    assert updater.updated_aqi_tifs == ['aqi_2020-10-10T08.tif', 'aqi_2020-10-10T09.tif']
+    assert [latency['aqi_tif'] for latency in scheduler.latencies] == updater.updated_aqi_tifs
+
+
+def test_pipelined_cleanup_runs_in_worker():
+    clock = Clock(hour_start + 600)
+    fetcher = FakeFetcher(clock)
+    updater = FakeUpdater(clock)
+    cleanup_threads = []
+    fetcher.finish_aqi_fetch = lambda: cleanup_threads.append(threading.current_thread().name)
+    updater.finish_aqi_update = lambda: cleanup_threads.append(threading.current_thread().name)
+    scheduler = AqiScheduler(log, fetcher, updater, pipelined=True, clock=clock)
+    scheduler.start()
+    scheduler.run_once()
+    scheduler.wait_until_idle()
+    assert updater.updated_aqi_tifs == ['aqi_2020-10-10T08.tif']
+    assert cleanup_threads == ['aqi-cleanup', 'aqi-cleanup']
+
+
+def test_pipelined_failed_update_is_retried_by_worker():
+    clock = Clock(hour_start + 600)
+    fetcher = FakeFetcher(clock)
+    updater = FakeUpdater(clock, fail_count=2)
+    sleeps = []
+    scheduler = AqiScheduler(log, fetcher, updater, pipelined=True, backoff_base=10, clock=clock, sleep=sleeps.append, seed=0)
+    scheduler.start()
+    # failed updates do not affect the fetch schedule
+    assert scheduler.run_once() > 3000
+    scheduler.wait_until_idle()
+    assert (fetcher.fetch_count, updater.update_count) == (1, 3)
+    assert updater.updated_aqi_tifs == ['aqi_2020-10-10T08.tif']
+    assert len(sleeps) == 2
@@ -0,0 +1,337 @@
+import pytest
+from ..aqi_updater.aqi_updater import AqiUpdater, AqiUpdaterPool
+from ..common.logger import Logger
+from ..common.igraph import Edge as E
+import common.igraph as ig_utils
+import common.raster as raster_utils
+from ..common.raster import RasterBand
+import igraph as ig
+import numpy as np
+import pandas as pd
+import json
+import gzip
+import hashlib
+import os
+from affine import Affine
+from shapely.geometry import LineString
+
+
+log = Logger(printing=False)
+
+
+def create_graph() -> ig.Graph:
+    """Creates a graph of two-way edges (sharing id_way) at x = 24.90-24.95, an edge outside the AQI raster
+    and an edge without geometry.
+    """
+    lines = [LineString([(24.9 + i * 0.01, 60.2), (24.9 + i * 0.01, 60.205)]) for i in range(6)]
+    geoms = [line for line in lines for _ in range(2)] + [LineString([(26.0, 60.2), (26.01, 60.2)]), None]
+    G = ig.Graph(n=2, edges=[(0, 1)] * len(geoms), directed=True)
+    G.es[E.id_ig.value] = list(range(len(geoms)))
+    G.es[E.id_way.value] = [idx // 2 for idx in range(12)] + [100, 101]
+    G.es[E.geom_wgs.value] = geoms
+    return G
+
+
+def create_aqi_raster(aqi_by_x: list = [0.5, 0.97, 1.0, 1.49, 2.5, 4.99], name: str = 'aqi_2020-10-10T08.tif') -> RasterBand:
+    band = np.tile(np.array(aqi_by_x, dtype='float32'), (10, 1))
+    return RasterBand(name, band, Affine(0.01, 0, 24.895, 0, -0.001, 60.21), 'epsg:4326')
+
+
+@pytest.mark.parametrize('sampling,edge_columns', [('point', False), ('line', False), ('point', True)])
+def test_sampled_aqi_is_fanned_out_to_edges(tmp_path, sampling, edge_columns):
+    aqi_updates = str(tmp_path) + '/'
+    graph = create_graph()
+    if edge_columns:
+        graph_file = str(tmp_path / 'test.graphml')
+        # columns are keyed by the Edge enum of the same module as used by AqiUpdater
+        e_attrs = [ig_utils.Edge.id_ig, ig_utils.Edge.id_way, ig_utils.Edge.geom_wgs]
+        ig_utils.export_to_graphml(graph, graph_file, e_attrs=e_attrs)
+        graph = ig_utils.read_graphml_columns(graph_file, e_attrs=e_attrs)[1]
+    aqi_updater = AqiUpdater(log, graph, aqi_cache=aqi_updates, aqi_updates=aqi_updates, sampling=sampling)
+    aqi_updater.create_aqi_update_csv('aqi_2020-10-10T08.tif', aqi_raster=create_aqi_raster())
+    aqi_update_df = pd.read_csv(aqi_updates + 'aqi_2020-10-10T08.csv')
+    # AQI below 0.95 and edges outside the raster or without geometry are left out
+    assert aqi_update_df[E.id_ig.name].tolist() == list(range(2, 12))
+    assert aqi_update_df['aqi'].tolist() == [1.0, 1.0, 1.0, 1.0, 1.49, 1.49, 2.5, 2.5, 4.99, 4.99]
+    with open(aqi_updates + 'aqi_map.json') as f:
+        assert json.load(f)['data'] == [[1, 2], [2, 2], [3, 2], [4, 5], [5, 9]]
+
+
+def test_sampling_bounds():
+    aqi_updater = AqiUpdater(log, create_graph())
+    assert aqi_updater.get_sampling_bounds(buffer=0) == pytest.approx((24.9, 60.2, 26.01, 60.205))
+
+
+def test_delta_updates(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    def create_aqi_updater():
+        return AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, delta_updates=True, keyframe_interval=3, keep_versions=1)
+    def update(aqi_updater, hour: int, aqi_by_x: list) -> pd.DataFrame:
+        aqi_raster = create_aqi_raster(aqi_by_x, name=f'aqi_2020-10-10T{hour:02d}.tif')
+        aqi_updater.create_aqi_update_csv(aqi_raster.name, aqi_raster=aqi_raster)
+        aqi_updater.finish_aqi_update()
+        return pd.read_csv(aqi_updates + aqi_updater.latest_aqi_csv)
+    def read_update_info() -> dict:
+        with open(aqi_updates + 'aqi_update.json') as f:
+            return json.load(f)
+
+    aqi_updater = create_aqi_updater()
+    assert len(update(aqi_updater, 8, [0.5, 0.97, 1.0, 1.49, 2.5, 4.99])) == 10
+    assert aqi_updater.latest_aqi_csv == 'aqi_2020-10-10T08.csv'
+    # only changes above the threshold (and lost AQI) are published
+    aqi_update_df = update(aqi_updater, 9, [0.5, 0.97, 1.04, 1.6, 0.5, 4.99])
+    assert aqi_updater.latest_aqi_csv == 'aqi_2020-10-10T09_delta.csv'
+    assert aqi_update_df[E.id_ig.name].tolist() == [6, 7, 8, 9]
+    assert aqi_update_df['aqi'].tolist()[:2] == [1.6, 1.6]
+    assert aqi_update_df['aqi'].isnull().tolist() == [False, False, True, True]
+    # small changes are accumulated against the published values
+    assert update(aqi_updater, 10, [0.5, 0.97, 1.08, 1.6, 0.5, 4.99])[E.id_ig.name].tolist() == [4, 5]
+    assert read_update_info() == {
+        'sequence': 3, 
+        'keyframe_sequence': 1, 
+        'delta_threshold': 0.05, 
+        'files': ['aqi_2020-10-10T08.csv', 'aqi_2020-10-10T09_delta.csv', 'aqi_2020-10-10T10_delta.csv']
+    }
+    assert sorted(f for f in os.listdir(aqi_updates) if f.endswith('.csv')) == read_update_info()['files']
+
+    # state is restored after a restart
+    aqi_updater = create_aqi_updater()
+    assert update(aqi_updater, 11, [0.5, 0.97, 1.08, 1.6, 0.5, 4.9])[E.id_ig.name].tolist() == [10, 11]
+    assert read_update_info()['sequence'] == 4
+    # keyframe is published after keyframe_interval updates
+    assert len(update(aqi_updater, 12, [0.5, 0.97, 1.08, 1.6, 0.5, 4.9])) == 8
+    assert read_update_info()['files'] == ['aqi_2020-10-10T12.csv']
+    assert [f for f in os.listdir(aqi_updates) if f.endswith('.csv')] == ['aqi_2020-10-10T12.csv']
+
+
+def test_binary_update_formats(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, binary_formats=['parquet', 'npy'], keep_versions=1)
+    for hour in [8, 9]:
+        aqi_updater.create_aqi_update_csv(f'aqi_2020-10-10T{hour:02d}.tif', aqi_raster=create_aqi_raster())
+        aqi_updater.finish_aqi_update()
+    assert sorted(f for f in os.listdir(aqi_updates) if f.startswith('aqi_2020')) == [
+        'aqi_2020-10-10T09.csv', 'aqi_2020-10-10T09.npy', 'aqi_2020-10-10T09.parquet'
+    ]
+    aqi_update_df = pd.read_csv(aqi_updates + 'aqi_2020-10-10T09.csv')
+    assert pd.read_parquet(aqi_updates + 'aqi_2020-10-10T09.parquet').equals(aqi_update_df)
+    dense_aqi = np.load(aqi_updates + 'aqi_2020-10-10T09.npy', mmap_mode='r')
+    assert dense_aqi.dtype == np.dtype('<f4')
+    assert dense_aqi.shape == (13,)
+    assert np.isnan(dense_aqi[[0, 1, 12]]).all()
+    assert np.allclose(dense_aqi[aqi_update_df[E.id_ig.name]], aqi_update_df['aqi'])
+
+
+def test_unknown_binary_format():
+    with pytest.raises(ValueError):
+        AqiUpdater(log, create_graph(), binary_formats=['feather'])
+
+
+def test_compact_aqi_map(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, aqi_map_encoding='delta')
+    aqi_updater.create_aqi_update_csv('aqi_2020-10-10T08.tif', aqi_raster=create_aqi_raster())
+    with open(aqi_updates + 'aqi_map.json', 'rb') as f:
+        aqi_map_json = f.read()
+    aqi_map = json.loads(aqi_map_json)
+    assert aqi_map == { 'encoding': 'delta', 'id_way': [1, 1, 1, 1, 1], 'aqi_class': '22259' }
+    id_aqi_pairs = list(zip(np.cumsum(aqi_map['id_way']).tolist(), [int(c, 11) for c in aqi_map['aqi_class']]))
+    assert id_aqi_pairs == [(1, 2), (2, 2), (3, 2), (4, 5), (5, 9)]
+    with open(aqi_updates + 'aqi_map.json.gz', 'rb') as f:
+        assert gzip.decompress(f.read()) == aqi_map_json
+    with open(aqi_updates + 'aqi_map.json.sha256') as f:
+        assert f.read() == hashlib.sha256(aqi_map_json).hexdigest()
+
+
+def assert_manifest_checksums(publish_dir: str, manifest: dict):
+    # the files of all kept versions and the latest files match their checksums in the manifest
+    files = [version['files'] for version in manifest['versions']] + [manifest.get('latest_files', {})]
+    for file_n, file_meta in [item for version_files in files for item in version_files.items()]:
+        with open(publish_dir + file_n, 'rb') as f:
+            assert hashlib.sha256(f.read()).hexdigest() == file_meta['sha256'], file_n
+
+
+def test_updates_are_published_to_manifest(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, binary_formats=['npy'], keep_versions=2)
+    for hour in [8, 9, 10]:
+        aqi_updater.create_aqi_update_csv(f'aqi_2020-10-10T{hour:02d}.tif', aqi_raster=create_aqi_raster())
+        aqi_updater.finish_aqi_update()
+    with open(aqi_updates + 'manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest['latest'] == 'aqi_2020-10-10T10'
+    assert [version['version'] for version in manifest['versions']] == ['aqi_2020-10-10T10', 'aqi_2020-10-10T09']
+    files = manifest['versions'][0]['files']
+    assert files['aqi_2020-10-10T10.csv']['rows'] == 10
+    assert files['aqi_2020-10-10T10.npy']['rows'] == 13
+    with open(aqi_updates + 'aqi_2020-10-10T10.csv', 'rb') as f:
+        assert files['aqi_2020-10-10T10.csv']['sha256'] == hashlib.sha256(f.read()).hexdigest()
+    # the AQI map (of a fixed name) is listed only in the latest files
+    assert not [file_n for version in manifest['versions'] for file_n in version['files'] if file_n.startswith('aqi_map')]
+    with open(aqi_updates + 'aqi_map.json', 'rb') as f:
+        assert manifest['latest_files']['aqi_map.json']['sha256'] == hashlib.sha256(f.read()).hexdigest()
+    assert 'aqi_map.json.gz' in manifest['latest_files']
+    # files of the two latest versions are kept
+    assert sorted(f for f in os.listdir(aqi_updates) if f.startswith('aqi_2020')) == [
+        'aqi_2020-10-10T09.csv', 'aqi_2020-10-10T09.npy', 'aqi_2020-10-10T10.csv', 'aqi_2020-10-10T10.npy'
+    ]
+    assert not [f for f in os.listdir(aqi_updates) if f.endswith('.tmp')]
+    assert_manifest_checksums(aqi_updates, manifest)
+
+    # in delta mode, aqi_update.json (of a fixed name) is listed only in the latest files
+    delta_aqi_updates = str(tmp_path / 'delta') + '/'
+    os.makedirs(delta_aqi_updates)
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=delta_aqi_updates, delta_updates=True, keep_versions=3)
+    for hour in [8, 9, 10]:
+        aqi_updater.create_aqi_update_csv(f'aqi_2020-10-10T{hour:02d}.tif', aqi_raster=create_aqi_raster([1.5 + hour / 10] * 6))
+        aqi_updater.finish_aqi_update()
+    with open(delta_aqi_updates + 'manifest.json') as f:
+        manifest = json.load(f)
+    assert [version['version'] for version in manifest['versions']] == [
+        'aqi_2020-10-10T10_delta', 'aqi_2020-10-10T09_delta', 'aqi_2020-10-10T08'
+    ]
+    assert not [file_n for version in manifest['versions'] for file_n in version['files'] if file_n == 'aqi_update.json']
+    assert 'aqi_update.json' in manifest['latest_files']
+    assert_manifest_checksums(delta_aqi_updates, manifest)
+
+
+def test_unpublished_updates(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, binary_formats=['npy'], delta_updates=True)
+    assert not aqi_updater.full_update_exists('aqi_2020-10-10T08.tif')
+    aqi_updater.create_aqi_update_csv('aqi_2020-10-10T08.tif', aqi_raster=create_aqi_raster(), publish=False)
+    # a full update is written even in delta mode, without the AQI map, the manifest or the delta state
+    assert aqi_updater.full_update_exists('aqi_2020-10-10T08.tif')
+    assert sorted(os.listdir(aqi_updates)) == ['aqi_2020-10-10T08.csv', 'aqi_2020-10-10T08.npy']
+    assert len(pd.read_csv(aqi_updates + 'aqi_2020-10-10T08.csv')) == 10
+    assert aqi_updater.latest_aqi_csv == ''
+    aqi_updater.create_aqi_update_csv('aqi_2020-10-10T09.tif', aqi_raster=create_aqi_raster())
+    with open(aqi_updates + 'manifest.json') as f:
+        files = json.load(f)['versions'][0]['files']
+    assert not [f for f in files if f.startswith('aqi_2020-10-10T08')]
+    assert 'aqi_2020-10-10T09.csv' in files
+
+
+def test_aggregates_are_published(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, aggregates=True, aggregate_interval=2)
+    for aqi_tif_name, aqi_by_x in [
+        ('aqi_2020-10-10T22.tif', [0.5, 1.0, 1.0, 1.5, 2.5, 4.0]),
+        ('aqi_2020-10-10T23.tif', [0.5, 2.0, 1.0, 1.5, 3.5, 2.0]),
+        ('aqi_2020-10-11T00.tif', [1.0, 3.0, 1.0, 1.5, 4.5, 3.0])
+    ]:
+        aqi_updater.create_aqi_update_csv(aqi_tif_name, aqi_raster=create_aqi_raster(aqi_by_x, aqi_tif_name))
+        aqi_updater.finish_aqi_update()
+    # the daily aggregates are published when the next day starts
+    daily_df = pd.read_csv(aqi_updates + 'aggregates/daily/aqi_day_2020-10-10.csv')
+    assert daily_df.columns.tolist() == [E.id_ig.name, 'aqi_mean', 'aqi_std', 'aqi_min', 'aqi_max', 'hours']
+    assert daily_df[E.id_ig.name].tolist() == list(range(2, 12))
+    assert daily_df['aqi_mean'].tolist()[::2] == [1.5, 1.0, 1.5, 3.0, 3.0]
+    assert daily_df['aqi_max'].tolist()[::2] == [2.0, 1.0, 1.5, 3.5, 4.0]
+    # the rolling aggregates are published every other hour
+    assert sorted(f for f in os.listdir(aqi_updates + 'aggregates/') if f.endswith('.csv')) == [
+        'aqi_24h_2020-10-10T22.csv', 'aqi_24h_2020-10-11T00.csv'
+    ]
+    rolling_df = pd.read_csv(aqi_updates + 'aggregates/aqi_24h_2020-10-11T00.csv')
+    assert rolling_df[E.id_ig.name].tolist() == list(range(12))
+    assert rolling_df['hours'].tolist()[::2] == [1, 3, 3, 3, 3, 3]
+    assert rolling_df['aqi_mean'].tolist()[::2] == [1.0, 2.0, 1.0, 1.5, 3.5, 3.0]
+    # the aggregation is resumed from the checkpointed state
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, aggregates=True, aggregate_interval=2)
+    aqi_updater.create_aqi_update_csv('aqi_2020-10-11T02.tif', aqi_raster=create_aqi_raster(name='aqi_2020-10-11T02.tif'))
+    rolling_df = pd.read_csv(aqi_updates + 'aggregates/aqi_24h_2020-10-11T02.csv')
+    assert rolling_df['hours'].tolist()[::2] == [1, 4, 4, 4, 4, 4]
+
+
+def test_pollutant_columns(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, binary_formats=['parquet'], pollutants=['NO2', 'PM25'])
+    aqi_raster = create_aqi_raster()
+    no2_raster = create_aqi_raster([10.0, 20.0, 30.0, -1.0, 50.0, 60.123], name='no2_2020-10-10T08.tif')
+    aqi_updater.create_aqi_update_csv(aqi_raster.name, aqi_raster=aqi_raster, pollutant_rasters={ 'NO2': no2_raster })
+    aqi_update_df = pd.read_csv(aqi_updates + 'aqi_2020-10-10T08.csv')
+    assert aqi_update_df.columns.tolist() == [E.id_ig.name, 'aqi', 'no2', 'pm25']
+    assert aqi_update_df[E.id_ig.name].tolist() == list(range(2, 12))
+    # invalid values and pollutants without raster are left empty
+    assert aqi_update_df['no2'].fillna(-1).tolist() == [20.0, 20.0, 30.0, 30.0, -1, -1, 50.0, 50.0, 60.12, 60.12]
+    assert aqi_update_df['pm25'].isnull().all()
+    assert pd.read_parquet(aqi_updates + 'aqi_2020-10-10T08.parquet').equals(aqi_update_df)
+
+
+def test_pollutants_are_not_supported_with_delta_updates():
+    with pytest.raises(ValueError):
+        AqiUpdater(log, create_graph(), pollutants=['NO2'], delta_updates=True)
+
+
+def test_forecast_updates(tmp_path):
+    aqi_updates = str(tmp_path) + '/'
+    aqi_updater = AqiUpdater(log, create_graph(), aqi_updates=aqi_updates, keep_versions=2)
+    def create_aqi_forecast(first_hour: int):
+        aqi_rasters = [create_aqi_raster([1.0 + step] * 6) for step in range(3)]
+        names = [f'aqi_2020-10-10T{first_hour + step:02d}.tif' for step in range(3)]
+        # RasterStack of the same module as used by AqiUpdater
+        return raster_utils.RasterStack(names, np.stack([r.band for r in aqi_rasters]), aqi_rasters[0].transform, aqi_rasters[0].crs)
+
+    aqi_updater.create_aqi_forecast_updates(create_aqi_forecast(8))
+    aqi_updater.finish_aqi_update()
+    with open(aqi_updates + 'forecast/manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest['latest'] == 'forecast_2020-10-10T08'
+    assert manifest['versions'][0]['steps'] == 3
+    assert sorted(manifest['versions'][0]['files']) == [
+        'aqi_2020-10-10T08_f2020-10-10T08.csv', 'aqi_2020-10-10T09_f2020-10-10T08.csv', 'aqi_2020-10-10T10_f2020-10-10T08.csv'
+    ]
+    for step in range(3):
+        aqi_update_df = pd.read_csv(aqi_updates + f'forecast/aqi_2020-10-10T{8 + step:02d}_f2020-10-10T08.csv')
+        assert aqi_update_df[E.id_ig.name].tolist() == list(range(12))
+        assert (aqi_update_df['aqi'] == 1.0 + step).all()
+    # the live updates are not affected by forecasts
+    assert not [f for f in os.listdir(aqi_updates) if f.endswith('.csv')]
+    # the files of the previous (overlapping) forecast are not overwritten by the next one
+    aqi_updater.create_aqi_forecast_updates(create_aqi_forecast(9))
+    aqi_updater.finish_aqi_update()
+    with open(aqi_updates + 'forecast/manifest.json') as f:
+        manifest = json.load(f)
+    assert [version['version'] for version in manifest['versions']] == ['forecast_2020-10-10T09', 'forecast_2020-10-10T08']
+    assert_manifest_checksums(aqi_updates + 'forecast/', manifest)
+    # files of old forecasts are removed
+    aqi_updater.create_aqi_forecast_updates(create_aqi_forecast(10))
+    aqi_updater.finish_aqi_update()
+    assert sorted(f for f in os.listdir(aqi_updates + 'forecast/') if f.endswith('.csv')) == sorted(
+        f'aqi_2020-10-10T{first_hour + step:02d}_f2020-10-10T{first_hour:02d}.csv' for first_hour in [9, 10] for step in range(3)
+    )
+
+
+def test_updater_pool_serves_multiple_graphs(tmp_path):
+    aqi_updates = str(tmp_path / 'aqi_updates') + '/'
+    e_attrs = [ig_utils.Edge.id_ig, ig_utils.Edge.id_way, ig_utils.Edge.geom_wgs]
+    graph_files = { 'full': str(tmp_path / 'full.graphml'), 'subset': str(tmp_path / 'subset.graphml') }
+    ig_utils.export_to_graphml(create_graph(), graph_files['full'], e_attrs=e_attrs)
+    subset_graph = create_graph()
+    subset_graph.delete_edges(range(6, 14))
+    ig_utils.export_to_graphml(subset_graph, graph_files['subset'], e_attrs=e_attrs)
+
+    aqi_updater_pool = AqiUpdaterPool(log, graph_files, aqi_updates=aqi_updates, aqi_cache=str(tmp_path) + '/')
+    try:
+        assert aqi_updater_pool.get_sampling_bounds(buffer=0) == pytest.approx((24.9, 60.2, 26.01, 60.205))
+        aqi_raster = create_aqi_raster()
+        assert aqi_updater_pool.new_update_available(aqi_raster.name)
+        aqi_updater_pool.create_aqi_update_csv(aqi_raster.name, aqi_raster=aqi_raster)
+        aqi_updater_pool.finish_aqi_update()
+        assert not aqi_updater_pool.new_update_available(aqi_raster.name)
+    finally:
+        aqi_updater_pool.close()
+
+    assert pd.read_csv(aqi_updates + 'subset/aqi_2020-10-10T08.csv')[E.id_ig.name].tolist() == [2, 3, 4, 5]
+    # updates are the same as by a single AqiUpdater
+    single_aqi_updates = str(tmp_path / 'single') + '/'
+    os.makedirs(single_aqi_updates)
+    AqiUpdater(log, create_graph(), aqi_updates=single_aqi_updates).create_aqi_update_csv(aqi_raster.name, aqi_raster=aqi_raster)
+    for filename in ['aqi_2020-10-10T08.csv', 'aqi_map.json']:
+        with open(aqi_updates + 'full/' + filename, 'rb') as f1, open(single_aqi_updates + filename, 'rb') as f2:
+            assert f1.read() == f2.read()
+
+
+def test_updater_pool_fails_with_missing_graph(tmp_path):
+    with pytest.raises(RuntimeError):
+        AqiUpdaterPool(log, { 'missing': str(tmp_path / 'missing.graphml') }, aqi_updates=str(tmp_path) + '/')
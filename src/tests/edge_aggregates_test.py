@@ -0,0 +1,87 @@
+import pytest
+from ..common.edge_aggregates import EdgeAggregates
+from ..common.logger import Logger
+import numpy as np
+import os
+
+
+log = Logger(printing=False)
+ids = np.array([10, 11, 12])
+day_start = 18545 * 24  # 2020-10-10T00 in epoch hours
+
+
+def get_values(hour: int) -> np.ndarray:
+    # the value of the last feature is missing on odd hours
+    return np.array([1.0 + hour % 24, 2.0, np.nan if hour % 2 else 3.0])
+
+
+def test_daily_stats(tmp_path):
+    aggregates = EdgeAggregates(log, str(tmp_path), ids)
+    for hour in range(day_start, day_start + 4):
+        aggregates.add(hour, get_values(hour))
+    stats = aggregates.get_daily_stats()
+    assert stats['count'].tolist() == [4, 4, 2]
+    assert np.allclose(stats['mean'], [2.5, 2.0, 3.0])
+    assert np.allclose(stats['std'], [np.std([1, 2, 3, 4]), 0, 0])
+    assert stats['min'].tolist() == [1.0, 2.0, 3.0]
+    assert stats['max'].tolist() == [4.0, 2.0, 3.0]
+    # the statistics are reset on a new day
+    aggregates.add(day_start + 24, get_values(day_start + 24))
+    assert aggregates.day == day_start // 24 + 1
+    assert aggregates.get_daily_stats()['count'].tolist() == [1, 1, 1]
+
+
+def test_rolling_stats(tmp_path):
+    aggregates = EdgeAggregates(log, str(tmp_path), ids, window=3)
+    for hour in range(day_start, day_start + 5):
+        aggregates.add(hour, get_values(hour))
+    stats = aggregates.get_rolling_stats()
+    assert stats['count'].tolist() == [3, 3, 2]
+    assert np.allclose(stats['mean'], [4.0, 2.0, 3.0])
+    assert stats['max'].tolist() == [5.0, 2.0, 3.0]
+    # hours that left the window over a gap are dropped
+    aggregates.add(day_start + 6, get_values(day_start + 6))
+    assert aggregates.get_rolling_stats()['count'].tolist() == [2, 2, 2]
+    assert np.allclose(aggregates.get_rolling_stats()['mean'], [6.0, 2.0, 3.0])
+
+
+def test_old_hours_are_ignored(tmp_path):
+    aggregates = EdgeAggregates(log, str(tmp_path), ids)
+    assert aggregates.add(day_start + 1, get_values(day_start + 1))
+    assert not aggregates.add(day_start + 1, get_values(day_start + 1))
+    assert not aggregates.add(day_start, get_values(day_start))
+    assert aggregates.get_daily_stats()['count'].tolist() == [1, 1, 0]
+
+
+def test_state_is_restored_from_checkpoint(tmp_path):
+    state_dir = str(tmp_path)
+    aggregates = EdgeAggregates(log, state_dir, ids, window=3)
+    for hour in range(day_start, day_start + 4):
+        aggregates.add(hour, get_values(hour))
+    restored = EdgeAggregates(log, state_dir, ids, window=3)
+    assert (restored.latest_hour, restored.day) == (aggregates.latest_hour, aggregates.day)
+    for stats, restored_stats in [
+        (aggregates.get_daily_stats(), restored.get_daily_stats()),
+        (aggregates.get_rolling_stats(), restored.get_rolling_stats())
+    ]:
+        for stat in stats:
+            assert np.array_equal(stats[stat], restored_stats[stat], equal_nan=True)
+    # the checkpoint can be memory-mapped and only the latest day_stats file is kept
+    assert [f for f in os.listdir(state_dir) if f.startswith('day_stats_')] == [f'day_stats_{day_start + 3}.npy']
+    day_stats = np.load(os.path.join(state_dir, f'day_stats_{day_start + 3}.npy'), mmap_mode='r')
+    assert day_stats[0].tolist() == [4, 4, 2]
+    # the state is discarded if the features change
+    assert EdgeAggregates(log, state_dir, np.array([10, 11]), window=3).latest_hour is None
+
+
+def test_row_written_after_checkpoint_is_dropped(tmp_path):
+    state_dir = str(tmp_path)
+    aggregates = EdgeAggregates(log, state_dir, ids, window=3)
+    for hour in range(day_start, day_start + 4):
+        aggregates.add(hour, get_values(hour))
+    # simulate a crash after writing the ring row of the next hour but before the checkpoint
+    ring = np.load(os.path.join(state_dir, 'rolling_values.npy'), mmap_mode='r+')
+    ring[(day_start + 4) % 4] = 100
+    ring.flush()
+    restored = EdgeAggregates(log, state_dir, ids, window=3)
+    assert restored.get_rolling_stats()['max'].tolist() == [4.0, 2.0, 3.0]
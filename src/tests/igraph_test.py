@@ -0,0 +1,205 @@
+import pytest
+from ..common import igraph as ig_utils
+from ..common.igraph import Edge as E, Node as N
+import igraph as ig
+import os
+import numpy as np
+from shapely.geometry import LineString, Point
+
+
+def create_test_graph() -> ig.Graph:
+    G = ig.Graph(directed=True)
+    G.add_vertices(3)
+    G.vs[N.id_ig.value] = [0, 1, 2]
+    G.vs[N.geom_wgs.value] = [Point(24.96, 60.20), Point(24.97, 60.21), Point(24.98, 60.20)]
+    G.vs[N.traffic_light.value] = [True, False, None]
+    G.add_edges([(0, 1), (1, 0), (1, 2)])
+    G.es[E.id_ig.value] = [0, 1, 2]
+    G.es[E.id_way.value] = [0, 0, 1]
+    G.es[E.uv.value] = [(0, 1), (1, 0), (1, 2)]
+    G.es[E.name_otp.value] = ['Kumpulantie', 'Kumpulantie', None]
+    G.es[E.geom_wgs.value] = [
+        LineString([(24.96, 60.20), (24.97, 60.21)]), 
+        LineString([(24.97, 60.21), (24.96, 60.20)]), 
+        LineString([(24.97, 60.21), (24.975, 60.205), (24.98, 60.20)])
+    ]
+    G.es[E.length.value] = [12.5, 12.5, None]
+    G.es[E.allows_biking.value] = [True, True, False]
+    G.es[E.noises.value] = [{60: 12.5, 65: 3.25}, {}, None]
+    return G
+
+
+def assert_graphs_equal(G1: ig.Graph, G2: ig.Graph):
+    assert G1.get_edgelist() == G2.get_edgelist()
+    assert sorted(G1.vs.attribute_names()) == sorted(G2.vs.attribute_names())
+    assert sorted(G1.es.attribute_names()) == sorted(G2.es.attribute_names())
+    for seq1, seq2 in [(G1.vs, G2.vs), (G1.es, G2.es)]:
+        for attr in seq1.attribute_names():
+            for value1, value2 in zip(seq1[attr], seq2[attr]):
+                assert type(value1) == type(value2)
+                assert value1.equals(value2) if hasattr(value1, 'equals') else value1 == value2
+
+
+def test_read_graphml_cached(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    G = ig_utils.read_graphml(graph_file)
+    G_first = ig_utils.read_graphml_cached(graph_file)
+    snapshot_dir = ig_utils.get_snapshot_dir(graph_file)
+    assert os.path.isdir(snapshot_dir)
+    assert ig_utils.read_snapshot_meta(snapshot_dir)['edge_attributes'][E.length.value] == 'float'
+    G_cached = ig_utils.read_graphml_cached(graph_file)
+    assert_graphs_equal(G, G_first)
+    assert_graphs_equal(G, G_cached)
+
+
+def test_snapshot_rebuilt_on_graph_change(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    G = create_test_graph()
+    ig_utils.export_to_graphml(G, graph_file)
+    ig_utils.read_graphml_cached(graph_file)
+    old_snapshot_dir = ig_utils.get_snapshot_dir(graph_file)
+    G.es[E.length.value] = [1.0, 2.0, 3.0]
+    ig_utils.export_to_graphml(G, graph_file)
+    G_cached = ig_utils.read_graphml_cached(graph_file)
+    assert G_cached.es[E.length.value] == [1.0, 2.0, 3.0]
+    assert not os.path.exists(old_snapshot_dir)
+    assert os.path.isdir(ig_utils.get_snapshot_dir(graph_file))
+
+
+def test_read_graphml_converts_values(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    G = ig_utils.read_graphml(graph_file)
+    assert G.es[E.id_way.value] == [0, 0, 1]
+    assert G.es[E.uv.value] == [(0, 1), (1, 0), (1, 2)]
+    assert G.es[E.name_otp.value] == ['Kumpulantie', 'Kumpulantie', None]
+    assert G.es[E.length.value] == [12.5, 12.5, None]
+    assert G.es[E.allows_biking.value] == [True, True, False]
+    assert G.es[E.noises.value] == [{60: 12.5, 65: 3.25}, {}, None]
+    assert G.vs[N.traffic_light.value] == [True, False, None]
+    assert G.es[2][E.geom_wgs.value].equals(create_test_graph().es[2][E.geom_wgs.value])
+
+
+def test_read_graphml_attribute_subset(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    e_attrs = [E.id_ig, E.id_way, E.geom_wgs]
+    G = ig_utils.read_graphml(graph_file, n_attrs=[], e_attrs=e_attrs)
+    assert G.vs.attribute_names() == []
+    assert sorted(G.es.attribute_names()) == sorted([attr.value for attr in e_attrs])
+    assert G.ecount() == 3
+    ig_utils.read_graphml_cached(graph_file)
+    G_cached = ig_utils.read_graphml_cached(graph_file, n_attrs=[N.id_ig], e_attrs=e_attrs)
+    assert G_cached.vs.attribute_names() == [N.id_ig.value]
+    assert sorted(G_cached.es.attribute_names()) == sorted([attr.value for attr in e_attrs])
+
+
+def test_read_graphml_columns(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    G = ig_utils.read_graphml(graph_file)
+    n_columns, e_columns = ig_utils.read_graphml_columns(
+        graph_file, 
+        n_attrs=[N.traffic_light], 
+        e_attrs=[E.id_ig, E.id_way, E.geom_wgs, E.length, E.allows_biking, E.noises, E.gvi]
+    )
+    assert list(n_columns) == [N.traffic_light]
+    assert n_columns[N.traffic_light].tolist() == G.vs[N.traffic_light.value]
+    # attributes that are not in the file are omitted
+    assert list(e_columns) == [E.id_ig, E.id_way, E.geom_wgs, E.length, E.allows_biking, E.noises]
+    assert e_columns[E.id_ig].dtype == np.int64
+    assert e_columns[E.id_way].tolist() == [0, 0, 1]
+    assert e_columns[E.allows_biking].dtype == bool
+    assert e_columns[E.length].tolist() == [12.5, 12.5, None]
+    assert e_columns[E.noises].tolist() == G.es[E.noises.value]
+    for geom, G_geom in zip(e_columns[E.geom_wgs], G.es[E.geom_wgs.value]):
+        assert geom.equals(G_geom)
+
+
+def test_read_snapshot_columns(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    G = ig_utils.read_graphml_cached(graph_file)
+    n_columns, e_columns = ig_utils.read_snapshot_columns(
+        ig_utils.get_snapshot_dir(graph_file),
+        n_attrs=[N.traffic_light],
+        e_attrs=[E.id_ig, E.id_way, E.geom_wgs, E.length, E.name_otp, E.noises, E.gvi]
+    )
+    assert n_columns[N.traffic_light].tolist() == G.vs[N.traffic_light.value]
+    assert list(e_columns) == [E.id_ig, E.id_way, E.geom_wgs, E.length, E.name_otp, E.noises]
+    # numeric columns without missing values are memory-mapped
+    assert isinstance(e_columns[E.id_way], np.memmap)
+    assert e_columns[E.id_way].tolist() == [0, 0, 1]
+    assert e_columns[E.length].tolist() == [12.5, 12.5, None]
+    assert e_columns[E.name_otp].tolist() == ['Kumpulantie', 'Kumpulantie', None]
+    assert e_columns[E.noises].tolist() == G.es[E.noises.value]
+    for geom, G_geom in zip(e_columns[E.geom_wgs], G.es[E.geom_wgs.value]):
+        assert geom.equals(G_geom)
+
+
+def test_read_graphml_columns_cached(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    e_attrs = [E.id_ig, E.id_way, E.geom_wgs]
+    _, e_columns = ig_utils.read_graphml_columns_cached(graph_file, e_attrs=e_attrs)
+    # the snapshot is built by streaming only the selected attributes of the GraphML file
+    snapshot_dir = ig_utils.get_snapshot_dir(graph_file)
+    meta = ig_utils.read_snapshot_meta(snapshot_dir)
+    assert (meta['node_attributes'], list(meta['edge_attributes'])) == ({}, [E.id_ig.value, E.id_way.value, E.geom_wgs.value])
+    assert (meta['node_selection'], meta['edge_selection']) == ([], [E.id_ig.value, E.id_way.value, E.geom_wgs.value])
+    _, e_columns_cached = ig_utils.read_graphml_columns_cached(graph_file, e_attrs=e_attrs)
+    assert isinstance(e_columns_cached[E.id_ig], np.memmap)
+    _, e_columns_graphml = ig_utils.read_graphml_columns(graph_file, e_attrs=e_attrs)
+    for columns in [e_columns, e_columns_cached]:
+        assert list(columns) == e_attrs
+        assert columns[E.id_way].tolist() == e_columns_graphml[E.id_way].tolist()
+        for geom, graphml_geom in zip(columns[E.geom_wgs], e_columns_graphml[E.geom_wgs]):
+            assert geom.equals(graphml_geom)
+
+    # the snapshot is rebuilt with both its attributes and the missing ones
+    _, e_columns = ig_utils.read_graphml_columns_cached(graph_file, e_attrs=[E.length, E.aqi])
+    assert e_columns[E.length].tolist() == [12.5, 12.5, None]
+    meta = ig_utils.read_snapshot_meta(snapshot_dir)
+    assert sorted(meta['edge_attributes']) == sorted([E.length.value, E.id_ig.value, E.id_way.value, E.geom_wgs.value])
+    assert meta['edge_selection'] == [E.length.value, E.aqi.value, E.id_ig.value, E.id_way.value, E.geom_wgs.value]
+    # attributes that are missing from the GraphML file do not cause rebuilds
+    os.remove(os.path.join(snapshot_dir, 'edges.npy'))
+    _, e_columns = ig_utils.read_graphml_columns_cached(graph_file, e_attrs=[E.id_ig, E.aqi])
+    assert list(e_columns) == [E.id_ig]
+    assert not os.path.exists(os.path.join(snapshot_dir, 'edges.npy'))
+
+    # a graph is not read from a snapshot of only some of the attributes
+    G = ig_utils.read_graphml_cached(graph_file)
+    assert_graphs_equal(G, ig_utils.read_graphml(graph_file))
+    meta = ig_utils.read_snapshot_meta(snapshot_dir)
+    assert (meta['node_selection'], meta['edge_selection']) == (None, None)
+    assert_graphs_equal(ig_utils.read_snapshot(snapshot_dir), G)
+
+
+def test_export_graphml_to_snapshot(tmp_path):
+    graph_file = str(tmp_path / 'test.graphml')
+    ig_utils.export_to_graphml(create_test_graph(), graph_file)
+    snapshot_dir = str(tmp_path / 'test.snapshot')
+    # the snapshot built by streaming the GraphML file has the same content as from a graph object
+    ig_utils.export_graphml_to_snapshot(graph_file, snapshot_dir)
+    assert_graphs_equal(ig_utils.read_snapshot(snapshot_dir), ig_utils.read_graphml(graph_file))
+
+
+def test_get_edge_gdf():
+    G = create_test_graph()
+    edge_gdf = ig_utils.get_edge_gdf(G, id_attr=E.id_ig, attrs=[E.id_way, E.aqi], ig_attrs=['source', 'target'], geom_attr=E.geom_wgs, epsg=4326)
+    assert list(edge_gdf.columns) == [E.geom_wgs.name, E.id_way.name, 'source', 'target']
+    assert list(edge_gdf.index) == [0, 1, 2]
+    assert edge_gdf.geometry.name == E.geom_wgs.name
+    assert edge_gdf.crs.to_epsg() == 4326
+    assert edge_gdf[E.id_way.name].tolist() == [0, 0, 1]
+    assert edge_gdf['target'].tolist() == [1, 0, 2]
+    assert edge_gdf.geometry.iloc[2].equals(G.es[2][E.geom_wgs.value])
+
+
+def test_get_node_gdf():
+    node_gdf = ig_utils.get_node_gdf(create_test_graph(), attrs=[N.traffic_light], ig_attrs=['index'], geom_attr=N.geom_wgs, epsg=4326)
+    assert list(node_gdf.columns) == [N.geom_wgs.name, N.traffic_light.name, 'index']
+    assert node_gdf['index'].tolist() == [0, 1, 2]
+    assert node_gdf.geometry.x.round(2).tolist() == [24.96, 24.97, 24.98]
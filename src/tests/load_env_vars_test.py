@@ -0,0 +1,22 @@
+import pytest
+from ..aqi_updater.load_env_vars import get_bool_env, get_json_env
+
+
+def test_get_bool_env(monkeypatch):
+    assert get_bool_env('AQI_TEST_FLAG', True)
+    for value, expected in [('True', True), ('true', True), ('FALSE', False), (' false ', False)]:
+        monkeypatch.setenv('AQI_TEST_FLAG', value)
+        assert get_bool_env('AQI_TEST_FLAG') == expected
+    for value in ['1', 'yes', '__import__("os")']:
+        monkeypatch.setenv('AQI_TEST_FLAG', value)
+        with pytest.raises(ValueError):
+            get_bool_env('AQI_TEST_FLAG')
+
+
+def test_get_json_env(monkeypatch):
+    assert get_json_env('AQI_TEST_GRAPHS') is None
+    monkeypatch.setenv('AQI_TEST_GRAPHS', '{"kumpula": "graph/kumpula.graphml"}')
+    assert get_json_env('AQI_TEST_GRAPHS') == { 'kumpula': 'graph/kumpula.graphml' }
+    monkeypatch.setenv('AQI_TEST_GRAPHS', "{'kumpula': 'graph/kumpula.graphml'}")
+    with pytest.raises(ValueError):
+        get_json_env('AQI_TEST_GRAPHS')
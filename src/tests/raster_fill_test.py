@@ -0,0 +1,76 @@
+import pytest
+from ..common.raster_fill import NodataFiller
+import numpy as np
+from rasterio import fill
+
+
+def create_band_with_nodata():
+    rows, cols = np.mgrid[0:120, 0:150]
+    band = (2.0 + np.sin(rows / 15) + np.cos(cols / 20)).astype('float32')
+    nodata_mask = (rows - 60) ** 2 + (cols - 50) ** 2 < 30 ** 2
+    nodata_mask[:, 130:] = True
+    band[nodata_mask] = 1.0
+    return band, nodata_mask
+
+
+def create_band_with_coast():
+    # noisy values with sea below a wavy coastline, a lake, small islands and nodata outside the model domain
+    rows, cols = np.mgrid[0:300, 0:300]
+    band = (2.0 + np.sin(rows / 15) + np.cos(cols / 20)).astype('float32')
+    band += np.random.default_rng(1).random(band.shape).astype('float32') * 0.5
+    nodata_mask = rows > 150 + 30 * np.sin(cols / 25)
+    nodata_mask &= (rows - 220) ** 2 + (cols - 120) ** 2 > 8 ** 2
+    nodata_mask |= (rows - 60) ** 2 + (cols - 80) ** 2 < 25 ** 2
+    nodata_mask[:, 260:] = True
+    band[nodata_mask] = 1.0
+    return band, nodata_mask
+
+
+@pytest.mark.parametrize('create_band', [create_band_with_nodata, create_band_with_coast])
+@pytest.mark.parametrize('max_search_distance', [100, 20, 7.5])
+def test_fill_matches_rasterio_fillnodata(create_band, max_search_distance):
+    band, nodata_mask = create_band()
+    band_fillna = NodataFiller(max_search_distance=max_search_distance).fill(band, nodata_mask)
+    band_fillna_gdal = fill.fillnodata(
+        band,
+        mask=np.where(nodata_mask, 0, 1).astype('uint8'),
+        max_search_distance=max_search_distance
+    )
+    assert band_fillna.dtype == band.dtype
+    assert np.array_equal(band_fillna[~nodata_mask], band[~nodata_mask])
+    # the same pixels are filled with the same values (up to float32 rounding)
+    assert np.abs(band_fillna - band_fillna_gdal).max() < 1e-5
+
+
+def test_fill_plan_is_cached_by_nodata_mask():
+    band, nodata_mask = create_band_with_nodata()
+    nodata_filler = NodataFiller()
+    targets, sources, weights = nodata_filler.get_fill_plan(nodata_mask)
+    assert len(targets) == nodata_mask.sum()
+    assert np.allclose(weights.sum(axis=1), 1)
+    assert nodata_filler.get_fill_plan(nodata_mask.copy())[0] is targets
+    # fill plan of the next hour is reused
+    assert np.allclose(nodata_filler.fill(band * 2, nodata_mask)[nodata_mask], 2 * nodata_filler.fill(band, nodata_mask)[nodata_mask])
+    # fill plan is recomputed if the nodata mask changes
+    nodata_mask[0, 0] = True
+    assert len(nodata_filler.get_fill_plan(nodata_mask)[0]) == len(targets) + 1
+
+
+def test_pixels_beyond_search_distance_are_not_filled():
+    band = np.full((50, 50), 3.0, dtype='float32')
+    nodata_mask = np.zeros(band.shape, dtype=bool)
+    nodata_mask[:, 10:] = True
+    band[nodata_mask] = 1.0
+    band_fillna = NodataFiller(max_search_distance=20).fill(band, nodata_mask)
+    assert np.all(band_fillna[:, 10:29] == 3.0)
+    assert np.all(band_fillna[:, 30:] == 1.0)
+
+
+def test_stack_of_bands_is_filled_at_once():
+    band, nodata_mask = create_band_with_nodata()
+    bands = np.stack([band, band * 2, band + 1])
+    nodata_filler = NodataFiller()
+    bands_fillna = nodata_filler.fill(bands, nodata_mask)
+    assert bands_fillna.shape == bands.shape
+    for step in range(3):
+        assert np.allclose(bands_fillna[step], nodata_filler.fill(bands[step], nodata_mask))
@@ -0,0 +1,72 @@
+import pytest
+from ..common.raster_sampler import PointSampler, LineSampler
+import numpy as np
+import os
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+
+
+transform = from_origin(24.90, 60.22, 0.001, 0.0005)
+band = np.arange(80 * 100, dtype='float32').reshape(80, 100) / 1000 + 1.0
+
+
+def test_point_sampler_matches_rasterio_sample():
+    rng = np.random.default_rng(1)
+    xs = rng.uniform(24.90, 25.00, 500)
+    ys = rng.uniform(60.18, 60.22, 500)
+    sampler = PointSampler(xs, ys)
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', height=80, width=100, count=1, dtype='float32', transform=transform) as raster:
+            raster.write(band, 1)
+            expected = [value.item() for value in raster.sample(zip(sampler.xs, sampler.ys))]
+    assert sampler.sample(band, transform).tolist() == expected
+
+
+def test_point_sampler_pixel_index_cache():
+    sampler = PointSampler(np.array([24.9005, 25.5]), np.array([60.2195, 60.20]))
+    rows, cols, inside = sampler.get_pixel_index(transform, band.shape)
+    assert (rows[0], cols[0]) == (1, 0)
+    assert inside.tolist() == [True, False]
+    assert sampler.get_pixel_index(transform, band.shape)[0] is rows
+    values = sampler.sample(band, transform)
+    assert values[0] == band[1, 0] and np.isnan(values[1])
+    # pixel index is recomputed for a different grid
+    shifted_transform = from_origin(24.85, 60.22, 0.001, 0.0005)
+    rows, cols, inside = sampler.get_pixel_index(shifted_transform, band.shape)
+    assert (rows[0], cols[0]) == (1, 50)
+
+
+def test_line_sampler_length_weights(tmp_path):
+    lines = np.array([
+        # 3/4 of the length in column 0 and 1/4 in column 1 of row 2
+        LineString([(24.90025, 60.21875), (24.90125, 60.21875)]),
+        # vertical line within pixel (row 1, col 3)
+        LineString([(24.9035, 60.2194), (24.9035, 60.2191)]),
+        LineString([(25.5, 60.20), (25.6, 60.20)])
+    ], dtype=object)
+    sampler = LineSampler(lines, cache_dir=str(tmp_path), geographic=False)
+    values = sampler.sample(band, transform)
+    assert values[0] == pytest.approx(0.75 * band[2, 0] + 0.25 * band[2, 1])
+    assert values[1] == pytest.approx(band[1, 3])
+    assert np.isnan(values[2])
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.npz')]) == 1
+    # weight matrix is read from the cache directory by a new sampler
+    cached_sampler = LineSampler(lines, cache_dir=str(tmp_path), geographic=False)
+    assert np.allclose(cached_sampler.get_weight_matrix(transform, band.shape).toarray(), 
+        sampler.get_weight_matrix(transform, band.shape).toarray())
+
+
+@pytest.mark.parametrize('sampler_type', ['point', 'line'])
+def test_stack_of_bands_is_sampled_at_once(sampler_type):
+    lines = [LineString([(24.905 + i * 0.01, 60.19), (24.91 + i * 0.01, 60.21)]) for i in range(5)] + [LineString([(25.5, 60.2), (25.6, 60.2)])]
+    if (sampler_type == 'point'):
+        sampler = PointSampler([line.centroid.x for line in lines], [line.centroid.y for line in lines])
+    else:
+        sampler = LineSampler(np.array(lines, dtype=object))
+    bands = np.stack([band, band * 2, band + 1])
+    values = sampler.sample(bands, transform)
+    assert values.shape == (6, 3)
+    for step in range(3):
+        assert np.allclose(values[:, step], sampler.sample(bands[step], transform), equal_nan=True)
+    assert np.isnan(values[5]).all()
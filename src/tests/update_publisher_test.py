@@ -0,0 +1,52 @@
+import pytest
+from ..common.update_publisher import UpdatePublisher
+from ..common.logger import Logger
+import os
+import json
+
+
+log = Logger(printing=False)
+
+
+def write_text(text: str):
+    return lambda f: f.write(text)
+
+
+def test_publish_versions(tmp_path):
+    publish_dir = str(tmp_path) + '/'
+    publisher = UpdatePublisher(log, publish_dir, keep_versions=2)
+    for version in ['v1', 'v2', 'v3']:
+        publisher.write_file(version + '.csv', write_text('id,aqi\n1,2.5\n'), text=True, rows=1)
+        publisher.write_file('map.json', write_text('{"v": '+ version[1] +'}'), text=True, latest_only=True)
+        publisher.publish(version, sequence=int(version[1]))
+        publisher.remove_old_files()
+    assert sorted(os.listdir(publish_dir)) == ['manifest.json', 'map.json', 'v2.csv', 'v3.csv']
+    with open(publish_dir + 'manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest['latest'] == 'v3'
+    assert [version['version'] for version in manifest['versions']] == ['v3', 'v2']
+    assert manifest['versions'][0]['sequence'] == 3
+    assert manifest['versions'][0]['files']['v3.csv']['rows'] == 1
+    assert manifest['versions'][0]['files']['v3.csv']['bytes'] == 13
+    # files of a fixed name are listed only in the latest files
+    assert list(manifest['versions'][0]['files']) == ['v3.csv']
+    assert manifest['latest_files']['map.json']['bytes'] == 8
+    # and are kept there until they are written again
+    publisher.write_file('v4.csv', write_text('id,aqi\n'), text=True)
+    publisher.publish('v4')
+    assert publisher.manifest['latest_files'] == manifest['latest_files']
+    publisher.remove_old_files()
+    # manifest is loaded on restart
+    assert UpdatePublisher(log, publish_dir).get_latest_version() == 'v4'
+
+
+def test_unpublished_files_are_removed(tmp_path):
+    publish_dir = str(tmp_path) + '/'
+    publisher = UpdatePublisher(log, publish_dir, keep_versions=1)
+    publisher.write_file('v1.csv', write_text('id,aqi\n'), text=True)
+    publisher.publish('v1')
+    publisher.write_file('v2.csv', write_text('id,aqi\n'), text=True)
+    publisher.write_file('keep.npy', write_text('id,aqi\n'), text=True)
+    publisher.remove_old_files(keep_files=['keep.csv'])
+    assert sorted(os.listdir(publish_dir)) == ['keep.npy', 'manifest.json', 'v1.csv']
+    assert publisher.publish('v3')['files'] == {}